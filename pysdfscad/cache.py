@@ -0,0 +1,374 @@
+"""
+On disk caches, kept under the appdirs user cache directory.
+
+Everything in here is content addressed, entries are named after a hash
+of whatever produced them, so a stale entry is never served, it just stops
+being used and eventually gets evicted.
+
+Eviction is least-recently-used, we bump an entry's mtime every time it's
+read and throw away the oldest entries once a cache grows over its size
+budget, as well as anything that hasn't been touched in `max_age` seconds.
+Between scans of the directory we keep a running total of what we've
+added, and only scan again once that's over budget, or `SCAN_INTERVAL`
+seconds after the last scan.
+"""
+
+from appdirs import AppDirs
+from pathlib import Path
+from loguru import logger  # type: ignore
+import importlib.util
+import hashlib
+import io
+import marshal
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+dirs = AppDirs("pySdfScad", "pySdfScad")
+
+DAY = 60 * 60 * 24
+#: Temporary files older than this are left over from a failed write
+STALE_TEMPORARY = 60 * 60
+
+
+def cache_dir(*parts):
+    """Return (and create) a directory inside the user cache directory."""
+    path = Path(dirs.user_cache_dir, *parts)
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+def digest(*parts):
+    """Stable hex digest of a number of str/bytes parts."""
+    out = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        out.update(len(part).to_bytes(8, "little"))
+        out.update(part)
+    return out.hexdigest()
+
+
+class DiskCache:
+    """A directory of files keyed by hash, with LRU eviction by size and age."""
+
+    #: Most seconds between scans of the directory when storing entries
+    SCAN_INTERVAL = 60
+
+    def __init__(self, name, suffix="", max_size=256 * 2**20, max_age=30 * DAY):
+        self.name = name
+        self.suffix = suffix
+        self.max_size = max_size
+        self.max_age = max_age
+        # Size of the cache as of the last scan, plus what we've added since
+        self._size = None
+        self._scanned = 0.0
+
+    @property
+    def root(self):
+        return cache_dir(self.name)
+
+    def path(self, key):
+        return self.root / (key + self.suffix)
+
+    def get(self, key):
+        """Return the cached bytes for key, or None on a miss."""
+        path = self.path(key)
+        try:
+            data = path.read_bytes()
+        except OSError:
+            return None
+        self.touch(path)
+        return data
+
+    def touch(self, path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def put(self, key, data):
+        """Atomically store bytes for key, then evict old entries."""
+        path = self.path(key)
+        tmp = None
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError as e:
+            if tmp is not None:
+                _unlink(tmp)
+            logger.warning(f"Unable to write {path} to cache: {e}")
+            return None
+        self._added(len(data))
+        return path
+
+    def _added(self, size):
+        """Count a new entry of size bytes, evicting if it's time to."""
+        if self._size is not None:
+            self._size += size
+        if self._size is None or self._size > self.max_size or time.time() - self._scanned > self.SCAN_INTERVAL:
+            self.evict()
+
+    def entries(self):
+        out = []
+        for path in self.root.glob("*" + self.suffix):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            out.append((stat.st_mtime, stat.st_size, path))
+        return sorted(out)
+
+    def evict(self):
+        """Drop entries older than max_age, then the least recently used
+        entries until we're under max_size, and any temporary files left
+        behind by writes that never finished.
+        """
+        now = time.time()
+        for path in self.root.glob("*.tmp"):
+            try:
+                if path.stat().st_mtime < now - STALE_TEMPORARY:
+                    path.unlink()
+            except OSError:
+                pass
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        cutoff = now - self.max_age
+        for mtime, size, path in entries:
+            if mtime >= cutoff and total <= self.max_size:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                continue
+            total -= size
+        self._size, self._scanned = total, now
+
+    def clear(self):
+        for _, _, path in self.entries():
+            _unlink(path)
+        self._size = None
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def compiler_version():
+    """Fingerprint of everything that decides what code we generate."""
+    import lark
+
+    package = Path(__file__).parent
+    parts = [lark.__version__]
+    for name in COMPILER_SOURCES:
+        try:
+            parts.append((package / name).read_bytes())
+        except OSError:
+            # Frozen builds might not ship the source, fall back to the version
+            from importlib.metadata import version
+
+            parts.append(version("pysdfscad"))
+    return digest(*parts)
+
+
+COMPILER_SOURCES = ("openscad.lark", "compiler.py", "optimizer.py", "openscad_builtins.py")
+
+
+class BytecodeCache(DiskCache):
+    """Caches compiled code objects for openscad sources, like `__pycache__`.
+
+    Keyed on the source text, the filename the code reports in tracebacks,
+    the compiler version and the python version.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__("bytecode", suffix=".pyc", **kwargs)
+        self._version = None
+
+    def key(self, text, filename, **options):
+        if self._version is None:
+            self._version = compiler_version()
+        return digest(
+            text,
+            filename,
+            self._version,
+            sys.implementation.cache_tag or sys.version,
+            repr(sorted(options.items())),
+        )
+
+    def load(self, key):
+        data = self.get(key)
+        if data is None or not data.startswith(importlib.util.MAGIC_NUMBER):
+            return None
+        try:
+            return marshal.loads(data[len(importlib.util.MAGIC_NUMBER) :])
+        except (EOFError, ValueError, TypeError):
+            return None
+
+    def store(self, key, code):
+        return self.put(key, importlib.util.MAGIC_NUMBER + marshal.dumps(code))
+
+
+bytecode_cache = BytecodeCache()
+
+
+def mesher_version():
+    """Fingerprint of everything that decides what mesh we generate."""
+    package = Path(__file__).parent
+    parts = []
+    for name in MESHER_SOURCES:
+        try:
+            parts.append((package / name).read_bytes())
+        except OSError:
+            from importlib.metadata import version
+
+            parts.append(version("pysdfscad"))
+    return digest(*parts)
+
+
+MESHER_SOURCES = ("geometry.py", "kernel.py", "mesher.py", "dual_contouring.py", "decimate.py", "volume.py")
+
+
+class MeshCache(DiskCache):
+    """Caches finished meshes, keyed on the geometry's structural hash
+    (`geometry.Node.digest`), the step, bounds, engine and whatever other
+    options change the result.
+
+    Meshes are stored as uncompressed `.npz` files, so loading one is about
+    as fast as the disk.
+    """
+
+    #: `Node.generate` options that don't change the mesh
+    IGNORED = ("verbose", "processes", "workers", "volumes")
+
+    def __init__(self, max_size=1024 * 2**20, **kwargs):
+        super().__init__("meshes", suffix=".npz", max_size=max_size, **kwargs)
+        self._version = None
+
+    def key(self, node, step, bounds, engine, **options):
+        if self._version is None:
+            self._version = mesher_version()
+        options = {k: v for k, v in options.items() if k not in self.IGNORED}
+        return digest(
+            node.digest,
+            repr(None if step is None else np.asarray(step, dtype=float).tolist()),
+            repr(None if bounds is None else np.asarray(bounds, dtype=float).tolist()),
+            engine,
+            self._version,
+            repr(sorted(options.items())),
+        )
+
+    def load(self, key):
+        """The cached mesh, a triangle soup or `(vertices, faces)` pair like
+        it was stored, or None.
+        """
+        data = self.get(key)
+        if data is None:
+            return None
+        try:
+            with np.load(io.BytesIO(data)) as arrays:
+                if "points" in arrays:
+                    return arrays["points"]
+                return arrays["vertices"], arrays["faces"]
+        except (OSError, ValueError, KeyError, EOFError):
+            return None
+
+    def store(self, key, mesh):
+        out = io.BytesIO()
+        if isinstance(mesh, tuple):
+            vertices, faces = mesh
+            np.savez(out, vertices=vertices, faces=faces)
+        else:
+            np.savez(out, points=np.asarray(mesh))
+        return self.put(key, out.getvalue())
+
+    def collect(self, key, chunks):
+        """Pass through mesh chunks (see `export`), storing the whole mesh
+        at the end, unless it's too big to be worth keeping.
+        """
+        from pysdfscad import mesher
+
+        kept, size = [], 0
+        for chunk in chunks:
+            yield chunk
+            if kept is None:
+                continue
+            size += sum(i.nbytes for i in chunk)
+            if size > self.max_size:
+                kept = None
+            else:
+                kept.append(chunk)
+        if kept is not None:
+            self.store(key, mesher.assemble(kept))
+
+
+class VolumeCache(DiskCache):
+    """Caches sampled distance volumes (see `pysdfscad.volume`) as `.npy`
+    files, keyed on the geometry's structural hash and the grid.
+
+    Volumes are sampled straight into the file and handed back memory
+    mapped, so neither storing nor loading one needs it all in memory.
+    """
+
+    def __init__(self, max_size=4 * 2**30, **kwargs):
+        super().__init__("volumes", suffix=".npy", max_size=max_size, **kwargs)
+        self._version = None
+
+    def key(self, node, axes):
+        if self._version is None:
+            self._version = mesher_version()
+        return digest(node.digest, self._version, *[np.asarray(i, dtype=float).tobytes() for i in axes])
+
+    def load(self, key, shape):
+        """The cached volume, memory mapped, or None.
+
+        The mapping is copy on write, the file never changes, but
+        `skimage` only takes writable buffers.
+        """
+        path = self.path(key)
+        try:
+            volume = np.load(path, mmap_mode="c")
+        except (OSError, ValueError):
+            return None
+        if volume.shape != tuple(shape) or volume.dtype != np.float32:
+            return None
+        self.touch(path)
+        return volume
+
+    def store(self, key, shape, fill):
+        """Create the volume for key, have `fill(volume)` sample it, and
+        return it memory mapped. None if it's too big to keep or can't be
+        written.
+        """
+        if 4 * np.prod(shape, dtype=float) > self.max_size:
+            return None
+        path = self.path(key)
+        try:
+            fd, tmp = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+            os.close(fd)
+        except OSError as e:
+            logger.warning(f"Unable to write {path} to cache: {e}")
+            return None
+        try:
+            volume = np.lib.format.open_memmap(tmp, mode="w+", dtype=np.float32, shape=tuple(shape))
+            fill(volume)
+            volume.flush()
+            del volume
+            os.replace(tmp, path)
+        except BaseException:
+            _unlink(tmp)
+            raise
+        self._added(4 * int(np.prod(shape)))
+        return self.load(key, shape)
+
+
+mesh_cache = MeshCache()
+volume_cache = VolumeCache()
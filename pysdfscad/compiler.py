@@ -56,6 +56,11 @@ import ast
 import itertools
 from pathlib import Path
 import functools
+from pysdfscad.cache import cache_dir
+
+# `$fn`, `$fa` and `$fs`. Any module call can set them, and builtins look
+# them up in their callers' frames, since they're dynamically scoped.
+SPECIAL_VARIABLES = ("var_fn", "var_fa", "var_fs")
 
 
 def lines(arg):
@@ -267,25 +272,22 @@ class OpenscadToPy(Transformer):
             **lines(meta),
         )
 
-    def combined_args(self, meta, *args_orig):
-        if len(args_orig) == 2:
-            args, kwargs = args_orig
-        elif len(args_orig) == 1:
-            if isinstance(args_orig[0][0], ast.keyword):
-                args = []
-                kwargs = args_orig[0]
+    def _split_args(self, children):
+        """Split a mixed argument list into positional and keyword arguments."""
+        args = []
+        kwargs = []
+        for child in children:
+            if child is None:
+                continue
+            elif isinstance(child, ast.keyword):
+                kwargs.append(child)
             else:
-                args = args_orig[0]
-                kwargs = []
-        elif len(args_orig) == 0:
-            args = []
-            kwargs = []
-        else:
-            raise Exception(
-                "That's the wrong nuber of args, something has gone very wrong"
-            )
+                args.append(child)
         return args, kwargs
 
+    def combined_args(self, meta, *children):
+        return self._split_args(children)
+
     def for_loop(self, meta, args, block):
         args, kwargs = args
         block = list(self._normalize_block(block))
@@ -323,9 +325,6 @@ class OpenscadToPy(Transformer):
         )
         yield result
 
-    def kwargs(self, meta, *children):
-        return children
-
     def args(self, meta, *children):
         return children
 
@@ -363,32 +362,13 @@ class OpenscadToPy(Transformer):
             **lines(meta),
         )
 
-    def args_definition(self, meta, *args_orig):
-        if len(args_orig) == 2:
-            args, kwargs = args_orig
-        elif len(args_orig) == 1:
-            if isinstance(args_orig[0][0], ast.keyword):
-                args = []
-                kwargs = args_orig[0]
-            else:
-                args = args_orig[0]
-                kwargs = []
-        elif len(args_orig) == 0:
-            args = []
-            kwargs = []
-        else:
-            raise Exception(
-                "That's the wrong nuber of args, something has gone very wrong"
-            )
-
+    def args_definition(self, meta, *children):
+        args, kwargs = self._split_args(children)
         newargs = []
         for arg in args:
             newargs.append(ast.arg(arg="var_" + arg.value, **lines(arg)))
         return newargs, kwargs
 
-    def arg_def_name(self, meta, *children):
-        return children
-
     def name(self, meta, children):
         return children
 
@@ -447,6 +427,16 @@ class OpenscadToPy(Transformer):
             **lines(meta),
         )
 
+    def or_op(self, meta, left, right):
+        return ast.BoolOp(
+            values=[
+                left,
+                right,
+            ],
+            op=ast.Or(),
+            **lines(meta),
+        )
+
     def and_op(self, meta, left, right):
         return ast.BoolOp(
             values=[
@@ -535,6 +525,10 @@ class OpenscadToPy(Transformer):
                     **lines(meta),
                 )
             )
+        # Special variables passed to the module have to end up as locals
+        # of the generator, where the builtins it calls can find them
+        declared = {i.arg for i in args}
+        specials = [i for i in SPECIAL_VARIABLES if i not in declared]
 
         body = [
             ast.FunctionDef(
@@ -550,8 +544,8 @@ class OpenscadToPy(Transformer):
                         *args,
                     ],
                     posonlyargs=[],
-                    kwonlyargs=[],
-                    kw_defaults=[],
+                    kwonlyargs=[ast.arg(i, **lines(meta)) for i in specials],
+                    kw_defaults=[ast.Name(id=i, ctx=ast.Load(), **lines(meta)) for i in specials],
                     defaults=inner_defaults,
                 ),
                 **lines(meta),
@@ -576,8 +570,8 @@ class OpenscadToPy(Transformer):
             args=ast.arguments(
                 args=args,
                 posonlyargs=[],
-                kwonlyargs=[],
-                kw_defaults=[],
+                kwonlyargs=[ast.arg(i, **lines(meta)) for i in specials],
+                kw_defaults=[ast.Constant(None, **lines(meta)) for i in specials],
                 defaults=defaults,
             ),
             **lines(meta),
@@ -615,7 +609,7 @@ class OpenscadToPy(Transformer):
 
     def vector(self, meta, args):
         return ast.List(
-            list(args),
+            list(args or ()),
             ctx=ast.Load(),
             **lines(meta),
         )
@@ -625,7 +619,117 @@ class OpenscadToPy(Transformer):
         raise
 
 
-parser = Lark.open("openscad.lark", rel_to=__file__, propagate_positions=True)
+class IncrementalOpenscadToPy:
+    """Transforms a parse tree, reusing the generated AST for top level
+    statements that haven't changed since the previous call.
+
+    Statements are keyed on their source text and starting column. A
+    statement that only moved up or down has its cached AST shifted to the
+    new line, so an edit only pays for re-transforming the statements it
+    actually touched.
+
+    Cached nodes are reused as-is rather than copied, so passes that run on
+    the resulting module must not modify it in place.
+    """
+
+    def __init__(self):
+        self.statements = {}
+        self.reused = 0
+        self.transformed = 0
+
+    def transform(self, tree, text):
+        transformer = OpenscadToPy()
+        statements = {}
+        children = []
+        self.reused = self.transformed = 0
+        for child in tree.children:
+            if isinstance(child, Token):
+                start, end, line, column = (
+                    child.start_pos,
+                    child.end_pos,
+                    child.line,
+                    child.column,
+                )
+            else:
+                meta = child.meta
+                start, end, line, column = (
+                    meta.start_pos,
+                    meta.end_pos,
+                    meta.line,
+                    meta.column,
+                )
+            key = (text[start:end], column)
+
+            # Identical statements can show up more than once, each copy
+            # needs its own nodes since they live on different lines.
+            pool = self.statements.get(key)
+            if pool:
+                cached = pool.pop()
+                cached_line, is_generator, nodes = cached
+                if line != cached_line:
+                    self._relocate(nodes, line - cached_line)
+                    cached = (line, is_generator, nodes)
+                self.reused += 1
+            else:
+                (result,) = transformer.transform(Tree("block", [child]))
+                if isinstance(result, types.GeneratorType):
+                    cached = (line, True, list(result))
+                else:
+                    cached = (line, False, [result])
+                self.transformed += 1
+            statements.setdefault(key, []).append(cached)
+
+            _, is_generator, nodes = cached
+            if is_generator:
+                # _normalize_block treats generators differently from bare
+                # nodes, so keep the shape the transformer originally gave us
+                children.append(node for node in nodes)
+            else:
+                children.append(nodes[0])
+
+        # Only keep statements that are still in the file
+        self.statements = statements
+        return transformer.transform(Tree("start", children, tree.meta))
+
+    @staticmethod
+    def _relocate(nodes, offset):
+        """Like `ast.increment_lineno`, but our ASTs share some nodes (module
+        arguments appear in two signatures) so only move each node once.
+        """
+        seen = set()
+        for root in nodes:
+            for node in ast.walk(root):
+                if id(node) in seen:
+                    continue
+                seen.add(id(node))
+                if getattr(node, "lineno", None) is not None:
+                    node.lineno += offset
+                if getattr(node, "end_lineno", None) is not None:
+                    node.end_lineno += offset
+
+
+def _build_parser():
+    """Build the shared LALR parser.
+
+    Lark can serialize the generated parse tables, so we keep them in the
+    user cache directory. Lark checks the grammar hash stored in the cache file
+    and rebuilds it if the grammar or lark version changed.
+    """
+    try:
+        cache = str(cache_dir() / f"openscad-lark-{lark.__version__}.cache")
+    except OSError:
+        cache = False
+    return Lark.open(
+        "openscad.lark",
+        rel_to=__file__,
+        parser="lalr",
+        lexer="contextual",
+        propagate_positions=True,
+        cache=cache,
+    )
+
+
+parser = _build_parser()
 example_text = """
 """
 
@@ -0,0 +1,219 @@
+"""
+Mesh decimation by quadric edge collapse.
+
+Marching cubes gives every part of the surface the same density of
+triangles, flat faces included. This merges triangles back together where
+that doesn't move the surface by more than a given error.
+
+Every vertex keeps a quadric, the sum of squared distances to the planes of
+the faces around it in the original mesh (Garland and Heckbert). Collapsing
+an edge into a point costs the sum of both end's quadrics at that point,
+so as long as the cost stays under `error ** 2` the mesh never strays more
+than `error` from any of the original faces it replaced. Coplanar regions
+all share one plane and collapse for free, so they're merged first.
+
+It's vectorized over the whole mesh. Each round picks a set of edges that
+are the cheapest in their neighbourhood, so no two of them touch the same
+triangles, and collapses all of them at once, except those that would make
+the mesh non-manifold or flip a triangle over.
+"""
+
+import time
+
+import numpy as np
+from loguru import logger  # type: ignore
+from scipy import sparse  # type: ignore
+
+#: Triangles can't turn by more than this (as a cosine) in one collapse
+MIN_NORMAL_COS = 0.2
+MAX_ROUNDS = 200
+#: How finely collapses are ordered by cost within a round
+COST_BUCKETS = 16
+
+
+def _proper(faces):
+    return (faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 2] != faces[:, 0])
+
+
+def _normals(vertices, faces):
+    a, b, c = (vertices[faces[:, i]] for i in range(3))
+    return np.cross(b - a, c - a)
+
+
+def plane_quadrics(vertices, faces):
+    """Sum of the plane quadrics of the faces around each vertex, `(n, 4, 4)`."""
+    normals = _normals(vertices, faces)
+    length = np.linalg.norm(normals, axis=1, keepdims=True)
+    normals = np.divide(normals, length, out=np.zeros_like(normals), where=length > 0)
+    planes = np.hstack([normals, -np.sum(normals * vertices[faces[:, 0]], axis=1, keepdims=True)])
+    quadrics = planes[:, :, None] * planes[:, None, :]
+    out = np.empty((len(vertices), 16))
+    corners = faces.ravel()
+    for i, column in enumerate(quadrics.reshape(-1, 16).T):
+        out[:, i] = np.bincount(corners, weights=np.repeat(column, 3), minlength=len(vertices))
+    return out.reshape(-1, 4, 4)
+
+
+def edges(faces, count):
+    """Unique edges as `(n, 2)` sorted pairs, and how many faces use each."""
+    pairs = np.sort(faces[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2), axis=1)
+    keys, uses = np.unique(pairs[:, 0] * count + pairs[:, 1], return_counts=True)
+    return np.stack([keys // count, keys % count], axis=1), uses
+
+
+def _cost(quadric, points):
+    homogeneous = np.concatenate([points, np.ones(points.shape[:-1] + (1,))], axis=-1)
+    return np.einsum("...i,...ij,...j->...", homogeneous, quadric, homogeneous)
+
+
+def collapse_targets(vertices, quadrics, pairs):
+    """Where to collapse each edge to, and what it costs.
+
+    That's the point minimizing the quadric when it's well defined and
+    close to the edge, otherwise the best of the ends and the midpoint.
+    """
+    a, b = vertices[pairs[:, 0]], vertices[pairs[:, 1]]
+    quadric = quadrics[pairs[:, 0]] + quadrics[pairs[:, 1]]
+    candidates = [a, b, (a + b) / 2]
+
+    system = quadric[:, :3, :3]
+    solvable = np.abs(np.linalg.det(system)) > 1e-12
+    optimal = (a + b) / 2
+    if solvable.any():
+        optimal[solvable] = np.linalg.solve(system[solvable], -quadric[solvable, :3, 3:])[..., 0]
+    near = np.linalg.norm(optimal - (a + b) / 2, axis=1) <= np.linalg.norm(b - a, axis=1)
+    candidates.append(np.where((solvable & near)[:, None], optimal, (a + b) / 2))
+
+    candidates = np.stack(candidates, axis=1)
+    costs = _cost(quadric[:, None], candidates)
+    best = np.argmin(costs, axis=1)
+    rows = np.arange(len(pairs))
+    return candidates[rows, best], np.maximum(costs[rows, best], 0)
+
+
+def _local_minima(pairs, allowed, rank, count):
+    """Allowed edges that are the cheapest edge touching their own or any
+    neighbouring vertex, which keeps their neighbourhoods apart.
+    """
+    rank = np.where(allowed, rank, len(pairs))
+    own = np.full(count, len(pairs), dtype=np.int64)
+    np.minimum.at(own, pairs[:, 0], rank)
+    np.minimum.at(own, pairs[:, 1], rank)
+    ring = own.copy()
+    np.minimum.at(ring, pairs[:, 0], own[pairs[:, 1]])
+    np.minimum.at(ring, pairs[:, 1], own[pairs[:, 0]])
+    return allowed & (rank == ring[pairs[:, 0]]) & (rank == ring[pairs[:, 1]])
+
+
+def _independent(pairs, allowed, costs, count, passes=16):
+    """A set of allowed edges, cheapest first, no two of which have ends
+    that are the same or neighbours, so no triangle is touched by two.
+
+    Each pass adds the local minima among the edges that are still free,
+    which gets close to a maximal set in a few passes. That only works if
+    the order is random-ish, flat regions are full of edges that all cost
+    nothing, so costs are sorted into `COST_BUCKETS` and ties are broken at
+    random.
+    """
+    buckets = np.floor(costs / max(costs[allowed].max(initial=0), 1e-300) * COST_BUCKETS)
+    noise = np.random.default_rng(count).random(len(pairs))
+    rank = np.empty(len(pairs), dtype=np.int64)
+    rank[np.lexsort((noise, buckets))] = np.arange(len(pairs))
+    selected = np.zeros(len(pairs), dtype=bool)
+    for _ in range(passes):
+        chosen = _local_minima(pairs, allowed, rank, count)
+        if not chosen.any():
+            break
+        selected |= chosen
+        # Block the ends of chosen edges and everything next to them
+        taken = np.zeros(count, dtype=bool)
+        taken[pairs[selected].ravel()] = True
+        near = taken.copy()
+        near[pairs[taken[pairs[:, 0]], 1]] = True
+        near[pairs[taken[pairs[:, 1]], 0]] = True
+        allowed = allowed & ~near[pairs[:, 0]] & ~near[pairs[:, 1]]
+    return selected
+
+
+def _manifold(pairs, selected, count):
+    """The link condition, the ends of an edge share exactly two neighbours."""
+    ones = np.ones(len(pairs))
+    adjacency = sparse.csr_matrix((ones, (pairs[:, 0], pairs[:, 1])), shape=(count, count))
+    adjacency = adjacency + adjacency.T
+    a, b = pairs[selected, 0], pairs[selected, 1]
+    shared = np.asarray(adjacency[a].multiply(adjacency[b]).sum(axis=1)).ravel()
+    return shared == 2
+
+
+def _flips(vertices, faces, pairs, targets):
+    """Which of the collapses in pairs would turn a triangle over."""
+    owner = np.full(len(vertices), -1)
+    owner[pairs[:, 0]] = np.arange(len(pairs))
+    owner[pairs[:, 1]] = np.arange(len(pairs))
+    moved = owner[faces]
+    edge = moved.max(axis=1)
+    # Triangles on the edge itself disappear, only check the ones around it
+    affected = (edge >= 0) & ((moved >= 0).sum(axis=1) == 1)
+    faces, edge = faces[affected], edge[affected]
+    before = _normals(vertices, faces)
+    after_vertices = vertices[faces]
+    corner = owner[faces] >= 0
+    after_vertices[corner] = targets[owner[faces][corner]]
+    a, b, c = after_vertices.transpose(1, 0, 2)
+    after = np.cross(b - a, c - a)
+    cos = np.sum(before * after, axis=1)
+    scale = np.linalg.norm(before, axis=1) * np.linalg.norm(after, axis=1)
+    bad = cos <= MIN_NORMAL_COS * scale
+    out = np.zeros(len(pairs), dtype=bool)
+    out[edge[bad]] = True
+    return out
+
+
+def decimate_indexed(vertices, faces, error, max_rounds=MAX_ROUNDS):
+    """Decimate an indexed mesh, returning new vertices and faces."""
+    vertices = vertices.astype(float, copy=True)
+    faces = faces[_proper(faces)]
+    quadrics = plane_quadrics(vertices, faces)
+    limit = error**2
+    for _ in range(max_rounds):
+        count = len(vertices)
+        pairs, uses = edges(faces, count)
+        # Keep open edges where they are, and anything touching them
+        locked = np.zeros(count, dtype=bool)
+        locked[pairs[uses != 2].ravel()] = True
+        targets, costs = collapse_targets(vertices, quadrics, pairs)
+        allowed = (costs <= limit) & ~locked[pairs[:, 0]] & ~locked[pairs[:, 1]]
+        selected = _independent(pairs, allowed, costs, count)
+        if not selected.any():
+            break
+        index = np.flatnonzero(selected)
+        index = index[_manifold(pairs, selected, count)]
+        index = index[~_flips(vertices, faces, pairs[index], targets[index])]
+        if not len(index):
+            break
+
+        keep, drop = pairs[index, 0], pairs[index, 1]
+        vertices[keep] = targets[index]
+        quadrics[keep] += quadrics[drop]
+        remap = np.arange(count)
+        remap[drop] = keep
+        faces = remap[faces]
+        faces = faces[_proper(faces)]
+
+    used, faces = np.unique(faces, return_inverse=True)
+    return vertices[used], faces.reshape(-1, 3)
+
+
+def decimate(mesh, error):
+    """Decimate a `(vertices, faces)` mesh, like the ones `generate()`
+    returns with `indexed`, keeping within `error` of the original surface.
+    """
+    start = time.time()
+    vertices, faces = mesh
+    before = len(faces)
+    vertices, faces = decimate_indexed(vertices, faces, error)
+    logger.info(
+        f"Decimated {before} triangles to {len(faces)} "
+        f"({len(faces) / max(before, 1):.1%}) in {time.time() - start:.3g} seconds"
+    )
+    return vertices, faces
@@ -0,0 +1,203 @@
+"""
+Dual contouring mesher.
+
+Marching cubes puts its vertices on the edges of the sampling grid, so it
+can only ever cut across the corners and edges of a part, and the only way
+to get them sharper is a finer grid. Dual contouring (Ju et al.) puts one
+vertex inside every cell the surface passes through instead, and joins the
+vertices of the four cells around every grid edge the surface crosses into
+a quad.
+
+Where a cell's vertex goes comes from the surface normals: for each crossing
+we know a point on the surface and, from the gradient of the distance
+function, the plane there. The vertex is the point closest to all of those
+planes (the quadratic error function, or QEF), which is the corner or edge
+where they meet if there is one, so a box meshed with a coarse grid still
+has exactly square corners.
+
+Gradients are estimated by central finite differences, evaluated in one
+batch for all the crossings. The grid is the same as `pysdfscad.mesher`'s,
+and only the blocks `mesher.surface_blocks` finds near the surface get
+sampled, each with its own specialized distance function if there is one.
+"""
+
+import time
+
+import numpy as np
+from loguru import logger  # type: ignore
+
+from pysdfscad import mesher
+
+#: Finite difference step, as a fraction of the grid step
+GRADIENT_STEP = 1e-3
+#: Directions in the QEF with less than this (relative) weight are ignored,
+#: the vertex stays near the middle of the crossings along them
+QEF_CUTOFF = 0.1
+
+_AXES = np.eye(3, dtype=np.int64)
+
+
+def _flat(index, counts):
+    return (index[..., 0] * counts[1] + index[..., 1]) * counts[2] + index[..., 2]
+
+
+def _lookup(keys, query):
+    """Position of each of query in the sorted keys, and whether it's there."""
+    position = np.minimum(np.searchsorted(keys, query), max(len(keys) - 1, 0))
+    return position, (keys[position] == query) if len(keys) else np.zeros(len(query), dtype=bool)
+
+
+def _sample(groups, axes, counts, leaf_size):
+    """Distances at every grid point of the blocks, as sorted flat keys and
+    values.
+    """
+    offsets = np.stack(np.meshgrid(*[np.arange(leaf_size + 1)] * 3, indexing="ij"), axis=-1).reshape(-1, 3)
+    per_batch = max(1, mesher.BATCH_POINTS // len(offsets))
+    keys, values = [], []
+    for f, group in groups.items():
+        group = np.asarray(group)
+        for i in range(0, len(group), per_batch):
+            index = np.minimum(group[i : i + per_batch, None, :] + offsets, counts - 1).reshape(-1, 3)
+            index = np.unique(index, axis=0)
+            points = np.stack([axes[axis][index[:, axis]] for axis in range(3)], axis=1)
+            keys.append(_flat(index, counts))
+            values.append(mesher._evaluate(f, points))
+    keys, values = np.concatenate(keys), np.concatenate(values)
+    keys, first = np.unique(keys, return_index=True)
+    return keys, values[first]
+
+
+def _gradients(groups, blocks, leaf_size, counts, points, index, f, step):
+    """Unit normals at points, by central differences, using the distance
+    function of the block each grid index is in.
+    """
+    owner = np.full(len(points), -1)
+    if len(groups) > 1:
+        block_keys = _flat(np.concatenate([np.asarray(i) for i in groups.values()]), counts)
+        block_group = np.repeat(np.arange(len(groups)), [len(i) for i in groups.values()])
+        order = np.argsort(block_keys)
+        position, found = _lookup(block_keys[order], _flat(index // leaf_size * leaf_size, counts))
+        owner = np.where(found, block_group[order][position], -1)
+
+    h = GRADIENT_STEP * step
+    offsets = np.concatenate([np.diag(h), -np.diag(h)])
+    normals = np.empty((len(points), 3))
+    functions = [f] + list(groups)
+    for i, group_f in enumerate(functions):
+        which = np.flatnonzero(owner == i - 1)
+        if not len(which):
+            continue
+        samples = (points[which, None, :] + offsets).reshape(-1, 3)
+        d = mesher._evaluate(group_f, samples).reshape(-1, 6)
+        normals[which] = (d[:, :3] - d[:, 3:]) / (2 * h)
+    length = np.linalg.norm(normals, axis=1, keepdims=True)
+    return np.divide(normals, length, out=np.zeros_like(normals), where=length > 0)
+
+
+def _solve_qef(normals, points, cells, count, low, high):
+    """The point closest to all the planes through each cell's crossings,
+    clamped to the cell.
+    """
+    ata = np.zeros((count, 3, 3))
+    atb = np.zeros((count, 3))
+    np.add.at(ata, cells, normals[:, :, None] * normals[:, None, :])
+    np.add.at(atb, cells, normals * np.sum(normals * points, axis=1, keepdims=True))
+    mass = np.zeros((count, 3))
+    np.add.at(mass, cells, points)
+    mass /= np.maximum(np.bincount(cells, minlength=count), 1)[:, None]
+
+    # Pseudo inverse with small eigenvalues dropped, so flat and edge cells
+    # keep their vertex near the crossings rather than flying off
+    values, vectors = np.linalg.eigh(ata)
+    keep = values > QEF_CUTOFF * values[:, -1:]
+    inverse = np.divide(1, values, out=np.zeros_like(values), where=keep)
+    residual = atb - np.einsum("nij,nj->ni", ata, mass)
+    along = np.einsum("nji,nj->ni", vectors, residual) * inverse
+    vertices = mass + np.einsum("nij,nj->ni", vectors, along)
+    return np.clip(vertices, low, high)
+
+
+def generate(
+    f, step, bounds, leaf_size=mesher.LEAF_SIZE, verbose=False, interval=None, specialize=None, indexed=False
+):
+    """Mesh a distance function by dual contouring, returning a triangle
+    soup like `sdf`, or with `indexed` a `(vertices, faces)` pair.
+
+    Takes the same arguments as `mesher.generate`. There's one vertex per
+    cell, so the mesh comes out indexed by cell without any welding.
+    """
+    start = time.time()
+    axes = mesher.grid(bounds, step)
+    counts = np.array([len(i) for i in axes])
+    if np.any(counts < 2):
+        return mesher._empty(indexed)
+    spacing = np.array([i[1] - i[0] for i in axes])
+    origin = np.array([i[0] for i in axes])
+    blocks = mesher.surface_blocks(f, axes, leaf_size, interval)
+    if not len(blocks):
+        return mesher._empty(indexed)
+    groups = mesher.block_groups(f, axes, blocks, leaf_size, specialize)
+    keys, values = _sample(groups, axes, counts, leaf_size)
+    inside = values < 0
+    grid_index = np.stack(np.unravel_index(keys, counts), axis=1)
+
+    # Grid edges the surface crosses, from each sample towards +x, +y, +z
+    crossing_index, crossing_axis, crossing_inside, crossing_points = [], [], [], []
+    for axis in range(3):
+        in_grid = grid_index[:, axis] < counts[axis] - 1
+        position, found = _lookup(keys, _flat(grid_index[in_grid] + _AXES[axis], counts))
+        first = np.flatnonzero(in_grid)[found]
+        second = position[found]
+        crosses = inside[first] != inside[second]
+        first, second = first[crosses], second[crosses]
+        a, b = values[first], values[second]
+        t = a / (a - b)
+        point = origin + grid_index[first] * spacing
+        point[:, axis] += t * spacing[axis]
+        crossing_index.append(grid_index[first])
+        crossing_axis.append(np.full(len(first), axis))
+        crossing_inside.append(inside[first])
+        crossing_points.append(point)
+    crossing_index = np.concatenate(crossing_index)
+    crossing_axis = np.concatenate(crossing_axis)
+    crossing_inside = np.concatenate(crossing_inside)
+    crossing_points = np.concatenate(crossing_points)
+
+    # The four cells around each crossing, in order around the edge
+    b_axis, c_axis = (crossing_axis + 1) % 3, (crossing_axis + 2) % 3
+    around = np.stack(
+        [
+            crossing_index,
+            crossing_index - _AXES[b_axis],
+            crossing_index - _AXES[b_axis] - _AXES[c_axis],
+            crossing_index - _AXES[c_axis],
+        ],
+        axis=1,
+    )
+    complete = np.all((around >= 0) & (around < counts - 1), axis=(1, 2))
+    cell_keys, cell_of = np.unique(_flat(np.maximum(around, 0), counts), return_inverse=True)
+    cell_of = cell_of.reshape(-1, 4)
+
+    normals = _gradients(groups, blocks, leaf_size, counts, crossing_points, crossing_index, f, spacing)
+    cell_index = np.stack(np.unravel_index(cell_keys, counts), axis=1)
+    low = origin + cell_index * spacing
+    vertices = _solve_qef(
+        np.repeat(normals, 4, axis=0),
+        np.repeat(crossing_points, 4, axis=0),
+        cell_of.ravel(),
+        len(cell_keys),
+        low,
+        low + spacing,
+    )
+
+    quads = cell_of[complete]
+    # Wind the quads so they face out, away from the inside end of the edge
+    flip = ~crossing_inside[complete]
+    quads[flip] = quads[flip][:, ::-1]
+    faces = np.concatenate([quads[:, [0, 1, 2]], quads[:, [0, 2, 3]]])
+    if verbose:
+        logger.info(
+            f"{len(blocks)} blocks near the surface, {len(cell_keys)} cells on the surface, "
+            f"{len(faces)} triangles in {time.time() - start:.3g} seconds"
+        )
+    return (vertices, faces) if indexed else vertices[faces].reshape(-1, 3)
@@ -0,0 +1,264 @@
+"""
+Streaming mesh exporters.
+
+Meshers hand us the mesh in chunks (see `mesher.generate_chunks`), and we
+write each one out as soon as it arrives, so only one batch of triangles
+is ever in memory. Every chunk is a `(vertices, faces, ids)` triple: an
+indexed mesh of its own, plus the index of each vertex in the whole mesh.
+Vertices shared with an earlier chunk come again with the same id, new
+ones get the next ids in order.
+
+Formats that need counts up front get a fixed width placeholder that's
+patched once we know, and formats that want all the vertices before any of
+the faces spool the faces to a temporary file and append them at the end.
+
+Files are written next to where they're going and only moved there once
+they're complete. If meshing fails, or is cancelled, part way through, the
+partial file is thrown away rather than patched up into one that looks
+whole.
+"""
+
+import os
+import secrets
+import shutil
+import struct
+import tempfile
+import zipfile
+from pathlib import Path
+
+import numpy as np
+
+
+class MeshWriter:
+    """Base class for the streaming writers, used as a context manager.
+
+    Writers write to `temporary`, `close` finishes that and moves it to
+    `path`, `abort` throws it away. Leaving the context does one or the
+    other, depending on whether there was an exception.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.temporary = self.path.with_name(f".{self.path.name}.{secrets.token_hex(4)}.tmp")
+        self.vertices = 0
+        self.faces = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, vertices, faces, ids):
+        new = ids >= self.vertices
+        self.write_vertices(vertices[new])
+        self.write_faces(ids[faces])
+        self.vertices += np.count_nonzero(new)
+        self.faces += len(faces)
+
+    def write_vertices(self, vertices):
+        raise NotImplementedError
+
+    def write_faces(self, faces):
+        raise NotImplementedError
+
+    def close(self):
+        """Finish the file and move it into place."""
+        try:
+            self._finish()
+            os.replace(self.temporary, self.path)
+        except BaseException:
+            self.temporary.unlink(missing_ok=True)
+            raise
+
+    def abort(self):
+        """Throw away what we've written, leaving path alone."""
+        try:
+            self._discard()
+        finally:
+            self.temporary.unlink(missing_ok=True)
+
+    def _finish(self):
+        raise NotImplementedError
+
+    def _discard(self):
+        raise NotImplementedError
+
+
+class StlWriter(MeshWriter):
+    """Binary STL, the triangle count in the header is patched on close."""
+
+    dtype = np.dtype([("normal", "<f4", 3), ("points", "<f4", (3, 3)), ("attribute", "<u2")])
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.file = open(self.temporary, "wb")
+        self.file.write(b"\0" * 80 + struct.pack("<I", 0))
+
+    def write(self, vertices, faces, ids):
+        triangles = vertices[faces].astype(np.float32)
+        normals = np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0])
+        length = np.linalg.norm(normals, axis=1, keepdims=True)
+        data = np.zeros(len(faces), dtype=self.dtype)
+        data["normal"] = np.divide(normals, length, out=np.zeros_like(normals), where=length > 0)
+        data["points"] = triangles
+        self.file.write(data.tobytes())
+        self.faces += len(faces)
+
+    def _finish(self):
+        self.file.seek(80)
+        self.file.write(struct.pack("<I", self.faces))
+        self.file.close()
+
+    def _discard(self):
+        self.file.close()
+
+
+class PlyWriter(MeshWriter):
+    """Binary little endian PLY."""
+
+    header = (
+        "ply\n"
+        "format binary_little_endian 1.0\n"
+        "element vertex {:010d}\n"
+        "property float x\n"
+        "property float y\n"
+        "property float z\n"
+        "element face {:010d}\n"
+        "property list uchar int vertex_indices\n"
+        "end_header\n"
+    )
+    face_dtype = np.dtype([("count", "u1"), ("indices", "<i4", 3)])
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.file = open(self.temporary, "wb")
+        self.file.write(self.header.format(0, 0).encode())
+        self.spool = tempfile.TemporaryFile()
+
+    def write_vertices(self, vertices):
+        self.file.write(vertices.astype("<f4").tobytes())
+
+    def write_faces(self, faces):
+        data = np.empty(len(faces), dtype=self.face_dtype)
+        data["count"] = 3
+        data["indices"] = faces
+        self.spool.write(data.tobytes())
+
+    def _finish(self):
+        self.spool.seek(0)
+        shutil.copyfileobj(self.spool, self.file)
+        self.spool.close()
+        # Same width as the placeholder, so the header doesn't move
+        self.file.seek(0)
+        self.file.write(self.header.format(self.vertices, self.faces).encode())
+        self.file.close()
+
+    def _discard(self):
+        self.spool.close()
+        self.file.close()
+
+
+class ObjWriter(MeshWriter):
+    """Wavefront OBJ, vertices and faces can be interleaved."""
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.file = open(self.temporary, "w")
+
+    def write_vertices(self, vertices):
+        np.savetxt(self.file, vertices, fmt="v %.9g %.9g %.9g")
+
+    def write_faces(self, faces):
+        np.savetxt(self.file, faces + 1, fmt="f %d %d %d")
+
+    def _finish(self):
+        self.file.close()
+
+    _discard = _finish
+
+
+class ThreeMfWriter(MeshWriter):
+    """3MF, a zip file with the model streamed into it."""
+
+    content_types = (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="model" ContentType="application/vnd.ms-package.3dmanufacturing-3dmodel+xml"/>'
+        "</Types>\n"
+    )
+    relationships = (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Target="/3D/3dmodel.model" Id="rel0" '
+        'Type="http://schemas.microsoft.com/3dmanufacturing/2013/01/3dmodel"/>'
+        "</Relationships>\n"
+    )
+    model_start = (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<model unit="millimeter" xml:lang="en-US" '
+        'xmlns="http://schemas.microsoft.com/3dmanufacturing/core/2015/02">\n'
+        '<resources>\n<object id="1" type="model">\n<mesh>\n<vertices>\n'
+    )
+    model_end = '</triangles>\n</mesh>\n</object>\n</resources>\n<build><item objectid="1"/></build>\n</model>\n'
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.zip = zipfile.ZipFile(self.temporary, "w", zipfile.ZIP_DEFLATED)
+        self.zip.writestr("[Content_Types].xml", self.content_types)
+        self.zip.writestr("_rels/.rels", self.relationships)
+        self.model = self.zip.open("3D/3dmodel.model", "w", force_zip64=True)
+        self.model.write(self.model_start.encode())
+        self.spool = tempfile.TemporaryFile()
+
+    def write_vertices(self, vertices):
+        np.savetxt(self.model, vertices, fmt='<vertex x="%.9g" y="%.9g" z="%.9g"/>')
+
+    def write_faces(self, faces):
+        np.savetxt(self.spool, faces, fmt='<triangle v1="%d" v2="%d" v3="%d"/>')
+
+    def _finish(self):
+        self.model.write(b"</vertices>\n<triangles>\n")
+        self.spool.seek(0)
+        shutil.copyfileobj(self.spool, self.model)
+        self.spool.close()
+        self.model.write(self.model_end.encode())
+        self.model.close()
+        self.zip.close()
+
+    def _discard(self):
+        self.spool.close()
+        self.model.close()
+        self.zip.close()
+
+
+#: Streaming writers by (lower case) file extension
+WRITERS = {
+    ".stl": StlWriter,
+    ".ply": PlyWriter,
+    ".obj": ObjWriter,
+    ".3mf": ThreeMfWriter,
+}
+
+
+def save(path, chunks):
+    """Write mesh chunks to path, in the format its extension asks for.
+
+    Formats we can't stream are handed to meshio, all in one go.
+    """
+    writer = WRITERS.get(Path(path).suffix.lower())
+    if writer is None:
+        import meshio  # type: ignore
+
+        from pysdfscad import mesher
+
+        vertices, faces = mesher.assemble(chunks)
+        meshio.Mesh(vertices, [("triangle", faces)]).write(path)
+        return
+    with writer(path) as out:
+        for vertices, faces, ids in chunks:
+            out.write(vertices, faces, ids)
@@ -0,0 +1,1766 @@
+"""
+Intermediate representation for geometry.
+
+The builtin openscad modules don't build `sdf` objects directly, they build
+a DAG of `Node`s (primitives, transforms, booleans, extrusions...). Nodes are
+hash-consed, building the same node twice gives you back the same object, so
+identical subtrees are automatically shared.
+
+Having the whole tree around before we turn it into `sdf` closures lets us
+run optimization passes over it (see `optimize`), and means we only build
+the parts of the tree that actually end up in the output.
+
+Every kind of node is described by an `Operation` subclass registered in
+`OPERATIONS`, which knows how to turn a node into an `sdf` object, how to
+simplify it, how big it is (see `Node.bounds`), and what range of distances
+it can have over a box (see `interval`).
+"""
+
+import functools
+import hashlib
+import itertools
+import math
+import threading
+import weakref
+
+import numpy as np
+import sdf  # type: ignore
+
+from pysdfscad import decimate as decimation, dual_contouring, export, mesher, parallel, resolution, volume
+from pysdfscad import kernel as fused
+
+
+_UNSET = object()
+
+
+def rotation_matrix(angle, axis):
+    """Matrix rotating by angle (in radians) around an axis."""
+    x, y, z = np.asarray(axis, dtype=float) / np.linalg.norm(axis)
+    s, c = np.sin(angle), np.cos(angle)
+    m = 1 - c
+    return np.array(
+        [
+            [m * x * x + c, m * x * y - z * s, m * z * x + y * s],
+            [m * x * y + z * s, m * y * y + c, m * y * z - x * s],
+            [m * z * x - y * s, m * y * z + x * s, m * z * z + c],
+        ]
+    )
+
+
+def box_distance(p, low, high):
+    """Signed distance from each point to a box.
+
+    Anything inside the box is never further out than the box itself, so
+    this is a lower bound on its signed distance, inside the box as well.
+    """
+    q = np.maximum(low - p, p - high)
+    return np.linalg.norm(np.maximum(q, 0), axis=1) + np.minimum(q.max(axis=1), 0)
+
+
+def box_sdf(q):
+    """Distance to a box in terms of `abs(p) - half_size`."""
+    return np.linalg.norm(np.maximum(q, 0), axis=1) + np.minimum(q.max(axis=1), 0)
+
+
+def abs_interval(low, high):
+    """Range of `abs(x)` for x in [low, high]."""
+    straddles = (low < 0) & (high > 0)
+    least = np.where(straddles, 0, np.minimum(np.abs(low), np.abs(high)))
+    return least, np.maximum(np.abs(low), np.abs(high))
+
+
+def rotate_boxes(low, high, matrix):
+    """Boxes around `(n, d)` boxes rotated by matrix, either way round."""
+    corners = np.array(list(itertools.product((0, 1), repeat=low.shape[1])))
+    points = np.where(corners, high[:, None, :], low[:, None, :])
+    points = np.concatenate([points @ matrix, points @ matrix.T], axis=1)
+    return points.min(axis=1), points.max(axis=1)
+
+
+def affine_boxes(low, high, matrix, offset):
+    """Boxes around `(n, d)` boxes mapped by `p @ matrix + offset`."""
+    corners = np.array(list(itertools.product((0, 1), repeat=low.shape[1])))
+    points = np.where(corners, high[:, None, :], low[:, None, :]) @ matrix + offset
+    return points.min(axis=1), points.max(axis=1)
+
+
+def compose(outer, inner):
+    """The `(matrix, offset, scale)` of two transforms applied in turn, see
+    `Operation.affine`.
+    """
+    (m1, b1, s1), (m2, b2, s2) = outer, inner
+    return m1 @ m2, b1 @ m2 + b2, s1 * s2
+
+
+def freeze(value):
+    """Convert parameters into something hashable with a stable repr."""
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return tuple(freeze(i) for i in value)
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+class Node:
+    """A hash-consed node in the geometry DAG."""
+
+    __slots__ = ("op", "params", "children", "_sdf", "_digest", "_bounds", "__weakref__")
+
+    _interned = weakref.WeakValueDictionary()
+    _lock = threading.Lock()
+
+    def __new__(cls, op, params=(), children=()):
+        params = freeze(params)
+        children = tuple(children)
+        key = (op, params, children)
+        with cls._lock:
+            node = cls._interned.get(key)
+            if node is None:
+                node = super().__new__(cls)
+                node.op = op
+                node.params = params
+                node.children = children
+                node._sdf = None
+                node._digest = None
+                node._bounds = _UNSET
+                cls._interned[key] = node
+        return node
+
+    def __reduce__(self):
+        return (Node, (self.op, self.params, self.children))
+
+    @property
+    def operation(self):
+        return OPERATIONS[self.op]
+
+    @property
+    def dimensions(self):
+        return self.operation.dimensions(self)
+
+    @property
+    def digest(self):
+        """Structural hash of this node and everything below it."""
+        if self._digest is None:
+            out = hashlib.sha256(repr((self.op, self.params)).encode())
+            for child in self.children:
+                out.update(child.digest.encode())
+            self._digest = out.hexdigest()
+        return self._digest
+
+    @property
+    def bounds(self):
+        """Conservative axis aligned bounding box as a `(low, high)` pair of
+        arrays, or None if we can't tell how big the geometry is.
+
+        Everything inside the geometry is inside the box, and so the
+        signed distance to the box is a lower bound on the geometry's.
+        """
+        if self._bounds is _UNSET:
+            children = [i.bounds for i in self.children]
+            if any(i is None for i in children):
+                bounds = self.operation.unbounded_children(self, children)
+            else:
+                bounds = self.operation.bounds(self, children)
+            if bounds is not None:
+                bounds = tuple(np.asarray(i, dtype=float) for i in bounds)
+            self._bounds = bounds
+        return self._bounds
+
+    def to_sdf(self):
+        """Build (and keep) the `sdf` object for this node."""
+        if self._sdf is None:
+            self._sdf = build(self)
+        return self._sdf
+
+    def generate(
+        self,
+        step=None,
+        bounds=None,
+        engine="sdf",
+        error=None,
+        triangles=None,
+        decimate=None,
+        indexed=False,
+        processes=None,
+        cache=None,
+        cancel=None,
+        **kwargs,
+    ):
+        """Mesh the node, using our own bounds by default rather than
+        letting `sdf` estimate them by sampling.
+
+        `engine` is "sdf" for `sdf`'s uniform grid mesher, "octree" for
+        `pysdfscad.mesher`, which only samples the grid near the surface,
+        "dual" for `pysdfscad.dual_contouring`, which keeps sharp edges and
+        corners even with a coarse grid, or "volume" for
+        `pysdfscad.volume`, which samples the whole grid and can mesh it
+        offset by a `level`, keeping the samples in a `volumes` cache (see
+        `cache.VolumeCache`) and growing the grid by a `margin` if asked.
+        Without a step, one is picked by `resolution.choose_step` from the
+        maximum feature `error`, `$fn`/`$fa`/`$fs` and a target number of
+        `triangles`. With `decimate`, triangles get merged back together
+        as long as that doesn't move the surface by more than that much.
+
+        Returns a triangle soup like `sdf`, or with `indexed` a
+        `(vertices, faces)` pair, which the sparse engines build directly.
+
+        With `processes`, the distance function is evaluated in a pool of
+        that many worker processes (0 for one per core), see
+        `pysdfscad.parallel`.
+
+        With a `cache.MeshCache`, meshes of the same geometry with the same
+        options are loaded from it rather than meshed again.
+
+        `cancel` is a `threading.Event`, once it's set meshing stops with
+        `Cancelled` before the next batch of points is evaluated.
+        """
+        step = resolution.choose_step(self, step, error, triangles, kwargs.get("samples"))
+        if bounds is None:
+            bounds = mesh_bounds(self, step, kwargs.get("samples"))
+        if cache is not None:
+            key = cache.key(self, step, bounds, engine, decimate=decimate, indexed=indexed, **kwargs)
+            mesh = cache.load(key)
+            if mesh is not None:
+                return mesh
+        indexed_mesh = indexed or decimate is not None
+        if engine in SPARSE_ENGINES:
+            generate = functools.partial(SPARSE_ENGINES[engine], indexed=indexed_mesh)
+            mesh = self._sparse(generate, step, bounds, processes=processes, cancel=cancel, **kwargs)
+        elif engine == "sdf":
+            if processes is not None:
+                # sdf's thread pool keeps the process pool busy
+                kwargs.setdefault("workers", parallel.pool(processes).processes)
+            mesh = sdf.mesh.generate(distance(self, processes, cancel), step=step, bounds=bounds, **kwargs)
+            if indexed_mesh:
+                mesh = mesher.weld(mesh)
+        elif engine == "volume":
+            mesh = self._volume(step, bounds, indexed=indexed_mesh, processes=processes, cancel=cancel, **kwargs)
+        else:
+            raise ValueError(f"Unknown meshing engine {engine!r}")
+        if decimate is not None:
+            if cancel is not None and cancel.is_set():
+                raise Cancelled()
+            mesh = decimation.decimate(mesh, decimate)
+            if not indexed:
+                vertices, faces = mesh
+                mesh = vertices[faces].reshape(-1, 3)
+        if cache is not None:
+            cache.store(key, mesh)
+        return mesh
+
+    def chunks(
+        self, step=None, bounds=None, engine="sdf", error=None, triangles=None, decimate=None, cache=None, **kwargs
+    ):
+        """Mesh the node a piece at a time, yielding the `(vertices, faces, ids)`
+        chunks `export.save` takes, see `mesher.generate_chunks`.
+
+        Only the octree engine meshes in pieces, the others (and decimation,
+        which needs the whole mesh) give a single chunk, as do meshes
+        loaded from the `cache`.
+        """
+        step = resolution.choose_step(self, step, error, triangles, kwargs.get("samples"))
+        if bounds is None:
+            bounds = mesh_bounds(self, step, kwargs.get("samples"))
+        if engine == "octree" and decimate is None:
+            if cache is None:
+                yield from self._sparse(mesher.generate_chunks, step, bounds, **kwargs)
+                return
+            # Same key as generate(indexed=True), both give the same mesh
+            key = cache.key(self, step, bounds, engine, decimate=decimate, indexed=True, **kwargs)
+            mesh = cache.load(key)
+            if mesh is None:
+                yield from cache.collect(key, self._sparse(mesher.generate_chunks, step, bounds, **kwargs))
+                return
+        else:
+            mesh = self.generate(step, bounds, engine, decimate=decimate, indexed=True, cache=cache, **kwargs)
+        vertices, faces = mesh
+        yield vertices, faces, np.arange(len(vertices))
+
+    def save(
+        self,
+        path,
+        step=None,
+        bounds=None,
+        engine="sdf",
+        error=None,
+        triangles=None,
+        decimate=None,
+        cache=None,
+        **kwargs,
+    ):
+        """Mesh the node into a file, streaming it out as it's meshed where
+        the engine and format allow. The format comes from the extension.
+        """
+        export.save(path, self.chunks(step, bounds, engine, error, triangles, decimate, cache, **kwargs))
+
+    def _grid(self, f, step, bounds, samples=None):
+        """Step and bounds, worked out like `sdf` does if we don't know them."""
+        if bounds is None:
+            bounds = sdf.mesh._estimate_bounds(f)
+        if step is None:
+            (x0, y0, z0), (x1, y1, z1) = bounds
+            size = (x1 - x0) * (y1 - y0) * (z1 - z0)
+            step = (size / (samples or sdf.mesh.SAMPLES)) ** (1 / 3)
+        return step, bounds
+
+    def _volume(
+        self,
+        step,
+        bounds,
+        indexed,
+        level=0.0,
+        margin=0.0,
+        volumes=None,
+        samples=None,
+        verbose=True,
+        processes=None,
+        cancel=None,
+    ):
+        # Only built if we need to sample, a cached volume doesn't
+        f = functools.lru_cache(None)(lambda: distance(self, processes, cancel))
+        step, bounds = self._grid(f() if bounds is None else None, step, bounds, samples)
+        low, high = bounds
+        axes = mesher.grid((np.subtract(low, margin), np.add(high, margin)), step)
+        shape = tuple(len(i) for i in axes)
+        sampled = None
+        if volumes is not None:
+            key = volumes.key(self, axes)
+            sampled = volumes.load(key, shape)
+            if sampled is None:
+                sampled = volumes.store(key, shape, lambda out: volume.sample(f(), axes, out))
+        if sampled is None:
+            sampled = volume.sample(f(), axes)
+        return volume.generate(sampled, axes, level, verbose=verbose, indexed=indexed)
+
+    def _sparse(self, engine, step, bounds, samples=None, verbose=True, processes=None, cancel=None, **kwargs):
+        f = distance(self, processes, cancel)
+        step, bounds = self._grid(f, step, bounds, samples)
+        return engine(
+            f,
+            step,
+            bounds,
+            verbose=verbose,
+            interval=lambda low, high: interval(self, low, high),
+            specialize=lambda low, high: [distance(i, processes, cancel) for i in specialize(self, low, high)],
+            **kwargs,
+        )
+
+    def walk(self):
+        """Every node in the DAG below (and including) this one, once."""
+        seen = set()
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node in seen:
+                continue
+            seen.add(node)
+            yield node
+            stack.extend(node.children)
+
+    def __repr__(self):
+        params = ", ".join(repr(i) for i in self.params)
+        if not self.children:
+            return f"{self.op}({params})"
+        children = ", ".join(repr(i) for i in self.children)
+        return f"{self.op}({params})[{children}]"
+
+
+OPERATIONS = {}
+
+
+def operation(name):
+    def register(cls):
+        cls.name = name
+        OPERATIONS[name] = cls()
+        return cls
+
+    return register
+
+
+class Operation:
+    """Describes how to build and simplify one kind of node."""
+
+    #: Dimensions of the result, None means the same as the first child
+    dims = None
+
+    def dimensions(self, node):
+        if self.dims is None:
+            return node.children[0].dimensions
+        return self.dims
+
+    def build(self, node, children):
+        raise NotImplementedError
+
+    def simplify(self, node):
+        """Return a cheaper node with the same result, or the node itself."""
+        return node
+
+    def bounds(self, node, children):
+        """Bounding box of the node given its children's, None if unknown."""
+        return None
+
+    def unbounded_children(self, node, children):
+        """Bounding box when some of the children's are None."""
+        return None
+
+    def child_boxes(self, node, low, high):
+        """The boxes each child needs to be evaluated over, for a batch of
+        `(n, dimensions)` boxes this node is evaluated over.
+        """
+        return [(low, high)] * len(node.children)
+
+    def interval(self, node, low, high, children):
+        """Lower and upper bounds on the distance over each box, given the
+        `(low, high)` bounds of each child over its `child_boxes`.
+
+        By default this relies on the distance function being Lipschitz,
+        nothing in a box is further from its center than half the diagonal.
+        """
+        center = (low + high) / 2
+        radius = np.linalg.norm(high - low, axis=1) / 2
+        d = self.evaluate(node, center)
+        return d - radius, d + radius
+
+    def relevant(self, node, low, high, children):
+        """Which children can change the result over each box, as a
+        `(len(children), n)` boolean array, or None for all of them.
+        """
+        return None
+
+    def pruned(self, node, children):
+        """node with the children `relevant` pruned away, which are None
+        in `children`.
+        """
+        return Node(node.op, node.params, [i for i in children if i is not None])
+
+    def changed(self, old, new):
+        """Boxes the surfaces of old and new, two nodes of this operation
+        with the same parameters, can differ in (see `changed`).
+
+        By default that's anywhere in either of them.
+        """
+        return _whole(old, new)
+
+    def affine(self, node):
+        """For transforms, the `(matrix, offset, scale)` such that the child
+        is evaluated at `p @ matrix + offset` and its distances multiplied
+        by scale. None for anything else.
+        """
+        return None
+
+    def emit(self, node, kernel, frame):
+        """Emit the code computing this node's distances into a register
+        of `kernel`, with the points in `frame`, see `pysdfscad.kernel`.
+
+        By default that's a call to the node's `sdf` closure.
+        """
+        return kernel.call(node.to_sdf(), node, frame)
+
+    @staticmethod
+    def evaluate(node, p):
+        if not len(p):
+            return np.empty(0)
+        return node.to_sdf()(p).reshape(-1)
+
+    @staticmethod
+    def api(node):
+        """The sdf.d2 or sdf.d3 module matching this node's dimensions."""
+        return sdf.d2 if node.dimensions == 2 else sdf.d3
+
+
+@operation("sphere")
+class Sphere(Operation):
+    dims = 3
+
+    def build(self, node, children):
+        (radius,) = node.params
+        return sdf.sphere(radius)
+
+    def bounds(self, node, children):
+        (radius,) = node.params
+        return np.full(3, -radius), np.full(3, radius)
+
+    def interval(self, node, low, high, children):
+        (radius,) = node.params
+        least, most = abs_interval(low, high)
+        return np.linalg.norm(least, axis=1) - radius, np.linalg.norm(most, axis=1) - radius
+
+    def emit(self, node, kernel, frame):
+        (radius,) = node.params
+        q, out = kernel.points(frame), kernel.register()
+        kernel.line(f"np.einsum('ij,ij->i', {q}, {q}, out={out})")
+        kernel.line(f"np.sqrt({out}, out={out})")
+        kernel.line(f"{out} -= {kernel.constant(radius)}")
+        return out
+
+
+@operation("box")
+class Box(Operation):
+    dims = 3
+
+    def build(self, node, children):
+        (size,) = node.params
+        return sdf.box(size)
+
+    def bounds(self, node, children):
+        (size,) = node.params
+        size = np.broadcast_to(np.abs(size), 3)
+        return -size / 2, size / 2
+
+    def interval(self, node, low, high, children):
+        # The distance to a box only grows with each of abs(p) - size / 2
+        (size,) = node.params
+        half = np.abs(size) / 2
+        least, most = abs_interval(low, high)
+        return box_sdf(least - half), box_sdf(most - half)
+
+    def emit(self, node, kernel, frame):
+        (size,) = node.params
+        half = np.broadcast_to(np.asarray(size, dtype=float) / 2, frame.dimensions).copy()
+        q = kernel.points(frame)
+        t, out, outside = kernel.register(frame.dimensions), kernel.register(), kernel.register()
+        kernel.line(f"np.abs({q}, out={t})")
+        kernel.line(f"{t} -= {kernel.constant(half)}")
+        kernel.line(f"np.max({t}, axis=1, out={out})")
+        kernel.line(f"np.minimum({out}, 0, out={out})")
+        kernel.line(f"np.maximum({t}, 0, out={t})")
+        kernel.line(f"np.einsum('ij,ij->i', {t}, {t}, out={outside})")
+        kernel.line(f"np.sqrt({outside}, out={outside})")
+        kernel.line(f"{out} += {outside}")
+        kernel.free(t, outside)
+        return out
+
+
+@operation("capped_cone")
+class CappedCone(Operation):
+    dims = 3
+
+    def build(self, node, children):
+        a, b, ra, rb = node.params
+        return sdf.capped_cone(np.array(a), np.array(b), ra, rb)
+
+    def bounds(self, node, children):
+        a, b, ra, rb = node.params
+        radius = max(abs(ra), abs(rb))
+        return np.minimum(a, b) - radius, np.maximum(a, b) + radius
+
+
+@operation("circle")
+class Circle(Operation):
+    dims = 2
+
+    def build(self, node, children):
+        (radius,) = node.params
+        return sdf.circle(radius)
+
+    def bounds(self, node, children):
+        (radius,) = node.params
+        return np.full(2, -radius), np.full(2, radius)
+
+    interval = Sphere.interval
+    emit = Sphere.emit
+
+
+@operation("rectangle")
+class Rectangle(Operation):
+    dims = 2
+
+    def build(self, node, children):
+        (size,) = node.params
+        return sdf.rectangle(size)
+
+    def bounds(self, node, children):
+        (size,) = node.params
+        size = np.broadcast_to(np.abs(size), 2)
+        return -size / 2, size / 2
+
+    interval = Box.interval
+    emit = Box.emit
+
+
+@operation("text")
+class Text(Operation):
+    dims = 2
+
+    def build(self, node, children):
+        font_file, text, width, height = node.params
+        return sdf.text(font_file, text, width=width, height=height)
+
+
+@operation("translate")
+class Translate(Operation):
+    def build(self, node, children):
+        (offset,) = node.params
+        return self.api(node).translate(children[0], offset[: node.dimensions])
+
+    def simplify(self, node):
+        (offset,) = node.params
+        child = node.children[0]
+        if not any(offset[: node.dimensions]):
+            return child
+        return collapse_transforms(node)
+
+    def bounds(self, node, children):
+        (offset,) = node.params
+        low, high = children[0]
+        offset = np.array(offset[: node.dimensions], dtype=float)
+        return low + offset, high + offset
+
+    def child_boxes(self, node, low, high):
+        (offset,) = node.params
+        offset = np.array(offset[: node.dimensions], dtype=float)
+        return [(low - offset, high - offset)]
+
+    def interval(self, node, low, high, children):
+        return children[0]
+
+    def emit(self, node, kernel, frame):
+        (offset,) = node.params
+        return kernel.emit(node.children[0], frame.translate(np.array(offset[: node.dimensions], dtype=float)))
+
+    def changed(self, old, new):
+        # Wherever the child changed, moved the way bounds are
+        boxes = changed(old.children[0], new.children[0])
+        if boxes is None:
+            return None
+        return [self.bounds(old, [box]) for box in boxes]
+
+    def affine(self, node):
+        (offset,) = node.params
+        dimensions = node.dimensions
+        return np.eye(dimensions), -np.array(offset[:dimensions], dtype=float), 1.0
+
+
+@operation("rotate")
+class Rotate(Operation):
+    """Rotation by an angle in radians, around an axis for 3D children."""
+
+    def build(self, node, children):
+        angle, axis = node.params
+        if node.dimensions == 2:
+            return sdf.d2.rotate(children[0], angle)
+        return sdf.d3.rotate(children[0], angle, np.array(axis))
+
+    def simplify(self, node):
+        angle, axis = node.params
+        if angle == 0:
+            return node.children[0]
+        return collapse_transforms(node)
+
+    def bounds(self, node, children):
+        angle, axis = node.params
+        low, high = children[0]
+        low, high = rotate_boxes(low[None], high[None], self.matrix(node))
+        return low[0], high[0]
+
+    def child_boxes(self, node, low, high):
+        return [rotate_boxes(low, high, self.matrix(node))]
+
+    def interval(self, node, low, high, children):
+        return children[0]
+
+    def emit(self, node, kernel, frame):
+        matrix, _, _ = self.affine(node)
+        return kernel.emit(node.children[0], frame.transform(matrix))
+
+    changed = Translate.changed
+
+    def affine(self, node):
+        # Children see `p @ matrix` in sdf, in 2D the matrix is transposed
+        matrix = self.matrix(node)
+        if node.dimensions == 2:
+            matrix = matrix.T
+        return matrix, np.zeros(node.dimensions), 1.0
+
+    @staticmethod
+    def matrix(node):
+        # sdf's 2D and 3D rotations turn opposite ways, callers cover both
+        angle, axis = node.params
+        if node.dimensions == 2:
+            return rotation_matrix(angle, (0, 0, 1))[:2, :2]
+        return rotation_matrix(angle, axis)
+
+
+@operation("transform")
+class Transform(Operation):
+    """Any affine transform, the child is evaluated at `p @ matrix + offset`
+    and its distances are multiplied by scale.
+
+    This is what chains of translations, rotations, scales and mirrors get
+    collapsed into (see `collapse_transforms`), so however deep the chain
+    is the points only get transformed once. Scale is what keeps the
+    distances a lower bound, `1 / largest singular value` of the matrix
+    for a single transform, like `sdf.scale`.
+    """
+
+    def build(self, node, children):
+        matrix, offset, scale = self.affine(node)
+        child = children[0]
+
+        def f(p):
+            d = child(p @ matrix + offset)
+            return d * scale if scale != 1 else d
+
+        wrapper = sdf.SDF2 if node.dimensions == 2 else sdf.SDF3
+        return wrapper(f)
+
+    def simplify(self, node):
+        matrix, offset, scale = self.affine(node)
+        child = node.children[0]
+        if np.array_equal(matrix, np.eye(len(matrix))) and scale == 1:
+            return translate(child, tuple(-offset)) if offset.any() else child
+        return collapse_transforms(node)
+
+    def bounds(self, node, children):
+        matrix, offset, _ = self.affine(node)
+        low, high = children[0]
+        inverse = np.linalg.inv(matrix)
+        low, high = affine_boxes(low[None], high[None], inverse, -offset @ inverse)
+        return low[0], high[0]
+
+    def child_boxes(self, node, low, high):
+        matrix, offset, _ = self.affine(node)
+        return [affine_boxes(low, high, matrix, offset)]
+
+    def interval(self, node, low, high, children):
+        _, _, scale = self.affine(node)
+        low, high = children[0]
+        return low * scale, high * scale
+
+    changed = Translate.changed
+
+    def emit(self, node, kernel, frame):
+        matrix, offset, scale = self.affine(node)
+        out = kernel.emit(node.children[0], frame.transform(matrix).translate(-offset))
+        if scale != 1:
+            kernel.line(f"{out} *= {kernel.constant(scale)}")
+        return out
+
+    def affine(self, node):
+        matrix, offset, scale = node.params
+        return np.array(matrix, dtype=float), np.array(offset, dtype=float), scale
+
+
+def collapse_transforms(node):
+    """Merge a transform with a transform directly below it into a single
+    `transform` node, or return node as it is.
+    """
+    child = node.children[0]
+    inner = child.operation.affine(child)
+    if inner is None or child.dimensions != node.dimensions:
+        return node
+    matrix, offset, scale = compose(node.operation.affine(node), inner)
+    return transform(child.children[0], matrix, offset, scale)
+
+
+@operation("extrude")
+class Extrude(Operation):
+    dims = 3
+
+    def build(self, node, children):
+        (height,) = node.params
+        return sdf.d2.extrude(children[0], height)
+
+    def bounds(self, node, children):
+        (height,) = node.params
+        low, high = children[0]
+        height = abs(height) / 2
+        return np.append(low, -height), np.append(high, height)
+
+    def child_boxes(self, node, low, high):
+        return [(low[:, :2], high[:, :2])]
+
+    def interval(self, node, low, high, children):
+        # Same as the box, the distance only grows with each of the 2D
+        # distance and abs(z) - height / 2
+        (height,) = node.params
+        (d_low, d_high), = children
+        z_low, z_high = abs_interval(low[:, 2], high[:, 2])
+        least = np.stack([d_low, z_low - height / 2], axis=1)
+        most = np.stack([d_high, z_high - height / 2], axis=1)
+        return box_sdf(least), box_sdf(most)
+
+    def emit(self, node, kernel, frame):
+        # Like a box, with the 2D distance and abs(z) - height / 2
+        (height,) = node.params
+        out = kernel.emit(node.children[0], frame.project(2))
+        q = kernel.points(frame)
+        z, inside = kernel.register(), kernel.register()
+        kernel.line(f"np.abs({q}[:, 2], out={z})")
+        kernel.line(f"{z} -= {kernel.constant(height / 2)}")
+        kernel.line(f"np.maximum({out}, {z}, out={inside})")
+        kernel.line(f"np.minimum({inside}, 0, out={inside})")
+        kernel.line(f"np.maximum({out}, 0, out={out})")
+        kernel.line(f"np.maximum({z}, 0, out={z})")
+        kernel.line(f"np.hypot({out}, {z}, out={out})")
+        kernel.line(f"{out} += {inside}")
+        kernel.free(z, inside)
+        return out
+
+    changed = Translate.changed
+
+
+@operation("shell")
+class Shell(Operation):
+    def build(self, node, children):
+        (thickness,) = node.params
+        return self.api(node).shell(children[0], thickness)
+
+    def bounds(self, node, children):
+        (thickness,) = node.params
+        low, high = children[0]
+        return low - abs(thickness) / 2, high + abs(thickness) / 2
+
+    def interval(self, node, low, high, children):
+        (thickness,) = node.params
+        least, most = abs_interval(*children[0])
+        return least - thickness / 2, most - thickness / 2
+
+    def emit(self, node, kernel, frame):
+        (thickness,) = node.params
+        out = kernel.emit(node.children[0], frame)
+        kernel.line(f"np.abs({out}, out={out})")
+        kernel.line(f"{out} -= {kernel.constant(thickness / 2)}")
+        return out
+
+    changed = Translate.changed
+
+
+def smooth_min(a, b, k):
+    """Polynomial smooth minimum, the same blend `sdf.union` uses."""
+    h = np.clip(0.5 + 0.5 * (b - a) / k, 0, 1)
+    return b + (a - b) * h - k * h * (1 - h)
+
+
+def smooth_max(a, b, k):
+    return -smooth_min(-a, -b, k)
+
+
+def emit_smooth_min(kernel, a, b, k):
+    """Emit `smooth_min(a, b, k)` into register a, freeing b."""
+    h = kernel.register()
+    k = kernel.constant(k)
+    kernel.line(f"np.subtract({b}, {a}, out={h})")
+    kernel.line(f"{h} *= 0.5 / {k}")
+    kernel.line(f"{h} += 0.5")
+    kernel.line(f"np.clip({h}, 0, 1, out={h})")
+    kernel.line(f"{a} -= {b}")
+    kernel.line(f"{a} *= {h}")
+    kernel.line(f"{a} += {b}")
+    kernel.line(f"np.subtract(1, {h}, out={b})")
+    kernel.line(f"{b} *= {h}")
+    kernel.line(f"{b} *= {k}")
+    kernel.line(f"{a} -= {b}")
+    kernel.free(b, h)
+    return a
+
+
+def emit_smooth_max(kernel, a, b, k):
+    for i in (a, b):
+        kernel.line(f"np.negative({i}, out={i})")
+    emit_smooth_min(kernel, a, b, k)
+    kernel.line(f"np.negative({a}, out={a})")
+    return a
+
+
+def _smooth_relevant(lows, highs, k, keep):
+    """Mark the children of a smooth union that can't change it in keep,
+    returning bounds on the union's distance.
+
+    This follows the grouping of `_balanced`. `smooth_min(a, b, k)` is
+    exactly a wherever b is at least k above it, so a half of the tree can
+    go wherever its lower bound is that far above the other's upper bound.
+    """
+    if len(lows) == 1:
+        return lows[0], highs[0]
+    middle = len(lows) // 2
+    left_low, left_high = _smooth_relevant(lows[:middle], highs[:middle], k, keep[:middle])
+    right_low, right_high = _smooth_relevant(lows[middle:], highs[middle:], k, keep[middle:])
+    left = left_low >= right_high + k
+    right = right_low >= left_high + k
+    keep[:middle, left] = False
+    keep[middle:, right] = False
+    low = np.where(left, right_low, np.where(right, left_low, np.minimum(left_low, right_low) - k / 4))
+    return low, np.minimum(left_high, right_high)
+
+
+def _balanced(combine, fs, p, k):
+    """Combine the results of every f in fs pairwise, as a balanced tree.
+
+    Smooth booleans aren't associative, so any grouping is as valid as a
+    left fold, and this one keeps the depth at log2(len(fs)).
+    """
+    if len(fs) == 1:
+        return fs[0](p)
+    middle = len(fs) // 2
+    return combine(_balanced(combine, fs[:middle], p, k), _balanced(combine, fs[middle:], p, k), k)
+
+
+@operation("detail")
+class Detail(Operation):
+    """Doesn't change the geometry, records how far the mesh of the subtree
+    may stray from the surface (see `pysdfscad.resolution`).
+    """
+
+    def build(self, node, children):
+        return children[0]
+
+    def bounds(self, node, children):
+        return children[0]
+
+    def interval(self, node, low, high, children):
+        return children[0]
+
+    def emit(self, node, kernel, frame):
+        return kernel.emit(node.children[0], frame)
+
+    changed = Translate.changed
+
+    def simplify(self, node):
+        (size,) = node.params
+        child = node.children[0]
+        if child.op == "detail":
+            return Node("detail", (min(size, child.params[0]),), child.children)
+        return node
+
+
+class BVH:
+    """Bounding volume hierarchy over sdf functions with known bounds.
+
+    Evaluating it gives the same result as taking the minimum over every
+    function, except that a point only evaluates a function if the distance
+    to its box is less than the closest distance found so far. Boxes are
+    conservative, so the distance to a function's box is a lower bound on
+    its distance, and that's what stands in for the functions we skip.
+    """
+
+    __slots__ = ("low", "high", "f", "children")
+
+    def __init__(self, items):
+        """Build a hierarchy from a list of `((low, high), f)` pairs."""
+        self.low = np.min([low for (low, _), _ in items], axis=0)
+        self.high = np.max([high for (_, high), _ in items], axis=0)
+        self.f = None
+        self.children = ()
+        if len(items) == 1:
+            self.f = items[0][1]
+            return
+        # Split along the longest axis, at the median of the box centers
+        axis = np.argmax(self.high - self.low)
+        items = sorted(items, key=lambda i: i[0][0][axis] + i[0][1][axis])
+        middle = len(items) // 2
+        self.children = (BVH(items[:middle]), BVH(items[middle:]))
+
+    def __call__(self, p, best=None):
+        """Minimum over every function at the points `p`, or over every
+        function and `best`, which gets updated in place.
+        """
+        if best is None:
+            best = np.full(len(p), np.inf)
+        shape = None
+        stack = [(self, np.arange(len(p)))]
+        while stack:
+            node, index = stack.pop()
+            points = p if len(index) == len(p) else p[index]
+            near = box_distance(points, node.low, node.high) < best[index]
+            if not near.all():
+                index = index[near]
+                if not len(index):
+                    continue
+                points = p[index]
+            if node.f is not None:
+                d = node.f(points)
+                shape = d.shape[1:]
+                best[index] = np.minimum(best[index], d.reshape(-1))
+                continue
+            # Visit the closest box first, so we find tight upper bounds
+            # early and can cull more of the rest
+            center = points.mean(axis=0)
+            first, second = sorted(
+                node.children,
+                key=lambda i: box_distance(center[None], i.low, i.high)[0],
+            )
+            stack.append((second, index))
+            stack.append((first, index))
+        if shape is None:
+            return best
+        return best.reshape((len(p), *shape))
+
+
+class SmoothBVH:
+    """Smooth union of sdf functions, combined in the same balanced tree as
+    `_balanced`, that skips a subtree wherever it can't change the result.
+
+    `smooth_min(a, b, k)` is just a once b is k or more above it. A
+    subtree's distance is at least the distance to its box, less however
+    much smoothing inside it can take off, so once one half of a pair has
+    been evaluated, the other half only needs evaluating where that bound
+    is within k of it. The result is the same as without culling.
+    """
+
+    __slots__ = ("low", "high", "error", "f", "children", "k")
+
+    def __init__(self, items, k):
+        """Build the tree from a list of `((low, high), f)` pairs, in the
+        order they're combined in. Bounds can be None, for no bounds.
+        """
+        self.k = k
+        self.f = None
+        self.children = ()
+        self.error = 0
+        if len(items) == 1:
+            bounds, self.f = items[0]
+            self.low, self.high = (-np.inf, np.inf) if bounds is None else bounds
+            return
+        middle = len(items) // 2
+        self.children = (SmoothBVH(items[:middle], k), SmoothBVH(items[middle:], k))
+        self.low = np.minimum(self.children[0].low, self.children[1].low)
+        self.high = np.maximum(self.children[0].high, self.children[1].high)
+        self.error = abs(k) / 4 * math.ceil(math.log2(len(items)))
+
+    def lower(self, p):
+        """Lower bound on the distance at points p."""
+        return box_distance(p, self.low, self.high) - self.error
+
+    def __call__(self, p):
+        """The smooth union at the points `p`, as an `(n,)` array."""
+        if self.f is not None:
+            return np.asarray(self.f(p)).reshape(-1)
+        if not len(p):
+            return np.empty(0)
+        # Each point starts with the half that's closest to it, for the
+        # lowest distances to cull with, smooth_min is symmetric so which
+        # goes first doesn't change the result
+        first, second = self.children
+        closer = first.lower(p) <= second.lower(p)
+        out = np.empty(len(p))
+        for mask, a, b in ((closer, first, second), (~closer, second, first)):
+            if mask.any():
+                out[mask] = self.pair(a, b, p[mask])
+        return out
+
+    def pair(self, first, second, p):
+        """Combine first and second, only evaluating second where it's
+        close enough to first to make a difference.
+        """
+        a = first(p)
+        near = second.lower(p) < a + abs(self.k)
+        if not near.any():
+            return a
+        out = a.copy()
+        out[near] = smooth_min(a[near], second(p[near]), self.k)
+        return out
+
+
+class Boolean(Operation):
+    """Booleans take a smoothing factor `k`, None for a sharp edge.
+
+    Sharp unions and intersections are associative and commutative, which
+    lets us flatten nested ones and put children in a canonical order so
+    more subtrees hash-cons together. Smooth ones depend on the order
+    children get combined in, so we leave those alone.
+
+    They're n-ary, all the children of a sharp boolean are evaluated in one
+    flat loop that folds them into a single buffer, instead of `sdf`'s chain
+    of nested two child closures.
+    """
+
+    #: Children after this index are interchangeable
+    commutative_from = 0
+    #: Interchangeable children that are this (sharp) operation get merged
+    flattens = None
+    #: ufunc combining sharp distances, and the smooth version of it
+    combine = None
+    smooth = None
+
+    def build(self, node, children):
+        (k,) = node.params
+        if len(children) == 1:
+            return children[0]
+        wrapper = sdf.SDF2 if node.dimensions == 2 else sdf.SDF3
+        if k is None:
+            return wrapper(self.sharp(children))
+        return wrapper(self.balanced(children, k))
+
+    def sharp(self, children):
+        combine = self.combine
+        first, rest = children[0], children[1:]
+
+        def f(p):
+            # Children might hand back an array they're caching, so the
+            # first combine allocates the buffer we accumulate into
+            out = combine(first(p), rest[0](p))
+            for child in rest[1:]:
+                combine(out, child(p), out=out)
+            return out
+
+        return f
+
+    def balanced(self, children, k):
+        smooth = self.smooth
+        return lambda p: _balanced(smooth, children, p, k)
+
+    #: ufunc name `combine` is emitted as, and `emit_smooth_min`/`max`
+    emit_combine = None
+    emit_smooth = None
+
+    def emit(self, node, kernel, frame):
+        (k,) = node.params
+        if len(node.children) == 1:
+            return kernel.emit(node.children[0], frame)
+        if k is None:
+            return self.emit_sharp(node.children, kernel, frame)
+        return self.emit_balanced([(i, False) for i in node.children], kernel, frame, k)
+
+    def emit_sharp(self, children, kernel, frame, out=None):
+        """Fold children into one register, or into `out` if given."""
+        for child in children:
+            d = kernel.emit(child, frame)
+            if out is None:
+                out = d
+                continue
+            kernel.line(f"np.{self.emit_combine}({out}, {d}, out={out})")
+            kernel.free(d)
+        return out
+
+    def emit_balanced(self, children, kernel, frame, k):
+        """Smooth combination of `(child, negated)` pairs, grouped the same
+        way as `_balanced`.
+        """
+        if len(children) == 1:
+            child, negated = children[0]
+            out = kernel.emit(child, frame)
+            if negated:
+                kernel.line(f"np.negative({out}, out={out})")
+            return out
+        middle = len(children) // 2
+        a = self.emit_balanced(children[:middle], kernel, frame, k)
+        b = self.emit_balanced(children[middle:], kernel, frame, k)
+        return self.emit_smooth(kernel, a, b, k)
+
+    def changed(self, old, new):
+        (k,) = old.params
+        start = self.commutative_from
+        if k is None and len(old.children) > start and len(new.children) > start:
+            # Sharp children are in a canonical order, but only the ones
+            # that changed line up by position
+            head = list(zip(old.children[:start], new.children[:start]))
+            new_tail, old_tail = set(new.children[start:]), set(old.children[start:])
+            removed = [i for i in old.children[start:] if i not in new_tail]
+            added = [i for i in new.children[start:] if i not in old_tail]
+        elif len(old.children) == len(new.children):
+            head, removed, added = list(zip(old.children, new.children)), [], []
+        else:
+            return _whole(old, new)
+        if len(removed) == len(added) == 1:
+            head.append((removed[0], added[0]))
+            removed = added = []
+        boxes = []
+        for a, b in head:
+            child_boxes = changed(a, b)
+            if child_boxes is None:
+                return None
+            boxes.extend(child_boxes)
+        for child in removed + added:
+            if child.bounds is None:
+                return None
+            boxes.append(child.bounds)
+        # Smoothing spreads a change out by up to k
+        pad = abs(k or 0)
+        return [(low - pad, high + pad) for low, high in boxes]
+
+    @staticmethod
+    def smoothing_error(node):
+        """How far smoothing can move the result past the sharp one, each
+        smooth min/max in the balanced tree is off by at most k/4.
+        """
+        (k,) = node.params
+        if k is None or len(node.children) < 2:
+            return 0
+        return abs(k) / 4 * math.ceil(math.log2(len(node.children)))
+
+    def simplify(self, node):
+        (k,) = node.params
+        children = node.children
+        if len(children) == 1:
+            return children[0]
+        if k is not None:
+            return node
+
+        start = self.commutative_from
+        head, tail = children[:start], children[start:]
+        flat = []
+        for child in tail:
+            if child.op == self.flattens and child.params == node.params:
+                flat.extend(child.children)
+            else:
+                flat.append(child)
+        # Duplicates can't change the result of a sharp min/max
+        unique = sorted(set(flat), key=lambda i: i.digest)
+        children = (*head, *unique)
+        if len(children) == 1:
+            return children[0]
+        if children != node.children:
+            return Node(node.op, node.params, children)
+        return node
+
+
+@operation("union")
+class Union(Boolean):
+    flattens = "union"
+    combine = np.minimum
+    smooth = staticmethod(smooth_min)
+    emit_combine = "minimum"
+    emit_smooth = staticmethod(emit_smooth_min)
+
+    #: Unions with at least this many bounded children use a `BVH`, or a
+    #: `SmoothBVH` if they're smooth
+    bvh_threshold = 8
+
+    def build(self, node, children):
+        (k,) = node.params
+        bounded = [
+            (child.bounds, f)
+            for child, f in zip(node.children, children)
+            if child.bounds is not None
+        ]
+        if len(bounded) < self.bvh_threshold or (k is not None and k <= 0):
+            return super().build(node, children)
+        wrapper = sdf.SDF2 if node.dimensions == 2 else sdf.SDF3
+        if k is not None:
+            tree = SmoothBVH([(child.bounds, f) for child, f in zip(node.children, children)], k)
+            return wrapper(lambda p: tree(p).reshape(-1, 1))
+
+        bvh = BVH(bounded)
+        rest = [f for child, f in zip(node.children, children) if child.bounds is None]
+
+        def f(p):
+            if not rest:
+                return bvh(p)
+            # Everything without bounds gets evaluated everywhere, which
+            # gives the hierarchy a head start on culling
+            d = self.sharp(rest)(p) if len(rest) > 1 else rest[0](p)
+            return bvh(p, d.reshape(-1).copy()).reshape(d.shape)
+
+        return wrapper(f)
+
+    def emit(self, node, kernel, frame):
+        (k,) = node.params
+        bounded = [child for child in node.children if child.bounds is not None]
+        if len(bounded) < self.bvh_threshold or (k is not None and k <= 0):
+            return super().emit(node, kernel, frame)
+        if k is not None:
+            tree = SmoothBVH([(child.bounds, fused.fuse(child)) for child in node.children], k)
+            out = kernel.register()
+            kernel.line(f"{out}[:] = {kernel.constant(tree, 'bvh')}({kernel.points(frame)})")
+            return out
+        # Culling beats evaluating everything, so the hierarchy stays, over
+        # a fused kernel for each child
+        bvh = BVH([(child.bounds, fused.fuse(child)) for child in bounded])
+        rest = [child for child in node.children if child.bounds is None]
+        out = self.emit_sharp(rest, kernel, frame)
+        if out is None:
+            out = kernel.register()
+            kernel.line(f"{out}.fill(np.inf)")
+        kernel.line(f"{kernel.constant(bvh, 'bvh')}({kernel.points(frame)}, {out})")
+        return out
+
+    def bounds(self, node, children):
+        (k,) = node.params
+        # Smoothing only ever adds material, less than k of it for a pair,
+        # but it adds up down the balanced tree of an n-ary union
+        pad = max(abs(k or 0), self.smoothing_error(node))
+        low = np.min([low for low, _ in children], axis=0)
+        high = np.max([high for _, high in children], axis=0)
+        return low - pad, high + pad
+
+    def interval(self, node, low, high, children):
+        lows, highs = np.array(children).transpose(1, 0, 2)
+        return lows.min(axis=0) - self.smoothing_error(node), highs.min(axis=0)
+
+    def relevant(self, node, low, high, children):
+        (k,) = node.params
+        lows, highs = np.array(children).transpose(1, 0, 2)
+        if k is None:
+            # A child that's never below the smallest upper bound is never
+            # the minimum
+            return lows <= highs.min(axis=0)
+        if k <= 0:
+            return None
+        keep = np.ones(lows.shape, dtype=bool)
+        _smooth_relevant(lows, highs, k, keep)
+        return keep
+
+    def pruned(self, node, children):
+        (k,) = node.params
+        if k is None:
+            return super().pruned(node, children)
+
+        # Regrouping smooth unions changes them, so what's left keeps the
+        # grouping of `_balanced`, as nested unions
+        def group(children):
+            if len(children) == 1:
+                return children[0]
+            if None not in children:
+                return Node(node.op, node.params, children)
+            middle = len(children) // 2
+            left, right = children[:middle], children[middle:]
+            if all(i is None for i in right):
+                return group(left)
+            if all(i is None for i in left):
+                return group(right)
+            return Node(node.op, node.params, [group(left), group(right)])
+
+        return group(list(children))
+
+
+@operation("intersection")
+class Intersection(Boolean):
+    flattens = "intersection"
+    combine = np.maximum
+    smooth = staticmethod(smooth_max)
+    emit_combine = "maximum"
+    emit_smooth = staticmethod(emit_smooth_max)
+
+    def bounds(self, node, children):
+        low = np.max([low for low, _ in children], axis=0)
+        high = np.min([high for _, high in children], axis=0)
+        return low, np.maximum(low, high)
+
+    def interval(self, node, low, high, children):
+        lows, highs = np.array(children).transpose(1, 0, 2)
+        return lows.max(axis=0), highs.max(axis=0) + self.smoothing_error(node)
+
+    def relevant(self, node, low, high, children):
+        (k,) = node.params
+        if k is not None:
+            return None
+        lows, highs = np.array(children).transpose(1, 0, 2)
+        return highs >= lows.max(axis=0)
+
+    def unbounded_children(self, node, children):
+        children = [i for i in children if i is not None]
+        if not children:
+            return None
+        return self.bounds(node, children)
+
+
+@operation("difference")
+class Difference(Boolean):
+    # a - (b | c) is a - b - c
+    commutative_from = 1
+    flattens = "union"
+    smooth = staticmethod(smooth_max)
+    emit_combine = "maximum"
+    emit_smooth = staticmethod(emit_smooth_max)
+
+    def sharp(self, children):
+        first, rest = children[0], children[1:]
+
+        # max(a, -b, -c...) is max(a, -min(b, c...))
+        cut = OPERATIONS["union"].sharp(rest) if len(rest) > 1 else rest[0]
+
+        def f(p):
+            d = -cut(p)
+            return np.maximum(first(p), d, out=d)
+
+        return f
+
+    def bounds(self, node, children):
+        return children[0]
+
+    def unbounded_children(self, node, children):
+        return children[0]
+
+    def interval(self, node, low, high, children):
+        # max(a, -b, -c...)
+        lows, highs = np.array(children).transpose(1, 0, 2)
+        lows, highs = np.concatenate([lows[:1], -highs[1:]]), np.concatenate([highs[:1], -lows[1:]])
+        return lows.max(axis=0), highs.max(axis=0) + self.smoothing_error(node)
+
+    def relevant(self, node, low, high, children):
+        (k,) = node.params
+        if k is not None:
+            return None
+        # Cutting away something that's always outside of a changes nothing
+        lows, highs = np.array(children).transpose(1, 0, 2)
+        keep = -lows > lows[0]
+        keep[0] = True
+        return keep
+
+    def balanced(self, children, k):
+        first, rest = children[0], children[1:]
+        negated = [lambda p, child=child: -child(p) for child in rest]
+        return lambda p: _balanced(smooth_max, [first, *negated], p, k)
+
+    def emit(self, node, kernel, frame):
+        (k,) = node.params
+        first, rest = node.children[0], node.children[1:]
+        if k is not None:
+            return self.emit_balanced([(first, False), *[(i, True) for i in rest]], kernel, frame, k)
+        out = kernel.emit(first, frame)
+        for child in rest:
+            d = kernel.emit(child, frame)
+            kernel.line(f"np.negative({d}, out={d})")
+            kernel.line(f"np.maximum({out}, {d}, out={out})")
+            kernel.free(d)
+        return out
+
+    def simplify(self, node):
+        (k,) = node.params
+        first = node.children[0]
+        if k is None and first.op == "difference" and first.params == node.params:
+            # (a - b) - c is a - b - c
+            node = Node(node.op, node.params, (*first.children, *node.children[1:]))
+        return super().simplify(node)
+
+
+@operation("blend")
+class Blend(Operation):
+    def build(self, node, children):
+        (k,) = node.params
+        return self.api(node).blend(*children, k=k)
+
+    def bounds(self, node, children):
+        (a_low, a_high), (b_low, b_high) = children
+        return np.minimum(a_low, b_low), np.maximum(a_high, b_high)
+
+    def interval(self, node, low, high, children):
+        # k * b + (1 - k) * a
+        (k,) = node.params
+        (a_low, a_high), (b_low, b_high) = children
+        a = (1 - k) * a_low, (1 - k) * a_high
+        b = k * b_low, k * b_high
+        return np.minimum(*a) + np.minimum(*b), np.maximum(*a) + np.maximum(*b)
+
+
+def sphere(radius):
+    return Node("sphere", (radius,))
+
+
+def box(size):
+    return Node("box", (size,))
+
+
+def capped_cone(a, b, ra, rb):
+    return Node("capped_cone", (a, b, ra, rb))
+
+
+def circle(radius):
+    return Node("circle", (radius,))
+
+
+def rectangle(size):
+    return Node("rectangle", (size,))
+
+
+def text(font_file, text, width=None, height=None):
+    return Node("text", (font_file, text, width, height))
+
+
+def translate(child, offset):
+    return Node("translate", (offset,), (child,))
+
+
+def rotate(child, angle, axis=(0, 0, 1)):
+    return Node("rotate", (angle, axis), (child,))
+
+
+def transform(child, matrix, offset=None, scale=1.0):
+    """Evaluate child at `p @ matrix + offset`, see `Transform`."""
+    matrix = np.asarray(matrix, dtype=float)
+    if offset is None:
+        offset = np.zeros(len(matrix))
+    return Node("transform", (matrix, offset, float(scale)), (child,))
+
+
+def scale(child, factor):
+    """Scale child up by a factor per axis, or the same along all of them."""
+    factor = np.broadcast_to(np.asarray(factor, dtype=float), child.dimensions)
+    if not np.all(factor):
+        raise ValueError(f"Can't scale by {tuple(factor)}, it would flatten the geometry")
+    return transform(child, np.diag(1 / factor), scale=np.abs(factor).min())
+
+
+def mirror(child, normal):
+    """Mirror child in the plane through the origin with that normal."""
+    normal = np.asarray(normal, dtype=float)[: child.dimensions]
+    length = np.linalg.norm(normal)
+    if not length:
+        return child
+    normal = normal / length
+    return transform(child, np.eye(child.dimensions) - 2 * np.outer(normal, normal))
+
+
+def extrude(child, height):
+    return Node("extrude", (height,), (child,))
+
+
+def shell(child, thickness):
+    return Node("shell", (thickness,), (child,))
+
+
+def detail(child, error):
+    return Node("detail", (error,), (child,))
+
+
+def _smoothing(k):
+    # sdf treats a zero smoothing factor as a sharp edge too
+    return k or None
+
+
+def union(children, k=None):
+    return Node("union", (_smoothing(k),), children)
+
+
+def intersection(children, k=None):
+    return Node("intersection", (_smoothing(k),), children)
+
+
+def difference(children, k=None):
+    return Node("difference", (_smoothing(k),), children)
+
+
+def blend(a, b, k=0.5):
+    return Node("blend", (k,), (a, b))
+
+
+#: Grid cells of padding around the geometry when meshing
+MESH_PADDING = 2
+
+#: Meshers that only sample near the surface, by `Node.generate` engine name
+SPARSE_ENGINES = {
+    "octree": mesher.generate,
+    "dual": dual_contouring.generate,
+}
+
+
+def mesh_bounds(node, step=None, samples=None):
+    """The bounds to mesh a 3D node in, as `((x0, y0, z0), (x1, y1, z1))`.
+
+    That's the node's bounding box padded by a couple of grid cells, so the
+    surface never touches the edge of the grid. Without a step we work it
+    out the same way `sdf` does, from the number of samples. Returns None
+    if the node isn't 3D or has no bounds.
+    """
+    if node.dimensions != 3 or node.bounds is None:
+        return None
+    low, high = node.bounds
+    if step is None:
+        samples = samples or sdf.mesh.SAMPLES
+        size = np.maximum(high - low, 1e-9)
+        step = (np.prod(size) / samples) ** (1 / 3)
+    pad = np.asarray(step, dtype=float) * MESH_PADDING
+    return tuple(low - pad), tuple(high + pad)
+
+
+def distance(node, processes=None, cancel=None):
+    """The distance function of node, as a fused kernel (see
+    `pysdfscad.kernel`), or evaluated in a pool of worker processes if
+    `processes` isn't None.
+
+    With a `cancel` event, every call checks it first, see `Cancellable`.
+    """
+    if processes is None:
+        f = fused.fuse(node)
+    else:
+        f = parallel.pool(processes).function(node)
+    return f if cancel is None else Cancellable(f, cancel)
+
+
+class Cancelled(Exception):
+    """Meshing was stopped because its `cancel` event was set."""
+
+
+class Cancellable:
+    """A distance function that raises `Cancelled` once cancel is set.
+
+    Meshers evaluate in batches, so that's a check between every batch,
+    whichever mesher it is. Equal for the same function and event, so
+    meshers can still group blocks by it.
+    """
+
+    __slots__ = ("f", "cancel")
+
+    def __init__(self, f, cancel):
+        self.f = f
+        self.cancel = cancel
+
+    def __call__(self, points):
+        if self.cancel.is_set():
+            raise Cancelled()
+        return self.f(points)
+
+    def __eq__(self, other):
+        return isinstance(other, Cancellable) and (self.f, self.cancel) == (other.f, other.cancel)
+
+    def __hash__(self):
+        return hash((self.f, id(self.cancel)))
+
+
+def changed(old, new):
+    """Boxes outside which old and new have the same surface, a list of
+    `(low, high)` pairs, or None if it could have changed anywhere.
+
+    Subtrees with the same structural hash are skipped, and otherwise each
+    operation says where a change in its children shows (see
+    `Operation.changed`). Near a box the distances can still differ a
+    little, whoever meshes with this should pad the boxes by a cell or two.
+    """
+    if old.digest == new.digest:
+        return []
+    if old.op != new.op or old.params != new.params or old.dimensions != new.dimensions:
+        return _whole(old, new)
+    return old.operation.changed(old, new)
+
+
+def _whole(old, new):
+    if old.bounds is None or new.bounds is None:
+        return None
+    return [old.bounds, new.bounds]
+
+
+def _shared(f):
+    """Cache the last batch a shared subtree was evaluated on.
+
+    A node that appears more than once in the DAG often gets called with
+    the exact same array of points by each of its parents (booleans pass
+    their points straight through), so we only evaluate it once.
+    """
+    local = threading.local()
+
+    def shared(p):
+        if getattr(local, "p", None) is p:
+            return local.d
+        d = f(p)
+        local.p, local.d = p, d
+        return d
+
+    return shared
+
+
+def build(root):
+    """Turn a DAG into nested `sdf` objects, sharing repeated subtrees."""
+    parents = {}
+    for node in root.walk():
+        for child in node.children:
+            parents[child] = parents.get(child, 0) + 1
+
+    # Reuse anything that's already been built as the root of another tree,
+    # specialize() makes lots of trees that share most of their nodes
+    def prebuilt(node):
+        return node is not root and node._sdf is not None
+
+    built = {}
+    for node in _postorder(root, prebuilt):
+        if prebuilt(node):
+            built[node] = node._sdf
+            continue
+        children = [built[i] for i in node.children]
+        result = node.operation.build(node, children)
+        if parents.get(node, 0) > 1:
+            wrapper = sdf.SDF2 if node.dimensions == 2 else sdf.SDF3
+            result = wrapper(_shared(result))
+        built[node] = result
+    return built[root]
+
+
+def _postorder(root, leaf=lambda node: False):
+    seen = set()
+    stack = [(root, False)]
+    while stack:
+        node, expanded = stack.pop()
+        if expanded:
+            yield node
+        elif node not in seen:
+            seen.add(node)
+            stack.append((node, True))
+            if not leaf(node):
+                stack.extend((child, False) for child in reversed(node.children))
+
+
+class Interval:
+    """Result of evaluating a node over a batch of boxes.
+
+    `low` and `high` bound the node's distance over each box, `children` are
+    the results for each child and `relevant` is the operation's
+    `Operation.relevant` mask.
+    """
+
+    __slots__ = ("node", "low", "high", "children", "relevant")
+
+    def __init__(self, node, low, high):
+        operation = node.operation
+        boxes = operation.child_boxes(node, low, high)
+        self.node = node
+        self.children = [Interval(child, *box) for child, box in zip(node.children, boxes)]
+        bounds = [(i.low, i.high) for i in self.children]
+        self.low, self.high = operation.interval(node, low, high, bounds)
+        self.relevant = operation.relevant(node, low, high, bounds)
+
+    def specialize(self, index):
+        """A node equivalent to this one inside box `index`, with the
+        children that can't change the result there pruned away.
+        """
+        node = self.node
+        children = []
+        for i, child in enumerate(self.children):
+            if self.relevant is None or self.relevant[i, index]:
+                children.append(child.specialize(index))
+            else:
+                children.append(None)
+        if tuple(children) == node.children:
+            return node
+        return simplify(node.operation.pruned(node, children))
+
+
+def interval(node, low, high):
+    """Bounds on a node's distance over `(n, dimensions)` boxes, as a pair
+    of `(n,)` arrays, computed with interval arithmetic.
+    """
+    result = Interval(node, *_boxes(low, high))
+    return result.low, result.high
+
+
+def specialize(node, low, high):
+    """For each of a batch of boxes, a node that's the same as this one
+    inside the box, but with the boolean children that can't change the
+    result there pruned away.
+    """
+    result = Interval(node, *_boxes(low, high))
+    return [result.specialize(i) for i in range(len(result.low))]
+
+
+def _boxes(low, high):
+    return np.atleast_2d(np.asarray(low, dtype=float)), np.atleast_2d(np.asarray(high, dtype=float))
+
+
+def simplify(root, memo=None):
+    """Apply every operation's `simplify` bottom up, until nothing changes."""
+    if memo is None:
+        memo = {}
+    if root in memo:
+        return memo[root]
+    node = root
+    while True:
+        children = tuple(simplify(i, memo) for i in node.children)
+        if children != node.children:
+            node = Node(node.op, node.params, children)
+        simpler = node.operation.simplify(node)
+        if simpler is node:
+            break
+        node = simpler
+    memo[root] = node
+    return node
+
+
+def optimize(roots):
+    """Run the optimization passes over a list of top level nodes.
+
+    Right now that's `simplify`, which covers removing subtrees that don't
+    contribute (identity transforms, single child and duplicate children in
+    booleans) and flattening/reordering sharp booleans. Deduplication of
+    identical subtrees falls out of hash-consing.
+    """
+    memo = {}
+    return [simplify(root, memo) for root in roots]
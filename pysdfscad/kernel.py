@@ -0,0 +1,207 @@
+"""
+Fuses a geometry DAG into a single generated NumPy function.
+
+Every `sdf` operation is its own closure, which allocates fresh arrays for
+its intermediate results on every call, so a model with hundreds of nodes
+makes hundreds of batch sized temporaries per evaluation, on top of the
+Python overhead of calling through all of them.
+
+Instead we generate the source of one flat, straight line function for the
+whole tree, where every operation works `out=` into a small set of scratch
+buffers that are allocated once (per thread and batch size) and reused.
+
+Transforms don't get code of their own. Every node is emitted in a
+`Frame`, the affine map from the kernel's input points to the node's own
+coordinates, translations and rotations just compose into the frame and
+the points are only transformed, with one matmul, where a primitive needs
+them.
+
+Each `geometry.Operation` knows how to emit its own code (see
+`Operation.emit`), operations that don't fall back to calling their `sdf`
+closure from the kernel.
+
+    f = kernel.fuse(node)
+    distances = f(points)
+    print(kernel.source(node))
+"""
+
+import math
+import threading
+import weakref
+
+import numpy as np
+
+_kernels = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+class Frame:
+    """Affine map `p @ matrix + offset` from the kernel's input points to a
+    node's coordinates.
+    """
+
+    __slots__ = ("matrix", "offset", "key")
+
+    def __init__(self, matrix, offset):
+        self.matrix = np.asarray(matrix, dtype=float)
+        self.offset = np.asarray(offset, dtype=float)
+        self.key = (self.matrix.shape, self.matrix.tobytes(), self.offset.tobytes())
+
+    @classmethod
+    def identity(cls, dimensions):
+        return cls(np.eye(dimensions), np.zeros(dimensions))
+
+    @property
+    def dimensions(self):
+        return self.matrix.shape[1]
+
+    @property
+    def is_identity(self):
+        matrix = self.matrix
+        return matrix.shape[0] == matrix.shape[1] and np.array_equal(matrix, np.eye(len(matrix))) and not self.offset.any()
+
+    def translate(self, offset):
+        """The frame of a child seeing `p - offset`."""
+        return Frame(self.matrix, self.offset - offset)
+
+    def transform(self, matrix):
+        """The frame of a child seeing `p @ matrix`."""
+        return Frame(self.matrix @ matrix, self.offset @ matrix)
+
+    def project(self, dimensions):
+        """The frame of a child seeing the first few coordinates."""
+        return Frame(self.matrix[:, :dimensions], self.offset[:dimensions])
+
+
+class Kernel:
+    """Builds the source of a fused kernel.
+
+    Values live in numbered scratch buffers, `r0, r1, ...` hold one
+    distance per point and `q0, q1, ...` hold points. `register()` hands
+    out a buffer that's free and `free()` gives it back, so buffers get
+    reused as soon as the value in them is dead.
+    """
+
+    def __init__(self, dimensions):
+        self.dimensions = dimensions
+        self.lines = []
+        self.namespace = {"np": np}
+        self.shapes = []
+        self._free = {}
+        self._frames = {}
+        self._counter = 0
+
+    def line(self, text):
+        self.lines.append(text)
+
+    def constant(self, value, prefix="c"):
+        """Name for a value the kernel can use, finite floats are inlined."""
+        # repr gives a bare inf or nan for the others, which isn't python
+        if isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value):
+            return repr(float(value))
+        self._counter += 1
+        name = f"{prefix}{self._counter}"
+        self.namespace[name] = value
+        return name
+
+    def register(self, columns=None):
+        """A free scratch buffer, `(n,)` or `(n, columns)`."""
+        free = self._free.setdefault(columns, [])
+        if free:
+            return free.pop()
+        name = f"{'r' if columns is None else 'q'}{len(self.shapes)}"
+        self.shapes.append((name, columns))
+        return name
+
+    def free(self, *names):
+        columns = dict(self.shapes)
+        for name in names:
+            self._free[columns[name]].append(name)
+
+    def points(self, frame):
+        """Name of the points in a frame, transforming them the first time."""
+        if frame.is_identity and frame.dimensions == self.dimensions:
+            return "p"
+        if frame.key not in self._frames:
+            q = self.register(frame.dimensions)
+            matrix = frame.matrix
+            if matrix.shape[0] == matrix.shape[1] and np.array_equal(matrix, np.eye(len(matrix))):
+                self.line(f"np.add(p, {self.constant(frame.offset)}, out={q})")
+            else:
+                self.line(f"np.matmul(p, {self.constant(matrix)}, out={q})")
+                if frame.offset.any():
+                    self.line(f"{q} += {self.constant(frame.offset)}")
+            self._frames[frame.key] = q
+        return self._frames[frame.key]
+
+    def emit(self, node, frame):
+        """Emit code for node, returning the register its distances end up
+        in, which the caller owns from then on.
+        """
+        before = set(self._frames)
+        out = node.operation.emit(node, self, frame)
+        # Points only transformed for this subtree are dead now
+        for key in set(self._frames) - before - {frame.key}:
+            self.free(self._frames.pop(key))
+        return out
+
+    def call(self, f, node, frame):
+        """Emit a call to a plain distance function."""
+        out = self.register()
+        self.line(f"np.copyto({out}, {self.constant(f, 'f')}({self.points(frame)}).reshape(-1))")
+        return out
+
+    def source(self, root):
+        """Finish off the kernel for root, returning its source."""
+        out = self.emit(root, Frame.identity(self.dimensions))
+        header = [
+            "def kernel(p):",
+            f"    p = np.ascontiguousarray(p, dtype=float).reshape(-1, {self.dimensions})",
+            f"    {', '.join(name for name, _ in self.shapes) or '_'}, = scratch(len(p))",
+        ]
+        body = [f"    {i}" for i in self.lines]
+        return "\n".join(header + body + [f"    return {out}.reshape(-1, 1).copy()", ""])
+
+
+def _scratch(shapes):
+    local = threading.local()
+
+    def scratch(n):
+        # Scratch buffers are per thread, sdf's mesher calls us from several
+        buffers = getattr(local, "buffers", None)
+        if buffers is None or local.n != n:
+            buffers = [np.empty(n if columns is None else (n, columns)) for _, columns in shapes]
+            local.buffers, local.n = buffers, n
+        return buffers or [None]
+
+    return scratch
+
+
+def generate(node):
+    """The source of node's kernel, and the namespace it needs."""
+    kernel = Kernel(node.dimensions)
+    source = kernel.source(node)
+    kernel.namespace["scratch"] = _scratch(kernel.shapes)
+    return source, kernel.namespace
+
+
+def source(node):
+    """The generated source of node's kernel, for debugging."""
+    return generate(node)[0]
+
+
+def fuse(node):
+    """node's distance function as a single fused kernel, taking `(n, d)`
+    points and returning `(n, 1)` distances like `sdf`.
+
+    Kernels are kept as long as the node is around.
+    """
+    with _lock:
+        f = _kernels.get(node)
+    if f is None:
+        text, namespace = generate(node)
+        exec(compile(text, f"<kernel {node.digest[:12]}>", "exec"), namespace)
+        f = namespace["kernel"]
+        with _lock:
+            _kernels[node] = f
+    return f
@@ -1,8 +1,11 @@
-from lark import Lark
 from loguru import logger
-import pathlib, sys
+import multiprocessing, pathlib, sys
 from pathlib import Path
-from pysdfscad.compiler import OpenscadToPy
+from pysdfscad.compiler import OpenscadToPy, IncrementalOpenscadToPy, parser as openscad_parser
+from pysdfscad.cache import bytecode_cache, mesh_cache, volume_cache
+from pysdfscad.optimizer import optimize
+from pysdfscad import geometry
+import click
 import numpy as np
 import astor
 
@@ -33,12 +36,47 @@ def colorize_html(source):
     return highlight(source, PythonLexer(), HtmlFormatter())
 
 class OpenscadFile():
-    def __init__(self,file=None):
+    """An openscad source file and the artifacts compiled from it.
+
+    Each compile stage (parse tree, python AST, code object, python source)
+    is computed lazily and kept until `text` or `file` changes, so asking
+    for several views of the same revision only parses once.
+    """
+    def __init__(self,file=None,use_cache=True,optimize=True):
+        self._stages={}
+        self._transformer=IncrementalOpenscadToPy()
         self.text=""
         self.file=file
+        self.use_cache=use_cache
+        self.optimize=optimize
         self.compiled=None
         self.reload()
 
+    @property
+    def text(self):
+        return self._text
+
+    @text.setter
+    def text(self, value):
+        if value != getattr(self, "_text", None):
+            self._stages={}
+        self._text=value
+
+    @property
+    def file(self):
+        return self._file
+
+    @file.setter
+    def file(self, value):
+        # The filename ends up in the code object for tracebacks
+        self._stages.pop("code", None)
+        self._file=value
+
+    def _stage(self, name, build):
+        if name not in self._stages:
+            self._stages[name]=build()
+        return self._stages[name]
+
     def reload(self):
         if self.file:
             self.text=self.file.read_text()
@@ -50,25 +88,62 @@ class OpenscadFile():
         self.file.write_text(self.text)
         return self
 
+    def parse_tree(self):
+        """The lark parse tree of the current text."""
+        return self._stage("parse_tree", lambda: openscad_parser.parse(self.text))
+
+    def transformed(self):
+        """The python AST module generated from the parse tree."""
+        return self._stage("transformed", lambda: self._transformer.transform(self.parse_tree(), self.text))
+
     def ast(self):
-        parser = Lark.open("openscad.lark", rel_to=__file__, propagate_positions=True)
-        tree = parser.parse(self.text)
-        return OpenscadToPy().transform(tree)
+        """The python AST module after optimization passes, this is what
+        actually gets compiled.
+        """
+        if not self.optimize:
+            return self.transformed()
+        return self._stage("ast", lambda: optimize(self.transformed()))
+
+    def code(self):
+        """Compile the file to a python code object.
+
+        Unchanged sources are loaded from the bytecode cache, skipping
+        parsing and compilation entirely.
+        """
+        return self._stage("code", self._compile)
+
+    def python_source(self):
+        """The generated python code, as text."""
+        return self._stage("python_source", lambda: astor.to_source(self.ast(), add_line_information=True))
+
+    def _compile(self):
+        filename = str(self.file)
+        if self.use_cache:
+            key = bytecode_cache.key(self.text, filename, optimize=self.optimize)
+            code = bytecode_cache.load(key)
+            if code is not None:
+                return code
+        code = compile(
+            self.ast(),
+            filename=filename,
+            mode="exec",
+        )
+        if self.use_cache:
+            bytecode_cache.store(key, code)
+        return code
 
     def run(self):
         """Compile and run the file, returning a
-        generator with top level SDF objects.
+        list of top level `geometry.Node`s.
         """
         scad_locals = {}
-        exec(
-            compile(
-                self.ast(),
-                filename=str(self.file),
-                mode="exec",
-            ),
-            scad_locals,
-        )
-        return list(scad_locals['main']())
+        exec(self.code(), scad_locals)
+        pysdfscad.openscad_builtins.memo_stats.clear()
+        result = list(scad_locals['main']())
+        pysdfscad.openscad_builtins.log_memo_stats()
+        if self.optimize:
+            result = geometry.optimize(result)
+        return result
 
     def as_image(self):
         from PyQt5 import QtWidgets, QtCore, QtGui, QtOpenGL
@@ -84,10 +159,8 @@ class OpenscadFile():
 
         result = list(self.run())[0]
 
-        points = result.generate()
-        points, cells = np.unique(points, axis=0, return_inverse=True)
-        cells = cells.reshape((-1, 3))
-    
+        points, cells = result.generate(indexed=True, cache=mesh_cache if self.use_cache else None)
+
         meshdata = gl.MeshData(vertexes=points, faces=cells)
         mesh = gl.GLMeshItem(meshdata=meshdata,
                              smooth=False, drawFaces=True,
@@ -114,25 +187,71 @@ class OpenscadFile():
         return image 
 
     def as_ast(self):
-        return astor.dump_tree(self.ast())
+        return self._stage("ast_dump", lambda: astor.dump_tree(self.ast()))
     def as_python(self):
-        return astor.to_source(self.ast(), add_line_information=True)
-
+        return self.python_source()
 
 
-openscad_parser = Lark((pathlib.Path(__file__).parent/"openscad.lark").read_text(), propagate_positions=True)
 
-def main():
-    f = Path(sys.argv[1])
-    interpreter = OpenscadFile(f)
-    print(colorize_ansi(interpreter.as_ast()))
-    print(colorize_ansi(interpreter.as_python()))
+@click.command()
+@click.argument("file", type=click.Path(exists=True, dir_okay=False, path_type=Path), required=False)
+@click.option("--no-cache", is_flag=True, help="Always recompile and remesh, bypassing the bytecode, mesh and volume caches.")
+@click.option("--clear-cache", is_flag=True, help="Empty the bytecode, mesh and volume caches before running.")
+@click.option("--show-ast", is_flag=True, help="Print the parsed openscad AST.")
+@click.option("--show-python", is_flag=True, help="Print the python code the file compiles to.")
+@click.option("--no-optimize", is_flag=True, help="Skip constant folding, useful for debugging the compiler.")
+@click.option("--engine", type=click.Choice(["sdf", "octree", "dual", "volume"]), default="sdf", show_default=True,
+              help="Mesher to use, octree only samples the grid near the surface, "
+                   "dual does too and keeps sharp edges and corners, "
+                   "volume keeps the sampled grid so it can be meshed again without evaluating anything.")
+@click.option("--offset", type=float, default=0, show_default=True,
+              help="Grow (or with a negative offset, shrink) the surface by this much, in mm. "
+                   "Only with the volume engine.")
+@click.option("--margin", type=float,
+              help="Grid to sample around the part, in mm, for offsets to grow into. Defaults to the offset, "
+                   "keep it the same to reuse the cached volume for different offsets.")
+@click.option("--error", type=float, help="Maximum distance from the mesh to the real surface, in mm.")
+@click.option("--triangles", type=int, help="Rough number of triangles to aim for, at most.")
+@click.option("--decimate", type=float, metavar="ERROR",
+              help="Merge triangles while staying within ERROR mm of the surface.")
+@click.option("-o", "--output", type=click.Path(dir_okay=False, path_type=Path),
+              help="Mesh file to write, the format comes from the extension "
+                   "(stl, ply, obj, 3mf or anything meshio knows). Defaults to FILE with a .stl extension.")
+@click.option("-j", "--processes", type=int,
+              help="Evaluate the model in this many worker processes, 0 for one per core.")
+def main(file, no_cache, clear_cache, show_ast, show_python, no_optimize, engine, offset, margin, error, triangles, decimate, output,
+         processes):
+    if (offset or margin is not None) and engine != "volume":
+        raise click.UsageError("--offset and --margin need --engine volume")
+    if clear_cache:
+        bytecode_cache.clear()
+        mesh_cache.clear()
+        volume_cache.clear()
+        logger.info(f"Cleared the bytecode, mesh and volume caches in {Path(bytecode_cache.root).parent}")
+    if file is None:
+        return
+    interpreter = OpenscadFile(file, use_cache=not no_cache, optimize=not no_optimize)
+    # Both of these parse the file, which a cached run otherwise never does
+    if show_ast:
+        print(colorize_ansi(interpreter.as_ast()))
+    if show_python:
+        print(colorize_ansi(interpreter.as_python()))
     result = list(interpreter.run())
     if not result:
         logger.info("No top level geometry to render")
     else:
-        result[0].save('test.stl')
+        output = output or file.with_suffix(".stl")
+        options = {}
+        if engine == "volume":
+            # Leave room in the grid for the surface to grow into
+            margin = max(offset, 0) if margin is None else margin
+            options = dict(level=offset, margin=margin, volumes=None if no_cache else volume_cache)
+        result[0].save(output, engine=engine, error=error, triangles=triangles, decimate=decimate,
+                       processes=processes, cache=None if no_cache else mesh_cache, **options)
+        logger.info(f"Wrote {output}")
 
 if __name__ == '__main__':
+    # Process pool workers re-run us when frozen
+    multiprocessing.freeze_support()
     main()
 
@@ -0,0 +1,293 @@
+"""
+Adaptive octree mesher.
+
+`sdf`'s mesher samples every point of a uniform grid over the bounding box,
+so time and memory grow with the volume of the part. This one samples the
+same grid, but only where the surface can actually be.
+
+Distance functions are Lipschitz bounded, a point `d` away from the surface
+has a distance value of at most `d`. So if the distance at the center of a
+cube is larger than half the cube's diagonal, there's no surface inside it
+and we can skip it without looking any closer. We start from a single cube
+around the whole grid, and each level throws away the cubes that are
+provably empty (or full) and splits the rest into 8, until they're blocks
+of `LEAF_SIZE` grid cells. Only those blocks get sampled and polygonized.
+
+All the leaf blocks are on the same grid, and neighbouring blocks share
+the samples on the face between them, so the output is crack free and the
+same triangles `sdf` would produce for that grid. Every vertex lies on a
+grid edge, so the grid edge is all we need to weld the blocks together
+into an indexed mesh, no sorting of coordinates.
+
+Given an `interval` function (see `geometry.interval`) we use that to rule
+out cubes instead, which is usually tighter, and given `specialize` (see
+`geometry.specialize`) each leaf block gets sampled with its own distance
+function, with the parts of the tree that don't matter there pruned away.
+"""
+
+import itertools
+import time
+
+import numpy as np
+from loguru import logger  # type: ignore
+from skimage import measure  # type: ignore
+
+#: Side of a leaf block, in grid cells
+LEAF_SIZE = 8
+#: Roughly how many points we hand to the distance function at once
+BATCH_POINTS = 2**16
+
+_CHILDREN = np.array(list(itertools.product((0, 1), repeat=3)))
+
+
+def grid(bounds, step):
+    """Sample positions along each axis, like `sdf.mesh.generate`."""
+    (x0, y0, z0), (x1, y1, z1) = bounds
+    dx, dy, dz = np.broadcast_to(step, 3)
+    return np.arange(x0, x1, dx), np.arange(y0, y1, dy), np.arange(z0, z1, dz)
+
+
+def _evaluate(f, points):
+    out = [f(points[i : i + BATCH_POINTS]).reshape(-1) for i in range(0, len(points), BATCH_POINTS)]
+    return np.concatenate(out) if out else np.empty(0)
+
+
+def surface_blocks(f, axes, leaf_size=LEAF_SIZE, interval=None, seed=None):
+    """Grid indices of the leaf blocks that might contain surface.
+
+    Returns an `(n, 3)` array with the sample index each block starts at.
+    `interval(low, high)` gives bounds on the distance over a batch of
+    boxes, without it we fall back to the Lipschitz bound.
+
+    `seed` is a `(cubes, size)` pair to start from instead of a single cube
+    around the whole grid, cubes of that size (a power of 2 times
+    `leaf_size`) that the surface is known to be inside of, say the blocks
+    of a coarser grid with the same origin (see `pysdfscad.progressive`).
+    """
+    counts = np.array([len(i) for i in axes])
+    origin = np.array([i[0] for i in axes])
+    step = np.array([i[1] - i[0] if len(i) > 1 else 1 for i in axes])
+    cells = np.maximum(counts - 1, 1)
+
+    if seed is None:
+        size = leaf_size
+        while size < cells.max():
+            size *= 2
+        cubes = np.zeros((1, 3), dtype=np.int64)
+    else:
+        cubes, size = seed
+        cubes = np.asarray(cubes, dtype=np.int64).reshape(-1, 3)
+    while True:
+        # Clip cubes to the grid, the part hanging off the edge doesn't count
+        low = origin + np.minimum(cubes, cells) * step
+        high = origin + np.minimum(cubes + size, cells) * step
+        if interval is not None:
+            d_low, d_high = interval(low, high)
+            cubes = cubes[(d_low <= 0) & (d_high >= 0)]
+        else:
+            radius = np.linalg.norm(high - low, axis=1) / 2
+            d = _evaluate(f, (low + high) / 2)
+            cubes = cubes[np.abs(d) <= radius]
+        if size <= leaf_size or not len(cubes):
+            return cubes
+        size //= 2
+        cubes = (cubes[:, None, :] + _CHILDREN * size).reshape(-1, 3)
+        cubes = cubes[np.all(cubes < cells, axis=1)]
+
+
+def block_groups(f, axes, blocks, leaf_size=LEAF_SIZE, specialize=None):
+    """Blocks grouped by the distance function to sample them with, as a
+    `{f: [block, ...]}` dict.
+    """
+    if specialize is None or not len(blocks):
+        return {f: blocks}
+    counts = np.array([len(i) for i in axes])
+    low = np.stack([axes[axis][blocks[:, axis]] for axis in range(3)], axis=1)
+    last = np.minimum(blocks + leaf_size, counts - 1)
+    high = np.stack([axes[axis][last[:, axis]] for axis in range(3)], axis=1)
+    groups = {}
+    for block, block_f in zip(blocks, specialize(low, high)):
+        groups.setdefault(block_f, []).append(block)
+    return groups
+
+
+def _polygonize(volume):
+    try:
+        verts, faces, _, _ = measure.marching_cubes(volume, 0)
+    except RuntimeError:
+        # Touching zero without crossing it, the surface lies on the grid
+        # and the block next to this one meshes it
+        return np.empty((0, 3)), np.empty((0, 3), dtype=np.int64)
+    return verts, faces
+
+
+def edge_keys(index, counts):
+    """Integer key for the grid edge each vertex (in grid index space) lies
+    on, identical for every block that produces it.
+
+    Vertices that land right on a sample get the sample's key instead.
+    """
+    # Marching cubes interpolates in floating point, a vertex on a sample
+    # can come out a hair off it
+    nearest = np.round(index)
+    index = np.where(np.abs(index - nearest) < 1e-6, nearest, index)
+    base = np.floor(index)
+    axis = np.argmax(index != base, axis=1)
+    axis[np.all(index == base, axis=1)] = 3
+    base = base.astype(np.int64)
+    return ((base[:, 0] * counts[1] + base[:, 1]) * counts[2] + base[:, 2]) * 4 + axis
+
+
+def weld(points):
+    """Turn a triangle soup into an indexed mesh, `(vertices, faces)`.
+
+    Rather than sorting the vertices by their coordinates, we hash the bits
+    of each vertex into a single integer and only sort those, checking for
+    collisions afterwards.
+    """
+    points = np.ascontiguousarray(points, dtype=float).reshape(-1, 3) + 0.0  # No -0.0
+    bits = points.view(np.uint64)
+    keys = (
+        bits[:, 0] * np.uint64(0x9E3779B97F4A7C15)
+        ^ bits[:, 1] * np.uint64(0xC2B2AE3D27D4EB4F)
+        ^ bits[:, 2] * np.uint64(0x165667B19E3779F9)
+    )
+    _, first, faces = np.unique(keys, return_index=True, return_inverse=True)
+    vertices = points[first]
+    if np.any(vertices[faces] != points):
+        vertices, faces = np.unique(points, axis=0, return_inverse=True)
+    return vertices, faces.reshape(-1, 3)
+
+
+def generate(
+    f, step, bounds, leaf_size=LEAF_SIZE, verbose=False, interval=None, specialize=None, indexed=False, blocks=None
+):
+    """Mesh a distance function, returning a triangle soup like `sdf`, or
+    with `indexed` a `(vertices, faces)` pair.
+
+    Takes the same step and bounds as `sdf.mesh.generate`, and gives back
+    the same triangles, skipping the parts of the grid without any surface.
+
+    `interval(low, high)` bounds the distance over a batch of boxes, and
+    `specialize(low, high)` returns a distance function for each box that
+    only has to be right inside it. `blocks` skips looking for the blocks
+    near the surface, if we already know them (see `surface_blocks`).
+    """
+    chunks = generate_chunks(f, step, bounds, leaf_size, verbose, interval, specialize, blocks)
+    vertices, faces = assemble(chunks)
+    return (vertices, faces) if indexed else vertices[faces].reshape(-1, 3)
+
+
+def generate_chunks(
+    f, step, bounds, leaf_size=LEAF_SIZE, verbose=False, interval=None, specialize=None, blocks=None
+):
+    """Like `generate`, but yields the mesh a batch of blocks at a time, so
+    it never has to be in memory all at once.
+
+    Each chunk is a `(vertices, faces, ids)` triple, an indexed mesh of
+    its own plus the index each of its vertices has in the whole mesh.
+    Vertices on the boundary between chunks turn up in both with the same
+    id, new ids are handed out in order, starting from 0.
+    """
+    start = time.time()
+    axes = grid(bounds, step)
+    counts = np.array([len(i) for i in axes])
+    if np.any(counts < 2):
+        return
+    if blocks is None:
+        blocks = surface_blocks(f, axes, leaf_size, interval)
+    groups = block_groups(f, axes, blocks, leaf_size, specialize)
+
+    offsets = np.stack(
+        np.meshgrid(*[np.arange(leaf_size + 1)] * 3, indexing="ij"), axis=-1
+    ).reshape(-1, 3)
+    per_batch = max(1, BATCH_POINTS // len(offsets))
+    empty = 0
+    triangles = 0
+    # Ids of the vertices on block faces, the only ones other chunks can share
+    seen_keys, seen_ids = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    count = 0
+    batches = (
+        (group_f, np.array(group[i : i + per_batch]))
+        for group_f, group in groups.items()
+        for i in range(0, len(group), per_batch)
+    )
+    for f, batch in batches:
+        # Blocks on the far edge of the grid are cut short, clamping their
+        # indices repeats the last sample, which we slice back off below
+        index = np.minimum(batch[:, None, :] + offsets, counts - 1)
+        samples = np.stack([axes[axis][index[..., axis]] for axis in range(3)], axis=-1)
+        volumes = _evaluate(f, samples.reshape(-1, 3)).reshape(len(batch), *[leaf_size + 1] * 3)
+        indices, vertices, faces = [], [], []
+        size = 0
+        for block, volume in zip(batch, volumes):
+            shape = np.minimum(leaf_size + 1, counts - block)
+            volume = volume[: shape[0], : shape[1], : shape[2]]
+            if np.all(volume > 0) or np.all(volume < 0) or np.any(shape < 2):
+                empty += 1
+                continue
+            first = np.array([axes[axis][block[axis]] for axis in range(3)])
+            scale = np.array([axes[axis][1] - axes[axis][0] for axis in range(3)])
+            block_vertices, block_faces = _polygonize(volume)
+            if not len(block_faces):
+                empty += 1
+                continue
+            faces.append(block_faces + size)
+            indices.append(block_vertices + block)
+            vertices.append(block_vertices * scale + first)
+            size += len(block_vertices)
+        if not faces:
+            continue
+
+        # Blocks share the vertices on their common faces, keep one of each
+        index = np.concatenate(indices)
+        keys, first, inverse = np.unique(edge_keys(index, counts), return_index=True, return_inverse=True)
+        vertices = np.concatenate(vertices)[first]
+        faces = inverse.reshape(-1)[np.concatenate(faces)]
+        index = index[first]
+
+        position = np.minimum(np.searchsorted(seen_keys, keys), max(len(seen_keys) - 1, 0))
+        found = seen_keys[position] == keys if len(seen_keys) else np.zeros(len(keys), dtype=bool)
+        ids = np.empty(len(keys), dtype=np.int64)
+        ids[found] = seen_ids[position[found]]
+        ids[~found] = count + np.arange(np.count_nonzero(~found))
+        count += np.count_nonzero(~found)
+
+        nearest = np.round(index)
+        shared = np.any((np.abs(index - nearest) < 1e-6) & (nearest % leaf_size == 0), axis=1) & ~found
+        insert = np.searchsorted(seen_keys, keys[shared])
+        seen_keys = np.insert(seen_keys, insert, keys[shared])
+        seen_ids = np.insert(seen_ids, insert, ids[shared])
+
+        triangles += len(faces)
+        yield vertices, faces, ids
+
+    if verbose:
+        total = np.prod(np.ceil((counts - 1) / leaf_size))
+        logger.info(
+            f"{len(blocks)} of {int(total)} blocks near the surface, {empty} empty, "
+            f"{len(groups)} distinct distance functions, "
+            f"{triangles} triangles in {time.time() - start:.3g} seconds"
+        )
+
+
+def assemble(chunks):
+    """Put the chunks from `generate_chunks` back together into one
+    `(vertices, faces)` pair.
+    """
+    vertices, faces = [], []
+    count = 0
+    for chunk_vertices, chunk_faces, ids in chunks:
+        new = ids >= count
+        vertices.append(chunk_vertices[new])
+        faces.append(ids[chunk_faces])
+        count += np.count_nonzero(new)
+    if not faces:
+        return np.empty((0, 3)), np.empty((0, 3), dtype=np.int64)
+    return np.concatenate(vertices), np.concatenate(faces)
+
+
+def _empty(indexed):
+    if indexed:
+        return np.empty((0, 3)), np.empty((0, 3), dtype=np.int64)
+    return np.empty((0, 3))
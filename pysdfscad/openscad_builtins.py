@@ -1,5 +1,6 @@
 import sdf #type: ignore
 from functools import reduce, wraps
+from collections import Counter, OrderedDict
 import inspect
 from loguru import logger #type: ignore
 import itertools
@@ -12,10 +13,11 @@ from urllib.request import urlopen
 import urllib.parse
 from zipfile import ZipFile
 import typing
+from pysdfscad import geometry
 
 dirs = AppDirs("pySdfScad", "pySdfScad")
 
-Geometry = typing.Iterator[sdf.SDF3|sdf.SDF2]
+Geometry = typing.Iterator[geometry.Node]
 
 def child(func=lambda: tuple()):
     def indexer(idx=None):
@@ -48,6 +50,85 @@ def module_echo(*args,**kwargs):
         yield from children()(no_children)
     return inner
 
+def pure(func):
+    """Mark a builtin as free of side effects, the compiler is allowed to
+    evaluate calls to it ahead of time when all the arguments are constant.
+    """
+    func.pure = True
+    return func
+
+# Hit and miss counts for memoized user functions, reset on every run
+memo_stats = Counter()
+MEMO_SIZE = 4096
+# Calls whose arguments and closure add up to more values than this aren't
+# memoized, building their key would cost about as much as the call
+MEMO_MAX_KEY = 1024
+
+class _KeyTooBig(ValueError):
+    pass
+
+def _freeze(value, counter=None):
+    """Turn a function argument into something hashable. The type is part of
+    the key, since `1`, `1.0` and `true` all compare equal in python.
+
+    With a `counter` (an `itertools.count`), this gives up with `_KeyTooBig`
+    after freezing `MEMO_MAX_KEY` values.
+    """
+    if counter is not None and next(counter) >= MEMO_MAX_KEY:
+        raise _KeyTooBig()
+    if isinstance(value, (list, tuple)):
+        return (list, tuple(_freeze(i, counter) for i in value))
+    if isinstance(value, Range):
+        return (Range, value.start, value.stop, value.step)
+    return (type(value), value)
+
+def memoize(func):
+    """Bounded LRU cache for openscad functions, which are pure expressions.
+
+    Functions can read variables from the scope they were defined in, and
+    those can be reassigned between calls, so the current values of the
+    function's closure are part of the cache key along with its arguments.
+    The closure only has the variables the function reads. Calls with more
+    than `MEMO_MAX_KEY` values between the two just get evaluated.
+    """
+    cache = OrderedDict()
+    name = func.__name__.removeprefix("function_")
+    cells = func.__closure__ or ()
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            counter = itertools.count()
+            key = (
+                _freeze(args, counter),
+                _freeze(sorted(kwargs.items()), counter),
+                _freeze([cell.cell_contents for cell in cells], counter),
+            )
+            result = cache[key]
+        except KeyError:
+            memo_stats[name, "misses"] += 1
+            result = cache[key] = func(*args, **kwargs)
+            if len(cache) > MEMO_SIZE:
+                cache.popitem(last=False)
+            return result
+        except _KeyTooBig:
+            memo_stats[name, "misses"] += 1
+            return func(*args, **kwargs)
+        except (TypeError, ValueError):
+            # Unhashable argument, or a variable that isn't assigned yet
+            return func(*args, **kwargs)
+        cache.move_to_end(key)
+        memo_stats[name, "hits"] += 1
+        return result
+    return wrapper
+
+def log_memo_stats():
+    names = sorted({name for name, _ in memo_stats})
+    for name in names:
+        hits, misses = memo_stats[name, "hits"], memo_stats[name, "misses"]
+        logger.debug(f"function {name}(): {hits} memoized calls, {misses} evaluated")
+
+@pure
 def div(left,right):
     """Openscad compatible division, returns inf
     on division by zero.
@@ -59,28 +140,36 @@ def function_version():
     from importlib.metadata import version
     return version('pysdfscad')
 
+@pure
 def function_str(*args):
     args = (str(i) for i in args)
     return "".join(args)
 
+@pure
 def function_cos(a):
     return math.cos(a)
 
+@pure
 def function_sin(a):
     return math.sin(a)
 
+@pure
 def function_atan2(left,right):
     return math.atan2(left,right)
 
+@pure
 def function_min(*a):
     return min(*a)
 
+@pure
 def function_max(*a):
     return max(*a)
 
+@pure
 def function_sqrt(a):
     return math.sqrt(a)
 
+@pure
 def function_pow(left,right):
     return math.pow(left,right)
 
@@ -124,14 +213,53 @@ def scad_range(start,stop,step):
 #    """
 #    return N(i)
 
-def module_sphere(var_r):
+def special_variable(name, value=None):
+    """Look up a special variable like `$fn`.
+
+    Special variables are dynamically scoped in openscad, a module sees the
+    value from wherever it was called from, so we look through our caller's
+    frames for the closest one that sets it.
+    """
+    frame = inspect.currentframe().f_back
+    while value is None and frame is not None:
+        value = frame.f_locals.get(name)
+        frame = frame.f_back
+    return value
+
+GRID_FINE = 0.00000095367431640625
+
+def fragments(r, fn=None, fa=None, fs=None):
+    """Number of fragments openscad would use for a circle of radius r."""
+    fn, fa, fs = fn or 0, fa or 12, fs or 2
+    if r < GRID_FINE:
+        return 3
+    if fn > 0:
+        return int(max(fn, 3))
+    return int(math.ceil(max(min(360 / fa, r * 2 * math.pi / fs), 5)))
+
+def curved(node, r, var_fn=None, var_fa=None, var_fs=None):
+    """Record the error $fn/$fa/$fs allow on a curved primitive, how far
+    the middle of one fragment's chord is from the curve (its sagitta).
+    Without any of them set we leave the resolution up to the mesher.
+    """
+    var_fn = special_variable("var_fn", var_fn)
+    var_fa = special_variable("var_fa", var_fa)
+    var_fs = special_variable("var_fs", var_fs)
+    if var_fn is None and var_fa is None and var_fs is None:
+        return node
+    r = abs(r)
+    if r < GRID_FINE:
+        return node
+    return geometry.detail(node, r * (1 - math.cos(math.pi / fragments(r, var_fn, var_fa, var_fs))))
+
+def module_sphere(var_r, var_fn=None, var_fa=None, var_fs=None):
     def inner(children):
-        yield sdf.sphere(var_r)
+        yield curved(geometry.sphere(var_r), var_r, var_fn, var_fa, var_fs)
     return inner
 
-def module_circle(var_r,var_fn=None):
+def module_circle(var_r, var_fn=None, var_fa=None, var_fs=None):
     def inner(children):
-        yield sdf.circle(var_r)
+        yield curved(geometry.circle(var_r), var_r, var_fn, var_fa, var_fs)
     return inner
 
 def module_square(var_size,var_center=False):
@@ -140,25 +268,29 @@ def module_square(var_size,var_center=False):
         offset=(0,0)
         if not var_center:
             offset=[x/2,y/2]
-        yield sdf.rectangle(var_size).translate(offset)
+        yield geometry.translate(geometry.rectangle(var_size), offset)
     return inner
 
-def module_cylinder(var_r=0, var_r1=None, var_r2=None, var_h=None, var_center=False):
+def module_cylinder(var_r=0, var_r1=None, var_r2=None, var_h=None, var_center=False,
+                    var_fn=None, var_fa=None, var_fs=None):
 
     if var_r1 == None : var_r1=var_r
     if var_r2 == None : var_r2=var_r
+    specials = (var_fn, var_fa, var_fs)
 
     def inner(children=lambda:()):
+        cone = geometry.capped_cone([0,0,0], sdf.Z*var_h, var_r1, var_r2)
+        cone = curved(cone, max(abs(var_r1), abs(var_r2)), *specials)
         if var_center == False:
-            yield sdf.capped_cone([0,0,0], sdf.Z*var_h, var_r1, var_r2)
+            yield cone
         elif var_center==True:
-            yield sdf.capped_cone([0,0,0], sdf.Z*var_h, var_r1, var_r2).translate(-sdf.Z*var_h/2)
+            yield geometry.translate(cone, -sdf.Z*var_h/2)
     return inner
 
 def module_linear_extrude(var_height=1,var_center=True, var_convexity=None,var_twist=0):
     def inner(children=lambda:()):
         children = list(module_union()(children))[0]
-        yield children.extrude(var_height)
+        yield geometry.extrude(children, var_height)
     return inner
 
 
@@ -168,42 +300,42 @@ def module_cube(var_size, var_center=False):
         offset=(0,0,0)
         if not var_center:
             offset=[x/2,y/2,z/2]
-        yield sdf.box(var_size).translate(offset)
+        yield geometry.translate(geometry.box(var_size), offset)
     return inner
 
 def module_union(var_smooth=1):
     def inner(children):
         children = list(children()(no_children))
         if not children: return
-        yield reduce(lambda a,b: sdf.union(a,b,k=var_smooth), children)
+        yield geometry.union(children, k=var_smooth)
     return inner
 
 def module_intersection(var_smooth=0):
     def inner(children):
         children = list(children()(no_children))
         if not children: return
-        yield reduce(lambda a,b: sdf.intersection(a,b,k=var_smooth), children)
+        yield geometry.intersection(children, k=var_smooth)
     return inner
 
 def module_difference(var_smooth=0):
     def inner(children):
         children = list(children()(no_children))
         if not children: return
-        yield reduce(lambda a,b: sdf.difference(a,b,k=var_smooth), children)
+        yield geometry.difference(children, k=var_smooth)
     return inner
 
 def module_blend(var_ratio=0.5):
     def inner(children):
         children = list(children()(no_children))
         child1 = children[0]
-        child2 = reduce(sdf.union,children[1:])
-        yield child1.blend(child2,k=var_ratio)
+        child2 = geometry.union(children[1:])
+        yield geometry.blend(child1, child2, k=var_ratio)
     return inner
 
 def module_shell(var_thickness=10):
     def inner(children):
         children = list(module_union()(children))[0]
-        yield children.shell(var_thickness)
+        yield geometry.shell(children, var_thickness)
     return inner
 
 def twist(context,degrees):
@@ -233,12 +365,14 @@ def module_rotate(vector):
         #Convert degrees to radians
         x,y,z = (i*(math.pi/180) for i in (x,y,z))
         #ToDo, these are not degrees
-        if isinstance(children,sdf.SDF3):
-            yield children.rotate(x,sdf.X).rotate(y,sdf.Y).rotate(z,sdf.Z)
-        elif isinstance(children,sdf.SDF2):
-            yield children.rotate(z)
+        if children.dimensions == 3:
+            children = geometry.rotate(children, x, sdf.X)
+            children = geometry.rotate(children, y, sdf.Y)
+            yield geometry.rotate(children, z, sdf.Z)
+        elif children.dimensions == 2:
+            yield geometry.rotate(children, z)
         else:
-            raise TypeError(f"{type(children)} not expected")
+            raise TypeError(f"{children} not expected")
     return inner
 
 def module_translate(vector):
@@ -252,14 +386,28 @@ def module_translate(vector):
             raise TypeError(f"Unable to convert translate({vector}) parameter to a vec3 or vec2 of numbers")
         children = list(module_union()(children))[0]
         if not children: return
-        yield children.translate((x,y,z))
+        yield geometry.translate(children, (x,y,z))
+    return inner
+
+def module_scale(var_v):
+    def inner(children):
+        children = list(module_union()(children))[0]
+        if not children: return
+        yield geometry.scale(children, var_v)
+    return inner
+
+def module_mirror(var_v):
+    def inner(children):
+        children = list(module_union()(children))[0]
+        if not children: return
+        yield geometry.mirror(children, var_v)
     return inner
 
 def module_extrude(height):
     def inner(children=lambda:()):
         children = list(module_union()(children))[0]
         if not children: return
-        yield children.extrude((height))
+        yield geometry.extrude(children, height)
     return inner
 
 
@@ -299,7 +447,7 @@ def module_text(var_text,var_size=10,var_font="Arimo",var_width=None,var_height=
 
     def text_inner(children=lambda:()):
         w, h = sdf.measure_text(str(font_file), var_text,height=var_size,width=var_width)
-        yield sdf.text(str(font_file), var_text, height=var_height,width=var_width,).translate((w/2,h/2))
+        yield geometry.translate(geometry.text(str(font_file), var_text, height=var_height, width=var_width), (w/2,h/2))
 
     return text_inner
 
@@ -0,0 +1,433 @@
+"""
+Optimization passes over the python AST generated by `compiler.OpenscadToPy`.
+
+This runs between the transformer and `compile()`. Right now it does constant
+folding and a bit of partial evaluation:
+
+ * Arithmetic, comparisons and boolean operations on literals get evaluated.
+ * Calls to builtins marked `@pure` in `openscad_builtins` get evaluated when
+   all their arguments are literals (unless the openscad file defines its
+   own function with that name).
+ * Builtin constants like `PI` and `true`, and top level variables that are
+   only ever assigned once to something constant, get inlined (variables
+   only after their assignment, like python would see them).
+ * Conditionals with a constant test get replaced by the branch that's taken.
+
+It also wraps user defined functions in `openscad_builtins.memoize`. You can
+opt a function out by putting a `// pysdfscad: no-memoize` comment on the
+line before it (or after it, on the same line).
+
+The incremental transformer shares AST nodes between compiles, so nothing
+in here modifies a node in place, changed nodes are shallow copies.
+"""
+
+import ast
+import copy
+import math
+import operator
+from collections import Counter
+
+import pysdfscad.openscad_builtins as builtins
+from pysdfscad.compiler import SPECIAL_VARIABLES
+
+BINARY_OPS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+}
+
+UNARY_OPS = {
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos,
+    ast.Not: operator.not_,
+}
+
+COMPARE_OPS = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+}
+
+# Lists longer than this don't get copied into every place they're used
+MAX_INLINE_LIST = 16
+
+NO_MEMOIZE_PRAGMA = "pysdfscad: no-memoize"
+
+
+
+def is_literal(node):
+    return isinstance(node, ast.Constant) or (
+        isinstance(node, ast.List) and all(is_literal(i) for i in node.elts)
+    )
+
+
+def literal_value(node):
+    if isinstance(node, ast.Constant):
+        return node.value
+    return [literal_value(i) for i in node.elts]
+
+
+def foldable(value):
+    """Can we put this value in the AST as a literal and get the same
+    thing back at runtime?
+    """
+    if isinstance(value, float):
+        return math.isfinite(value)
+    return isinstance(value, (int, str, bool, type(None)))
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def literal_size(node):
+    if isinstance(node, ast.List):
+        return sum(literal_size(i) for i in node.elts)
+    return 1
+
+
+def has_yield(nodes):
+    return any(
+        isinstance(child, (ast.Yield, ast.YieldFrom))
+        for node in nodes
+        for child in ast.walk(node)
+    )
+
+
+def bindings(module):
+    """Count how many times each name gets bound anywhere in the module."""
+    out = Counter()
+    for node in ast.walk(module):
+        if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load):
+            out[node.id] += 1
+        elif isinstance(node, ast.arg):
+            out[node.arg] += 1
+        elif isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            out[node.name] += 1
+    return out
+
+
+class CopyOnWriteTransformer(ast.NodeTransformer):
+    """A NodeTransformer that copies nodes instead of modifying them."""
+
+    def generic_visit(self, node):
+        changed = {}
+        for field, old in ast.iter_fields(node):
+            if isinstance(old, list):
+                new = []
+                dirty = False
+                for item in old:
+                    if not isinstance(item, ast.AST):
+                        new.append(item)
+                        continue
+                    value = self.visit(item)
+                    if value is not item:
+                        dirty = True
+                    if value is None:
+                        continue
+                    elif isinstance(value, list):
+                        new.extend(value)
+                    else:
+                        new.append(value)
+                if dirty:
+                    changed[field] = new
+            elif isinstance(old, ast.AST):
+                value = self.visit(old)
+                if value is not old:
+                    changed[field] = value
+        if not changed:
+            return node
+        node = copy.copy(node)
+        for field, value in changed.items():
+            setattr(node, field, value)
+        return node
+
+
+class ConstantFolder(CopyOnWriteTransformer):
+    """Copy-on-write constant folder.
+
+    `constants` maps variable names to literal AST nodes that can be
+    substituted wherever the name is loaded, `shadowed` is the set of names
+    the openscad file binds itself, so we leave those builtins alone.
+    Assignments to names in `dead` are removed.
+    """
+
+    def __init__(self, constants, shadowed, dead=()):
+        self.constants = constants
+        self.shadowed = shadowed
+        self.dead = dead
+
+    def constant(self, value, like):
+        return ast.copy_location(ast.Constant(value), like)
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, ast.Load) and node.id in self.constants:
+            value = copy.deepcopy(self.constants[node.id])
+            for child in ast.walk(value):
+                ast.copy_location(child, node)
+            return value
+        return node
+
+    def visit_Assign(self, node):
+        targets = node.targets
+        if len(targets) == 1 and isinstance(targets[0], ast.Name):
+            if targets[0].id in self.dead:
+                return None
+        return self.generic_visit(node)
+
+    def visit_FunctionDef(self, node):
+        node = self.generic_visit(node)
+        if not node.body:
+            node = copy.copy(node)
+            node.body = [ast.copy_location(ast.Pass(), node)]
+        return node
+
+    def visit_BinOp(self, node):
+        node = self.generic_visit(node)
+        op = BINARY_OPS.get(type(node.op))
+        if not (op and is_literal(node.left) and is_literal(node.right)):
+            return node
+        left, right = literal_value(node.left), literal_value(node.right)
+        if not (is_number(left) and is_number(right)):
+            return node
+        if isinstance(node.op, ast.Pow) and abs(right) > 64:
+            return node
+        try:
+            value = op(left, right)
+        except (ArithmeticError, ValueError):
+            return node
+        if not foldable(value):
+            return node
+        return self.constant(value, node)
+
+    def visit_UnaryOp(self, node):
+        node = self.generic_visit(node)
+        op = UNARY_OPS.get(type(node.op))
+        if not (op and isinstance(node.operand, ast.Constant)):
+            return node
+        try:
+            value = op(node.operand.value)
+        except TypeError:
+            return node
+        if not foldable(value):
+            return node
+        return self.constant(value, node)
+
+    def visit_Compare(self, node):
+        node = self.generic_visit(node)
+        if not all(isinstance(i, ast.Constant) for i in [node.left, *node.comparators]):
+            return node
+        left = node.left.value
+        try:
+            for op, right in zip(node.ops, node.comparators):
+                if not COMPARE_OPS[type(op)](left, right.value):
+                    return self.constant(False, node)
+                left = right.value
+        except (KeyError, TypeError):
+            return node
+        return self.constant(True, node)
+
+    def visit_BoolOp(self, node):
+        node = self.generic_visit(node)
+        if not all(isinstance(i, ast.Constant) for i in node.values):
+            return node
+        values = [i.value for i in node.values]
+        if isinstance(node.op, ast.And):
+            value = values[0]
+            for value in values:
+                if not value:
+                    break
+        else:
+            value = values[0]
+            for value in values:
+                if value:
+                    break
+        return self.constant(value, node)
+
+    def visit_IfExp(self, node):
+        node = self.generic_visit(node)
+        if isinstance(node.test, ast.Constant):
+            return node.body if node.test.value else node.orelse
+        return node
+
+    def visit_If(self, node):
+        node = self.generic_visit(node)
+        if not isinstance(node.test, ast.Constant):
+            return node
+        taken, dropped = (
+            (node.body, node.orelse) if node.test.value else (node.orelse, node.body)
+        )
+        # Removing the only `yield` would turn a generator into a regular
+        # function, so leave those for CPython's own dead code elimination
+        if has_yield(dropped):
+            return node
+        return taken or ast.copy_location(ast.Pass(), node)
+
+    def visit_Subscript(self, node):
+        node = self.generic_visit(node)
+        if not (
+            isinstance(node.value, ast.List)
+            and is_literal(node.value)
+            and isinstance(node.slice, ast.Constant)
+            and isinstance(node.slice.value, int)
+            and not isinstance(node.slice.value, bool)
+        ):
+            return node
+        try:
+            return node.value.elts[node.slice.value]
+        except IndexError:
+            return node
+
+    def visit_Call(self, node):
+        node = self.generic_visit(node)
+        if not isinstance(node.func, ast.Name) or node.func.id in self.shadowed:
+            return node
+        func = getattr(builtins, node.func.id, None)
+        if not getattr(func, "pure", False):
+            return node
+        if not all(is_literal(i) for i in node.args):
+            return node
+        if not all(i.arg and is_literal(i.value) for i in node.keywords):
+            return node
+        args = [literal_value(i) for i in node.args]
+        kwargs = {i.arg: literal_value(i.value) for i in node.keywords}
+        try:
+            value = func(*args, **kwargs)
+        except Exception:
+            # Leave it for runtime, where the error gets reported properly
+            return node
+        if not foldable(value):
+            return node
+        return self.constant(value, node)
+
+
+class Memoizer(CopyOnWriteTransformer):
+    """Decorates user defined openscad functions with `memoize`, except the
+    ones defined on a line in `skip`.
+    """
+
+    def __init__(self, skip):
+        self.skip = skip
+
+    def visit_FunctionDef(self, node):
+        node = self.generic_visit(node)
+        if not node.name.startswith("function_") or node.lineno in self.skip:
+            return node
+        node = copy.copy(node)
+        node.decorator_list = [
+            ast.copy_location(ast.Name(id="memoize", ctx=ast.Load()), node),
+            *node.decorator_list,
+        ]
+        return node
+
+
+def pragma_lines(module, pragma):
+    """Lines a pragma comment applies to, the one it ends on and the next."""
+    out = set()
+    for node in ast.walk(module):
+        if (
+            isinstance(node, ast.Expr)
+            and isinstance(node.value, ast.Constant)
+            and isinstance(node.value.value, str)
+            and pragma in node.value.value
+        ):
+            out.update((node.end_lineno, node.end_lineno + 1))
+    return out
+
+
+def builtin_constants(shadowed):
+    """Literal constants (`var_PI`, `var_true`...) exported by the builtins."""
+    out = {}
+    for name in dir(builtins):
+        if not name.startswith("var_") or name in shadowed:
+            continue
+        value = getattr(builtins, name)
+        if foldable(value):
+            out[name] = ast.Constant(value)
+    return out
+
+
+def optimize(module):
+    """Return an optimized copy of a module generated by `OpenscadToPy`."""
+    bound = bindings(module)
+    shadowed = set(bound)
+    constants = builtin_constants(shadowed)
+
+    main = next(
+        (i for i in module.body if isinstance(i, ast.FunctionDef) and i.name == "main"),
+        None,
+    )
+    # Where in main each constant gets assigned, python only sees it after
+    # that, so uses before it stay the error they are without optimization
+    assignments = {}
+    if main:
+        for index, statement in enumerate(main.body):
+            if (
+                isinstance(statement, ast.Assign)
+                and len(statement.targets) == 1
+                and isinstance(statement.targets[0], ast.Name)
+                and bound[statement.targets[0].id] == 1
+            ):
+                assignments[statement.targets[0].id] = index
+
+    def before(index):
+        return {
+            name: value for name, value in constants.items() if assignments.get(name, -1) < index
+        }
+
+    # Constants can be defined in terms of other constants, keep going until
+    # we stop finding new ones
+    changed = True
+    while changed:
+        changed = False
+        for name, index in assignments.items():
+            if name in constants:
+                continue
+            folder = ConstantFolder(before(index), shadowed)
+            value = folder.visit(main.body[index].value)
+            if is_literal(value) and literal_size(value) <= MAX_INLINE_LIST:
+                constants[name] = value
+                changed = True
+
+    # Every use after the assignment gets substituted, so the assignments
+    # themselves are dead, unless something reads them before that, or
+    # they're special variables, the builtins read those from the frame
+    inlined = set(assignments) & set(constants) - set(SPECIAL_VARIABLES)
+    for name in list(inlined):
+        early = main.body[: assignments[name] + 1]
+        if any(
+            isinstance(i, ast.Name) and i.id == name and isinstance(i.ctx, ast.Load)
+            for statement in early
+            for i in ast.walk(statement)
+        ):
+            inlined.discard(name)
+
+    available = before(0)
+    assigned = {index: name for name, index in assignments.items() if name in constants}
+    body = []
+    for statement in module.body:
+        if statement is main:
+            folder = ConstantFolder(available, shadowed, dead=inlined)
+            statement = copy.copy(main)
+            statement.body = []
+            for index, child in enumerate(main.body):
+                child = folder.visit(child)
+                if isinstance(child, list):
+                    statement.body.extend(child)
+                elif child is not None:
+                    statement.body.append(child)
+                if index in assigned:
+                    available[assigned[index]] = constants[assigned[index]]
+            if not statement.body:
+                statement.body = [ast.copy_location(ast.Pass(), main)]
+        else:
+            statement = ConstantFolder(before(0), shadowed).visit(statement)
+        body.append(statement)
+    module = copy.copy(module)
+    module.body = body
+    return Memoizer(pragma_lines(module, NO_MEMOIZE_PRAGMA)).visit(module)
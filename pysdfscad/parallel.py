@@ -0,0 +1,229 @@
+"""
+Evaluate distance functions in a pool of worker processes.
+
+`sdf` evaluates batches on a thread pool, but the closures our builtins
+build spend a lot of their time in Python, holding the GIL, so that doesn't
+get far past one core. This evaluates them in other processes instead.
+
+Points and distances go through blocks of shared memory ("slots"), so a
+task is just a few integers. The geometry itself (a `geometry.Node`, which
+is what the compiled model produces) is pickled once and sent to each
+worker the first time it's asked for it. Workers fuse the node into a single
+kernel (see `pysdfscad.kernel`) and keep it by the node's digest, so later
+calls, and later renders of the same geometry, only send the digest.
+
+    with parallel.ProcessPool(8) as pool:
+        f = pool.function(node)
+        distances = f(points)
+
+`pool()` gives a pool that's kept around for the rest of the session.
+Pools are shut down, and their shared memory freed, when they're closed,
+garbage collected or the process exits, whichever comes first.
+
+Workers are started with "spawn", which re-runs the program's entry point
+in a frozen (PyInstaller) build, so entry points call
+`multiprocessing.freeze_support()` first.
+"""
+
+import collections
+import math
+import multiprocessing
+import os
+import pickle
+import queue
+import threading
+import weakref
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from pysdfscad import kernel
+
+#: Most points a slot holds, bigger batches are split over several slots
+SLOT_POINTS = 2**16
+#: Batches aren't split into pieces smaller than this
+MIN_POINTS = 2**10
+#: How many fused kernels each worker keeps
+WORKER_CACHE = 256
+#: How many pickled nodes a pool keeps to send workers that don't have them
+PAYLOAD_CACHE = 256
+
+_worker = {}
+
+
+def _attach(names, shape):
+    blocks = [shared_memory.SharedMemory(name=i) for i in names]
+    return blocks, [np.ndarray(shape, dtype=float, buffer=i.buf) for i in blocks]
+
+
+def _initialize(inputs, outputs, slot_points):
+    _worker["blocks"], _worker["inputs"] = _attach(inputs, (slot_points, 3))
+    blocks, _worker["outputs"] = _attach(outputs, (slot_points,))
+    _worker["blocks"] += blocks
+    _worker["functions"] = collections.OrderedDict()
+
+
+def _evaluate(digest, slot, count, payload=None):
+    """Evaluate the node with digest on the points in slot. Returns False
+    if we haven't seen that node yet and weren't sent it.
+    """
+    functions = _worker["functions"]
+    f = functions.get(digest)
+    if f is None:
+        if payload is None:
+            return False
+        f = functions[digest] = kernel.fuse(pickle.loads(payload))
+        if len(functions) > WORKER_CACHE:
+            functions.popitem(last=False)
+    functions.move_to_end(digest)
+    points = _worker["inputs"][slot][:count]
+    _worker["outputs"][slot][:count] = np.asarray(f(points)).reshape(-1)
+    return True
+
+
+class RemoteFunction:
+    """A node's distance function, evaluated by a `ProcessPool`.
+
+    Equal for the same node, so meshers can group blocks by it.
+    """
+
+    __slots__ = ("pool", "node")
+
+    def __init__(self, pool, node):
+        self.pool = pool
+        self.node = node
+
+    def __call__(self, points):
+        return self.pool.evaluate(self.node, points)
+
+    def __eq__(self, other):
+        return isinstance(other, RemoteFunction) and (self.pool, self.node) == (other.pool, other.node)
+
+    def __hash__(self):
+        return hash((id(self.pool), self.node))
+
+
+class ProcessPool:
+    """Worker processes, and the shared memory slots to talk to them.
+
+    Safe to call from several threads at once, like `sdf`'s mesher does.
+    """
+
+    def __init__(self, processes=None, slot_points=SLOT_POINTS):
+        self.processes = processes or os.cpu_count() or 1
+        self.slot_points = slot_points
+        # Twice as many slots as workers, so they never wait on us to
+        # copy the next batch in
+        slots = 2 * self.processes
+        self._inputs = [shared_memory.SharedMemory(create=True, size=slot_points * 3 * 8) for _ in range(slots)]
+        self._outputs = [shared_memory.SharedMemory(create=True, size=slot_points * 8) for _ in range(slots)]
+        self._input_arrays = [np.ndarray((slot_points, 3), dtype=float, buffer=i.buf) for i in self._inputs]
+        self._output_arrays = [np.ndarray((slot_points,), dtype=float, buffer=i.buf) for i in self._outputs]
+        self._free = queue.Queue()
+        for slot in range(slots):
+            self._free.put(slot)
+        self._payloads = collections.OrderedDict()
+        self._payloads_lock = threading.Lock()
+        self._pool = multiprocessing.get_context("spawn").Pool(
+            self.processes,
+            initializer=_initialize,
+            initargs=([i.name for i in self._inputs], [i.name for i in self._outputs], slot_points),
+        )
+        # Doesn't hold on to self, so runs at exit or once we're collected
+        self._finalizer = weakref.finalize(self, _shutdown, self._pool, self._inputs + self._outputs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def function(self, node):
+        """A callable evaluating node's distance function in the pool."""
+        return RemoteFunction(self, node)
+
+    def _payload(self, node):
+        # Only the most recent nodes, a worker that's dropped an older one
+        # gets sent it again anyway
+        with self._payloads_lock:
+            payload = self._payloads.get(node.digest)
+            if payload is None:
+                payload = self._payloads[node.digest] = pickle.dumps(node)
+                if len(self._payloads) > PAYLOAD_CACHE:
+                    self._payloads.popitem(last=False)
+            self._payloads.move_to_end(node.digest)
+            return payload
+
+    def _collect(self, node, out, start, count, slot, result):
+        try:
+            if not result.get():
+                self._pool.apply(_evaluate, (node.digest, slot, count, self._payload(node)))
+            out[start : start + count] = self._output_arrays[slot][:count]
+        finally:
+            self._free.put(slot)
+
+    def evaluate(self, node, points):
+        """Distances from node to `(n, 3)` points, as an `(n, 1)` array."""
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        out = np.empty(len(points))
+        size = min(self.slot_points, max(MIN_POINTS, math.ceil(len(points) / self.processes)))
+        pending = collections.deque()
+        try:
+            for start in range(0, len(points), size):
+                count = min(size, len(points) - start)
+                while True:
+                    try:
+                        slot = self._free.get_nowait()
+                        break
+                    except queue.Empty:
+                        if not pending:
+                            slot = self._free.get()
+                            break
+                        # Free up one of our own slots rather than wait on them
+                        self._collect(node, out, *pending.popleft())
+                try:
+                    self._input_arrays[slot][:count] = points[start : start + count]
+                    result = self._pool.apply_async(_evaluate, (node.digest, slot, count))
+                except BaseException:
+                    self._free.put(slot)
+                    raise
+                pending.append((start, count, slot, result))
+            while pending:
+                self._collect(node, out, *pending.popleft())
+        finally:
+            # Something failed, the slots still out have to come back, but
+            # only once the workers are done writing to them
+            for _, _, slot, result in pending:
+                result.wait()
+                self._free.put(slot)
+        return out.reshape(-1, 1)
+
+    def close(self):
+        self._input_arrays = self._output_arrays = []
+        self._payloads.clear()
+        self._finalizer()
+
+
+def _shutdown(pool, blocks):
+    pool.terminate()
+    pool.join()
+    for block in blocks:
+        block.unlink()
+        try:
+            block.close()
+        except BufferError:
+            # Still viewed by an array at exit, unlinked is what matters
+            pass
+
+
+_pools = {}
+
+
+def pool(processes=None):
+    """A `ProcessPool` with that many processes, started the first time it's
+    asked for and kept until exit.
+    """
+    processes = processes or os.cpu_count() or 1
+    if processes not in _pools:
+        _pools[processes] = ProcessPool(processes)
+    return _pools[processes]
@@ -0,0 +1,107 @@
+"""
+Meshes that start coarse and get finer, for a preview that shows up
+straight away.
+
+Each pass halves the step (`FACTOR`), from one giving about
+`COARSE_SAMPLES` samples over the bounding box down to the step asked for,
+so the first mesh costs a small fraction of the last one. All the passes
+mesh with the octree mesher on grids with the same origin, so a block of
+one pass is exactly 8 blocks of the next. We only look for surface inside
+the blocks the pass before found it in, rather than working down from a
+cube around the whole model again.
+
+    for step, (vertices, faces) in progressive.refine(node, error=0.1):
+        show(vertices, faces)  # Coarse first, the last one at error 0.1
+
+The last pass is the same mesh `Node.generate(engine="octree")` gives in
+the same bounds. With `align`, the grid lines fall on multiples of the
+final step, like those of `tiles.TiledMesh`, so the last pass can be split
+into its tiles (see `TiledMesh.adopt`) rather than meshed again. These are
+for looking at, exports should still mesh once, at the full resolution.
+"""
+
+import time
+
+import numpy as np
+from loguru import logger  # type: ignore
+
+from pysdfscad import geometry, mesher, resolution
+
+#: How many times the step gets divided from one pass to the next, a power
+#: of 2 so the blocks of each pass line up with those of the next
+FACTOR = 2
+#: Most passes we make, the last one included
+PASSES = 4
+#: Samples over the bounding box for the first pass
+COARSE_SAMPLES = 24**3
+
+
+def steps(node, step=None, error=None, triangles=None, passes=PASSES, factor=FACTOR):
+    """The step of each pass, coarsest first, ending with the one
+    `resolution.choose_step` picks.
+    """
+    final = resolution.choose_step(node, step, error, triangles) or resolution.samples_step(node)
+    if final is None:
+        return [None]
+    coarse = resolution.samples_step(node, COARSE_SAMPLES)
+    out = [final]
+    while len(out) < passes and coarse is not None and np.max(out[-1]) * factor <= coarse:
+        out.append(np.multiply(out[-1], factor))
+    return out[::-1]
+
+
+def refine(
+    node,
+    step=None,
+    error=None,
+    triangles=None,
+    passes=PASSES,
+    factor=FACTOR,
+    leaf_size=mesher.LEAF_SIZE,
+    processes=None,
+    cancel=None,
+    verbose=False,
+    align=False,
+):
+    """Mesh node over and over, yielding `(step, (vertices, faces))` for
+    each pass, coarsest first. The step is picked like `Node.generate`
+    does, and `processes` and `cancel` work the same way. With `align`,
+    the grid starts on a multiple of the last step.
+
+    Nodes without bounds, or that aren't 3D, get a single pass.
+    """
+    passes = steps(node, step, error, triangles, passes, factor)
+    # The coarsest step pads the grid enough for all of them, the surface
+    # never gets near the edge of a grid some other pass doesn't cover
+    bounds = geometry.mesh_bounds(node, passes[0])
+    if bounds is None:
+        yield passes[-1], node.generate(passes[-1], indexed=True, verbose=verbose, processes=processes, cancel=cancel)
+        return
+    if align:
+        low, high = bounds
+        bounds = tuple(np.floor(np.divide(low, passes[-1])) * passes[-1]), high
+    f = geometry.distance(node, processes, cancel)
+
+    def interval(low, high):
+        return geometry.interval(node, low, high)
+
+    def specialize(low, high):
+        return [geometry.distance(i, processes, cancel) for i in geometry.specialize(node, low, high)]
+
+    blocks = None
+    for step in passes:
+        start = time.time()
+        if cancel is not None and cancel.is_set():
+            raise geometry.Cancelled()
+        axes = mesher.grid(bounds, step)
+        seed = None if blocks is None else (blocks * factor, leaf_size * factor)
+        blocks = mesher.surface_blocks(f, axes, leaf_size, interval, seed)
+        mesh = mesher.generate(
+            f, step, bounds, leaf_size, interval=interval, specialize=specialize, indexed=True, blocks=blocks
+        )
+        if verbose:
+            logger.info(
+                f"Pass at step {np.max(step):.3g}, {len(blocks)} blocks, "
+                f"{len(mesh[1])} triangles in {time.time() - start:.3g} seconds"
+            )
+        yield step, mesh
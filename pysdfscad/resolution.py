@@ -0,0 +1,91 @@
+"""
+Picks the grid step to mesh a model with.
+
+Left alone, `sdf` spreads a fixed number of samples over the bounding box,
+whatever the model looks like. Instead we work the step out from, in order
+of precedence:
+
+ * An explicit step.
+ * A maximum feature error, how far (roughly) the mesh may stray from the
+   real surface. Marching cubes can be off by up to half a cell diagonal.
+ * `$fn`, `$fa` and `$fs`. Curved primitives record how far openscad's
+   fragments would be from the curve in a `detail` node, and we treat the
+   smallest one as a feature error. A coarse `$fn` never makes the step
+   any coarser than the sample count would, and a fine one never spreads
+   more than `MAX_DETAIL_SAMPLES` over the bounding box.
+ * The sample count, like `sdf` does.
+
+On top of that a target triangle count caps the resolution. We mesh a
+cheap draft, and since the triangle count goes with the inverse square of
+the step, scale its step to hit the target.
+"""
+
+import math
+
+import sdf  # type: ignore
+from loguru import logger  # type: ignore
+
+#: Samples in the draft we mesh to estimate the triangle count
+DRAFT_SAMPLES = 32**3
+#: Most samples over the bounding box `$fn`/`$fa`/`$fs` can ask for, a
+#: high `$fn` on a big part would otherwise never finish meshing
+MAX_DETAIL_SAMPLES = 256**3
+
+
+def detail_error(node):
+    """The smallest error asked for by `$fn`/`$fa`/`$fs`, or None."""
+    errors = [i.params[0] for i in node.walk() if i.op == "detail"]
+    return min(errors, default=None)
+
+
+def error_step(error):
+    """Largest step that keeps marching cubes within `error` of the surface."""
+    return 2 * error / math.sqrt(3)
+
+
+def samples_step(node, samples=None):
+    """The step `sdf` would pick, spreading samples over the bounding box."""
+    if node.bounds is None or node.dimensions != 3:
+        return None
+    low, high = node.bounds
+    volume = max(math.prod(high - low), 1e-27)
+    return (volume / (samples or sdf.mesh.SAMPLES)) ** (1 / 3)
+
+
+def triangles_step(node, triangles):
+    """Step that should give roughly `triangles` triangles."""
+    draft = samples_step(node, DRAFT_SAMPLES)
+    if draft is None:
+        return None
+    for _ in range(4):
+        count = len(node.generate(step=draft, engine="octree", verbose=False)) // 3
+        if count:
+            return draft * math.sqrt(count / triangles)
+        # Too coarse to see anything, a thin part maybe
+        draft /= 4
+    return None
+
+
+def choose_step(node, step=None, error=None, triangles=None, samples=None):
+    """The step to mesh node with, None to leave it up to `sdf`."""
+    if step is not None:
+        return step
+    if error is not None:
+        step = error_step(error)
+    if step is None and detail_error(node) is not None:
+        step = error_step(detail_error(node))
+        default = samples_step(node, samples)
+        if default is not None:
+            step = min(step, default)
+        finest = samples_step(node, MAX_DETAIL_SAMPLES)
+        if finest is not None and finest > step:
+            logger.debug(f"Coarsening step to {finest:.3g}, $fn/$fa/$fs asked for {step:.3g}")
+            step = finest
+    if step is None and (samples is not None or triangles is not None):
+        step = samples_step(node, samples)
+    if triangles is not None:
+        budget = triangles_step(node, triangles)
+        if budget is not None and (step is None or budget > step):
+            logger.debug(f"Coarsening step to {budget:.3g} to stay near {triangles} triangles")
+            step = budget
+    return step
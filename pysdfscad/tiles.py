@@ -0,0 +1,196 @@
+"""
+Meshes kept in tiles, so an edit only re-meshes the part of the model it
+touched.
+
+Space is split into cubes of `TILE_CELLS` grid cells, on a grid anchored
+at the origin so the tiles line up from one version of the model to the
+next. Each tile is meshed on its own, and neighbouring tiles sample the
+same points on the face between them, so they meet without cracks.
+
+When the model changes, `geometry.changed` diffs the old and new DAGs by
+structural hash and says where the surface can have moved. Only the tiles
+around there are meshed again, the rest of the mesh is kept as it was.
+
+    tiles = TiledMesh()
+    tiles.update(node, error=0.1)
+    vertices, faces = tiles.mesh()
+    tiles.update(edited_node, error=0.1)  # Only meshes what changed
+"""
+
+import time
+
+import numpy as np
+from loguru import logger  # type: ignore
+
+from pysdfscad import geometry, resolution
+
+#: Side of a tile, in grid cells
+TILE_CELLS = 64
+#: Grid cells around a change that get meshed again, distances near it move
+#: a little even outside it
+CHANGE_PADDING = 2
+#: Engines that mesh tiles that fit together, others are meshed whole
+TILED_ENGINES = ("sdf", "octree")
+
+
+class TiledMesh:
+    """A mesh of the last node it was `update`d with, one piece per tile."""
+
+    def __init__(self, tile_cells=TILE_CELLS):
+        self.tile_cells = tile_cells
+        self.node = None
+        self.step = None
+        self.options = None
+        self.tiles = {}
+
+    def copy(self):
+        """Another `TiledMesh` with the same tiles, that can be updated
+        without touching this one.
+        """
+        out = TiledMesh(self.tile_cells)
+        out.node, out.step, out.options, out.tiles = self.node, self.step, self.options, dict(self.tiles)
+        return out
+
+    def _size(self, step):
+        return np.broadcast_to(np.asarray(step, dtype=float) * self.tile_cells, 3)
+
+    def _needed(self, node, step):
+        """Every tile node's (padded) bounds touch."""
+        low, high = geometry.mesh_bounds(node, step)
+        size = self._size(step)
+        first = np.floor(np.array(low) / size).astype(int)
+        last = np.floor(np.array(high) / size).astype(int)
+        return {tuple(first + i) for i in np.ndindex(*(last - first + 1))}
+
+    def _touched(self, tiles, boxes, step):
+        size = self._size(step)
+        pad = np.broadcast_to(np.asarray(step, dtype=float) * CHANGE_PADDING, 3)
+        out = set()
+        for tile in tiles:
+            low = np.array(tile) * size
+            high = low + size
+            if any(np.all(low <= box_high + pad) and np.all(box_low - pad <= high) for box_low, box_high in boxes):
+                out.add(tile)
+        return out
+
+    def _bounds(self, tile, step):
+        size = self._size(step)
+        low = np.array(tile) * size
+        # Grids leave off the end, half a step more keeps the last sample,
+        # which the next tile starts from
+        high = low + size + np.broadcast_to(np.asarray(step, dtype=float) / 2, 3)
+        return tuple(low), tuple(high)
+
+    def _dirty(self, node, step, options):
+        """The tiles node needs, and those of them to mesh again."""
+        needed = self._needed(node, step)
+        same_grid = self.options == options and np.array_equal(self.step, step) and None not in self.tiles
+        if self.node is None or not same_grid:
+            return needed, needed
+        boxes = geometry.changed(self.node, node)
+        dirty = needed if boxes is None else self._touched(needed, boxes, step)
+        return needed, dirty | (needed - set(self.tiles))
+
+    def fresh(self, node, step, engine="octree", **options):
+        """Whether `update`ing to node at step would mesh all of it again,
+        without any of the tiles we have.
+        """
+        if not _tiled(node, step, engine):
+            return True
+        needed, dirty = self._dirty(node, step, _options(engine, options))
+        return dirty == needed
+
+    def adopt(self, node, step, mesh, engine="octree", **options):
+        """Take mesh, node meshed at step as a whole on a grid that starts
+        on a multiple of step (see `progressive.refine`), as if we'd been
+        `update`d to it, splitting its triangles into the tiles they're in.
+        """
+        if not _tiled(node, step, engine):
+            raise ValueError(f"Can't split a mesh from the {engine!r} engine into tiles")
+        vertices, faces = mesh
+        tiles = {tile: _empty() for tile in self._needed(node, step)}
+        if len(faces):
+            # The grids line up, so every triangle is inside one tile
+            keys = np.floor(vertices[faces].mean(axis=1) / self._size(step)).astype(int)
+            found, inverse = np.unique(keys, axis=0, return_inverse=True)
+            inverse = inverse.reshape(-1)
+            order = np.argsort(inverse, kind="stable")
+            groups = np.split(order, np.cumsum(np.bincount(inverse))[:-1])
+            for tile, group in zip(found, groups):
+                used, tile_faces = np.unique(faces[group], return_inverse=True)
+                tiles[tuple(tile)] = vertices[used], tile_faces.reshape(-1, 3)
+        self.node, self.step, self.options, self.tiles = node, step, _options(engine, options), tiles
+
+    def update(self, node, step=None, error=None, triangles=None, engine="octree", cancel=None, **options):
+        """Mesh node, re-meshing only the tiles where it differs from the
+        node we had before, with the same options as `Node.generate`.
+
+        Returns how many tiles were meshed. Everything gets meshed again
+        if the options or the step change, or node has no bounds. If it's
+        `cancel`led (see `Node.generate`) we're left as we were.
+
+        A mesh `cache` is only used when node gets meshed whole, tiles
+        aren't worth keeping on disk, and would push whole meshes out.
+        """
+        start = time.time()
+        step = resolution.choose_step(node, step, error, triangles) or resolution.samples_step(node)
+        cache = options.pop("cache", None)
+        options = _options(engine, options)
+
+        if not _tiled(node, step, engine):
+            mesh = node.generate(step, indexed=True, verbose=False, cancel=cancel, cache=cache, **options)
+            self.node, self.step, self.options, self.tiles = node, step, options, {None: mesh}
+            return 1
+        needed, dirty = self._dirty(node, step, options)
+        tiles = {tile: mesh for tile, mesh in self.tiles.items() if tile in needed and tile not in dirty}
+        dirty = sorted(dirty)
+        meshed = 0
+        if dirty:
+            # All the tiles at once, skipping those the surface can't be in
+            # and meshing the rest with only the parts of the tree that
+            # matter inside them
+            low = np.array(dirty) * self._size(step)
+            result = geometry.Interval(node, low, low + self._size(step))
+            surface = (result.low <= 0) & (result.high >= 0)
+            for i, tile in enumerate(dirty):
+                # Empty tiles are kept too, so we know they're up to date
+                tiles[tile] = _empty()
+                if surface[i]:
+                    bounds = self._bounds(tile, step)
+                    sub = result.specialize(i)
+                    tiles[tile] = sub.generate(step, bounds, indexed=True, verbose=False, cancel=cancel, **options)
+                    meshed += 1
+        # Only now the whole update went through
+        self.node, self.step, self.options, self.tiles = node, step, options, tiles
+        logger.info(
+            f"{len(dirty)} of {len(needed)} tiles changed, meshed {meshed} with surface "
+            f"in {time.time() - start:.3g} seconds"
+        )
+        return len(dirty)
+
+    def mesh(self):
+        """The whole mesh, as a `(vertices, faces)` pair."""
+        vertices, faces = [], []
+        count = 0
+        for tile_vertices, tile_faces in self.tiles.values():
+            vertices.append(tile_vertices)
+            faces.append(tile_faces + count)
+            count += len(tile_vertices)
+        if not faces:
+            return _empty()
+        return np.concatenate(vertices), np.concatenate(faces)
+
+
+def _options(engine, options):
+    options = dict(options, engine=engine)
+    for i in ("verbose", "cache"):
+        options.pop(i, None)
+    return options
+
+
+def _tiled(node, step, engine):
+    return engine in TILED_ENGINES and step is not None and node.bounds is not None and node.dimensions == 3
+
+
+def _empty():
+    return np.empty((0, 3)), np.empty((0, 3), dtype=np.int64)
@@ -0,0 +1,62 @@
+"""
+Mesh from a densely sampled distance volume.
+
+The other meshers evaluate the distance function every time they run, even
+when all that changed is how we want the surface meshed. This one samples
+every point of the grid once, into a volume that can be kept (memory
+mapped, see `cache.VolumeCache`) and meshed again without touching the
+distance function.
+
+Because we have the whole field, the surface doesn't have to be at zero:
+meshing at `level` gives the surface offset by that much, outwards for a
+positive level, like a `shell` around the part but without evaluating
+anything. Outward offsets need grid around the part to land in, so the
+volume can be sampled with a `margin`.
+
+Volumes are float32, which is what `skimage`'s marching cubes works in
+anyway, so a C ordered volume, memory mapped or not, is meshed in place.
+"""
+
+import time
+
+import numpy as np
+from loguru import logger  # type: ignore
+from skimage import measure  # type: ignore
+
+from pysdfscad import mesher
+
+
+def sample(f, axes, out=None):
+    """Distances at every point of the grid into out, an `(nx, ny, nz)`
+    float32 array, a slab of x at a time.
+    """
+    counts = tuple(len(i) for i in axes)
+    if out is None:
+        out = np.empty(counts, dtype=np.float32)
+    yz = np.stack(np.meshgrid(axes[1], axes[2], indexing="ij"), axis=-1).reshape(-1, 2)
+    per_slab = max(1, mesher.BATCH_POINTS // max(len(yz), 1))
+    for i in range(0, counts[0], per_slab):
+        x = axes[0][i : i + per_slab]
+        points = np.column_stack([np.repeat(x, len(yz)), np.tile(yz, (len(x), 1))])
+        out[i : i + len(x)] = mesher._evaluate(f, points).reshape(len(x), *counts[1:])
+    return out
+
+
+def generate(volume, axes, level=0.0, verbose=False, indexed=False):
+    """Mesh the surface where volume, sampled on the grid axes, is level.
+
+    Returns a triangle soup like `sdf`, or with `indexed` a `(vertices,
+    faces)` pair.
+    """
+    start = time.time()
+    if min(volume.shape) < 2 or not volume.min() <= level <= volume.max():
+        return mesher._empty(indexed)
+    spacing = tuple(float(i[1] - i[0]) for i in axes)
+    vertices, faces, _, _ = measure.marching_cubes(volume, level, spacing=spacing)
+    vertices += [i[0] for i in axes]
+    if verbose:
+        logger.info(
+            f"Meshed a {'x'.join(str(i) for i in volume.shape)} volume at level {level:g}, "
+            f"{len(faces)} triangles in {time.time() - start:.3g} seconds"
+        )
+    return (vertices, faces) if indexed else vertices[faces].reshape(-1, 3)
@@ -1,10 +1,14 @@
 import sys, os
+import functools
+import multiprocessing
 import textwrap
 import pkgutil
 import pysdfscad
 import sdf
-#from pysdfscad.main import EvalOpenscad, openscad_parser
 from pysdfscad.main import OpenscadFile, colorize_html
+from pysdfscad import geometry, progressive, tiles
+from pysdfscad.cache import mesh_cache
+from pysdfscad.compiler import parser as openscad_parser
 import importlib.resources
 from loguru import logger
 from pathlib import Path
@@ -14,7 +18,7 @@ from PyQt5 import QtWidgets, uic, QtCore, QtGui
 from PyQt5.Qt import QColor, QApplication, QFont, QFontMetrics
 from PyQt5.QtWidgets import QApplication, QLabel, QMainWindow, QMenuBar, QMenu,\
         QAction, QHBoxLayout, QWidget, QSplitter, QFileDialog, QShortcut, QMessageBox, QFrame,\
-        QGridLayout, QTextEdit
+        QGridLayout, QTextEdit, QInputDialog
 from PyQt5.QtCore import Qt, QSettings, QPoint, QSize, QThread, pyqtSlot, pyqtSignal, QObject
 from PyQt5.QtGui import QKeySequence
 from PyQt5 import QtCore
@@ -30,7 +34,6 @@ from PyQt5.Qsci import QsciLexerCustom
 from lark import Lark
 import json
 
-from threading import Thread
 from pathlib import Path
 
 from collections import defaultdict
@@ -105,9 +108,8 @@ class LexerOpenscad(QsciLexerCustom):
         }
 
     def create_parser(self):
-        grammar = pkgutil.get_data("pysdfscad","openscad.lark").decode("utf-8")
-        #self.lark = Lark(grammar, parser=None, lexer='basic')
-        self.lark = Lark(grammar, parser='earley', lexer='dynamic_complete')
+        #Share the compiler's cached LALR parser, we only use it for lexing
+        self.lark = openscad_parser
         # All tokens: print([t.name for t in self.lark.parser.lexer.tokens])
 
 #    def defaultPaper(self, style):
@@ -225,6 +227,7 @@ example_intersection();
 """
 
 from pysdfscad_qtgui.logWidget import QTextEditLogger
+from pysdfscad_qtgui.renderQueue import RenderQueue
 from contextlib import redirect_stdout
 
 class LoggerWriter:
@@ -253,7 +256,19 @@ class MainUi(QMainWindow):
         self.readSettings()
 
         self.openscadFile=OpenscadFile()
+        #Only ever touched by the render thread, it compiles a snapshot of
+        # the editor's text and keeps what it can from the last one
+        self._renderFile=OpenscadFile()
         self.mesh=None
+        self.result=None
+        #Meshed a tile at a time, so edits only remesh what they touched,
+        # renders update a copy and hand it back when they're done
+        self.tiledMesh=tiles.TiledMesh()
+        self.meshItem=None
+        #Renders run on their own thread, the last one wins
+        self.renderQueue=RenderQueue(self)
+        self.renderQueue.finished.connect(self._showRender)
+        self.renderQueue.progress.connect(self._showRender)
 
         self.preview3d=gl.GLViewWidget(self.sideSplitter)
         self.preview3d.setCameraPosition(distance=40)
@@ -297,6 +312,9 @@ class MainUi(QMainWindow):
         self.actionExit.triggered.connect(self.close)
         self.actionRender.triggered.connect(self.render)
         self.actionExport_Mesh.triggered.connect(self.exportMesh)
+        self.actionTriangle_Budget.triggered.connect(self.setTriangleBudget)
+        self.actionMax_Error.triggered.connect(self.setMaxError)
+        self.actionDecimate_Export.triggered.connect(self.setDecimateError)
         # Connect Edit actions
 #        self.copyAction.triggered.connect(self.copyContent)
 #        self.pasteAction.triggered.connect(self.pasteContent)
@@ -319,62 +337,134 @@ class MainUi(QMainWindow):
         self.setWindowTitle(f"{self.openscadFile.file} - pySdfScad")
 
 
-    @logger.catch
-    def _render(self):
-        try:
-            #Try and set background threads to a *low* priority,
-            # since people on the internet seem confused about this
-            # a higher nice value means your program is *nicer* to
-            # other programs, and will get out of their way.
-            os.nice(14)
-        except: pass
-
-        self.openscadFile.text=self.editor.text()
-        self.astPreview.setText(self.openscadFile.as_ast())
-        self.pythonPreview.setText(self.openscadFile.as_python())
-        result = list(self.openscadFile.run())
+    def _render(self, text, file, tiledMesh, options, cancel, progress):
+        """Compile and mesh on the render thread, returning everything the UI
+        needs to show the result (see `_showRender`), including tiledMesh,
+        a copy of ours updated to the new mesh.
+
+        If the tiles we have are no use, coarse meshes get handed to
+        `progress` first, so there's something to look at straight away,
+        and each pass only looks for surface where the one before found it,
+        the last one included.
+        """
+        openscadFile=self._renderFile
+        openscadFile.file=file
+        openscadFile.text=text
+        ast=openscadFile.as_ast()
+        python=openscadFile.as_python()
+        result = list(openscadFile.run())
+        if cancel.is_set():
+            raise geometry.Cancelled()
         if not result:
             logger.info("No top level geometry to render")
-        else:
-            self.result=result[0]
-            if isinstance(self.result,sdf.SDF2):
-                self.result=self.result.extrude(0.1)
-            import numpy as np
-            with redirect_stdout(LoggerWriter(logger.opt(depth=1).info)):
-                points = self.result.generate()
-            points, cells = np.unique(points, axis=0, return_inverse=True)
-            cells = cells.reshape((-1, 3))
-            self.mesh=(points,cells)
-    
-            meshdata = gl.MeshData(vertexes=points, faces=cells)
-            mesh = gl.GLMeshItem(meshdata=meshdata,
-                                 smooth=False, drawFaces=True,
-                                 drawEdges=False,
-                                 shader="normalColor",
-                                 color = (1,1,1,1), edgeColor=(0.2, 0.5, 0.2, 1)
-                                 )
+            return ast, python, None, None, None
+        result=result[0]
+        if result.dimensions == 2:
+            result=geometry.extrude(result,0.1)
+        with redirect_stdout(LoggerWriter(logger.opt(depth=1).info)):
+            options=dict(options)
+            passes=progressive.steps(result, error=options.pop("error"), triangles=options.pop("triangles"))
+            step=passes[-1]
+            adopted=False
+            if len(passes) > 1 and tiledMesh.fresh(result, step, **options):
+                tiled=options["engine"] in tiles.TILED_ENGINES
+                #The last pass is split into tiles, unless the engine
+                # doesn't tile, then we only make the coarse ones
+                count=len(passes) if tiled else len(passes)-1
+                refined=progressive.refine(result, passes[count-1], passes=count,
+                                           processes=options.get("processes"), cancel=cancel, align=tiled)
+                for i, (_, mesh) in enumerate(refined, 1):
+                    if tiled and i == count:
+                        tiledMesh.adopt(result, step, mesh, **options)
+                        adopted=True
+                    else:
+                        progress((ast, python, result, mesh, None))
+            if not adopted:
+                tiledMesh.update(result, step, cancel=cancel, **options)
+            mesh = tiledMesh.mesh()
+        return ast, python, result, mesh, tiledMesh
+
+    def _showRender(self, job, rendered):
+        ast, python, self.result, self.mesh, tiledMesh = rendered
+        if tiledMesh is not None:
+            self.tiledMesh=tiledMesh
+        self.astPreview.setText(ast)
+        self.pythonPreview.setText(python)
+        if self.result is None:
             self.preview3d.clear()
-            g = gl.GLGridItem()
-            g.setSize(200, 200)
-            g.setSpacing(10, 10)
+            self.meshItem=None
+            return
+        points, cells = self.mesh
+        if self.meshItem is not None:
+            #Swap the new tiles into the mesh that's already shown
+            self.meshItem.setMeshData(vertexes=points, faces=cells)
+            return
+        meshdata = gl.MeshData(vertexes=points, faces=cells)
+        self.meshItem = gl.GLMeshItem(meshdata=meshdata,
+                             smooth=False, drawFaces=True,
+                             drawEdges=False,
+                             shader="normalColor",
+                             color = (1,1,1,1), edgeColor=(0.2, 0.5, 0.2, 1)
+                             )
+        self.preview3d.clear()
+        g = gl.GLGridItem()
+        g.setSize(200, 200)
+        g.setSpacing(10, 10)
 
-            a=gl.GLAxisItem()
-            a.setSize(10,10,10)
+        a=gl.GLAxisItem()
+        a.setSize(10,10,10)
 
-            self.preview3d.addItem(g)
-            self.preview3d.addItem(a)
-            self.preview3d.addItem(mesh)
+        self.preview3d.addItem(g)
+        self.preview3d.addItem(a)
+        self.preview3d.addItem(self.meshItem)
 
     def exportMesh(self):
         if not self.result:
             return
         dlg = QFileDialog()
         dlg.setFileMode(QFileDialog.AnyFile)
-        dlg.setNameFilters(["STL file (*.stl)","Guess from extention (*)"])
+        dlg.setNameFilters(["STL file (*.stl)","3MF file (*.3mf)","PLY file (*.ply)","OBJ file (*.obj)","Guess from extention (*)"])
         dlg.selectNameFilter("STL file (*.stl)")
         if dlg.exec_():
             filename = dlg.selectedFiles()[0]
-            self.result.save(filename)
+            self.result.save(filename, decimate=self.decimateError or None, **self.meshOptions)
+
+    @property
+    def engine(self):
+        if self.actionDual_Contouring.isChecked():
+            return "dual"
+        return "octree" if self.actionOctree_Mesher.isChecked() else "sdf"
+
+    @property
+    def meshOptions(self):
+        return dict(
+            engine=self.engine,
+            triangles=self.triangleBudget or None,
+            error=self.maxError or None,
+            processes=0 if self.actionAll_Cores.isChecked() else None,
+            cache=mesh_cache,
+        )
+
+    def setTriangleBudget(self):
+        value, ok = QInputDialog.getInt(self, "Triangle Budget",
+            "Rough number of triangles to aim for, at most (0 for no limit):",
+            self.triangleBudget, 0, 2**31-1, 1000)
+        if ok:
+            self.triangleBudget = value
+
+    def setMaxError(self):
+        value, ok = QInputDialog.getDouble(self, "Max Feature Error",
+            "Maximum distance from the mesh to the real surface in mm (0 to use $fn/$fa/$fs):",
+            self.maxError, 0, 1000, 3)
+        if ok:
+            self.maxError = value
+
+    def setDecimateError(self):
+        value, ok = QInputDialog.getDouble(self, "Decimate Export",
+            "Merge exported triangles while staying within this many mm of the surface (0 to not decimate):",
+            self.decimateError, 0, 1000, 3)
+        if ok:
+            self.decimateError = value
 
     def openFile(self):
         dlg = QFileDialog()
@@ -400,24 +490,36 @@ class MainUi(QMainWindow):
         logger.warning(f"Early \x1b[31malpha!\x1b[0m Really!")
         logger.warning(f'Save your files \x1b[31mregularly\x1b[0m')
         logger.info(f"Started new render with file {self.openscadFile.file}")
-        self.preview3d.clear()
-        self.astPreview.setText("")
-        self.pythonPreview.setText("")
-        thread = Thread(target=self._render)
-        thread.start()
+        #Widgets and the state renders start from are only touched from
+        # this thread, so take a snapshot of them now
+        self.renderQueue.submit(functools.partial(self._render, self.editor.text(),
+            self.openscadFile.file, self.tiledMesh.copy(), self.meshOptions))
 
     def closeEvent(self, event):
+        self.renderQueue.close()
         logger.remove(self._logger_handle_id)
         settings = QSettings()
         settings.setValue('geometry',self.saveGeometry())
         settings.setValue('windowState',self.saveState())
+        settings.setValue('octreeMesher',self.actionOctree_Mesher.isChecked())
+        settings.setValue('dualContouring',self.actionDual_Contouring.isChecked())
+        settings.setValue('allCores',self.actionAll_Cores.isChecked())
+        settings.setValue('triangleBudget',self.triangleBudget)
+        settings.setValue('maxError',self.maxError)
+        settings.setValue('decimateError',self.decimateError)
         super().closeEvent(event)
 
     def readSettings(self):
         settings = QSettings()
+        self.triangleBudget = settings.value("triangleBudget", 0, type=int)
+        self.maxError = settings.value("maxError", 0.0, type=float)
+        self.decimateError = settings.value("decimateError", 0.0, type=float)
         try:
             self.restoreGeometry(settings.value("geometry"))
             self.restoreState(settings.value("windowState"))
+            self.actionOctree_Mesher.setChecked(settings.value("octreeMesher", False, type=bool))
+            self.actionDual_Contouring.setChecked(settings.value("dualContouring", False, type=bool))
+            self.actionAll_Cores.setChecked(settings.value("allCores", False, type=bool))
         except:
             logger.warning("Couldn't restore window state from settings")
 
@@ -469,4 +571,6 @@ def main():
 
 
 if __name__ == "__main__":
+    # Process pool workers re-run us when frozen, see pysdfscad.parallel
+    multiprocessing.freeze_support()
     main()
@@ -0,0 +1,129 @@
+"""
+Runs renders one at a time on a background thread.
+
+Every render gets a job id. Submitting a new one cancels whatever is queued
+or running, and waits for the edits to settle (`DEBOUNCE_MS`) before
+starting, so a burst of renders only runs the last one. Cancelling is
+cooperative, jobs get a `threading.Event` to hand to the mesher (see
+`geometry.Cancellable`), which stops before its next batch of points.
+
+Results come back to the UI thread through the `finished` signal, and
+only for the latest job, anything older is stale and dropped. Jobs can
+hand back results along the way too, by calling the `progress` function
+they're given, those come through the `progress` signal the same way.
+"""
+
+import functools
+import itertools
+import os
+import threading
+
+from loguru import logger
+from PyQt5.QtCore import QObject, QThread, QTimer, pyqtSignal, pyqtSlot
+
+from pysdfscad.geometry import Cancelled
+
+#: How long to wait for another render before starting one, in ms
+DEBOUNCE_MS = 300
+
+
+class _Worker(QObject):
+    finished = pyqtSignal(int, object)
+    progress = pyqtSignal(int, object)
+
+    @pyqtSlot()
+    def lowerPriority(self):
+        try:
+            #Try and set background threads to a *low* priority,
+            # since people on the internet seem confused about this
+            # a higher nice value means your program is *nicer* to
+            # other programs, and will get out of their way.
+            os.nice(14)
+        except: pass
+
+    @pyqtSlot(int, object, object)
+    def run(self, job, function, cancel):
+        if cancel.is_set():
+            return
+        try:
+            result = function(cancel, functools.partial(self.progress.emit, job))
+        except Cancelled:
+            logger.info(f"Render {job} cancelled")
+            return
+        except Exception:
+            logger.exception(f"Render {job} failed")
+            return
+        self.finished.emit(job, result)
+
+
+class RenderQueue(QObject):
+    """Runs `function(cancel, progress)` jobs on a single worker `QThread`."""
+
+    #: Job id and result of the latest job
+    finished = pyqtSignal(int, object)
+    #: Job id and a result the latest job isn't finished with yet
+    progress = pyqtSignal(int, object)
+    _run = pyqtSignal(int, object, object)
+
+    def __init__(self, parent=None, delay=DEBOUNCE_MS):
+        super().__init__(parent)
+        self._ids = itertools.count(1)
+        self.latest = 0
+        self._pending = None
+        self._cancel = None
+
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(delay)
+        self._timer.timeout.connect(self._start)
+
+        self._thread = QThread(self)
+        self._worker = _Worker()
+        self._worker.moveToThread(self._thread)
+        #The worker lives in the other thread, so these are queued
+        self._thread.started.connect(self._worker.lowerPriority)
+        self._run.connect(self._worker.run)
+        self._worker.finished.connect(self._finished)
+        self._worker.progress.connect(self._progress)
+        self._thread.start()
+
+    def submit(self, function):
+        """Queue up `function(cancel, progress)`, cancelling the job before it,
+        returns the new job's id.
+        """
+        self.cancel()
+        job = next(self._ids)
+        self.latest = job
+        self._cancel = threading.Event()
+        self._pending = (job, function, self._cancel)
+        self._timer.start()
+        return job
+
+    def cancel(self):
+        """Cancel the job that's queued or running, if there is one."""
+        if self._cancel is not None:
+            self._cancel.set()
+        self._pending = None
+        self._timer.stop()
+
+    def _start(self):
+        if self._pending is None:
+            return
+        job, function, cancel = self._pending
+        self._pending = None
+        self._run.emit(job, function, cancel)
+
+    @pyqtSlot(int, object)
+    def _finished(self, job, result):
+        if job == self.latest:
+            self.finished.emit(job, result)
+
+    @pyqtSlot(int, object)
+    def _progress(self, job, result):
+        if job == self.latest:
+            self.progress.emit(job, result)
+
+    def close(self):
+        self.cancel()
+        self._thread.quit()
+        self._thread.wait()
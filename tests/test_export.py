@@ -0,0 +1,91 @@
+import zipfile
+
+import meshio
+import numpy as np
+import pytest
+from pysdfscad import export, geometry, mesher
+
+
+@pytest.fixture
+def small_batches(monkeypatch):
+    monkeypatch.setattr(mesher, "BATCH_POINTS", 2000)
+
+
+def test_chunks_weld_across_batches(small_batches):
+    shape = geometry.difference([geometry.box((4, 4, 4)), geometry.sphere(2.5)])
+    chunks = list(shape.chunks(step=0.2, engine="octree", verbose=False))
+    assert len(chunks) > 1
+    vertices, faces = mesher.assemble(chunks)
+    expected, _ = shape.generate(step=0.2, engine="octree", verbose=False, indexed=True)
+    assert len(vertices) == len(expected)
+    assert np.array_equal(np.sort(vertices, axis=0), np.sort(expected, axis=0))
+
+
+@pytest.mark.parametrize("suffix", [".stl", ".ply", ".obj"])
+def test_streamed_files_read_back(small_batches, tmp_path, suffix):
+    shape = geometry.sphere(2)
+    vertices, faces = shape.generate(step=0.2, engine="octree", verbose=False, indexed=True)
+    path = tmp_path / f"out{suffix}"
+    shape.save(path, step=0.2, engine="octree", verbose=False)
+    mesh = meshio.read(path)
+    triangles = mesh.points[mesh.cells_dict["triangle"]]
+    assert len(triangles) == len(faces)
+    assert np.allclose(np.sort(triangles.reshape(-1, 3), axis=0), np.sort(vertices[faces].reshape(-1, 3), axis=0), atol=1e-5)
+
+
+def test_3mf(tmp_path):
+    shape = geometry.box((2, 2, 2))
+    vertices, faces = shape.generate(step=0.5, engine="dual", verbose=False, indexed=True)
+    path = tmp_path / "out.3mf"
+    shape.save(path, step=0.5, engine="dual", verbose=False)
+    with zipfile.ZipFile(path) as archive:
+        model = archive.read("3D/3dmodel.model").decode()
+    assert model.count("<vertex ") == len(vertices)
+    assert model.count("<triangle ") == len(faces)
+    assert model.endswith("</model>\n")
+
+
+def test_mesh_cache(tmp_path, monkeypatch):
+    from pysdfscad import cache
+
+    monkeypatch.setattr(cache, "cache_dir", lambda *parts: tmp_path.joinpath(*parts))
+    (tmp_path / "meshes").mkdir()
+    meshes = cache.MeshCache()
+    shape = geometry.difference([geometry.box((4, 4, 4)), geometry.sphere(2.5)])
+    expected = shape.generate(step=0.2, engine="octree", verbose=False, indexed=True)
+    soup = shape.generate(step=0.2, engine="octree", verbose=False, cache=meshes)
+    assert np.array_equal(soup, shape.generate(step=0.2, engine="octree", verbose=False, cache=meshes))
+    shape.save(tmp_path / "first.stl", step=0.2, engine="octree", verbose=False, cache=meshes)
+
+    def no_meshing(*args, **kwargs):
+        raise AssertionError("Cached geometry was meshed again")
+
+    monkeypatch.setattr(geometry, "distance", no_meshing)
+    # Streamed chunks were stored under the same key generate() uses
+    vertices, faces = shape.generate(step=0.2, engine="octree", verbose=False, indexed=True, cache=meshes)
+    assert np.array_equal(vertices, expected[0]) and np.array_equal(faces, expected[1])
+    shape.save(tmp_path / "second.stl", step=0.2, engine="octree", verbose=False, cache=meshes)
+    assert (tmp_path / "first.stl").read_bytes() == (tmp_path / "second.stl").read_bytes()
+    with pytest.raises(AssertionError):
+        shape.generate(step=0.25, engine="octree", verbose=False, cache=meshes)
+
+    # Least recently used meshes go first once over the size budget
+    meshes.max_size = max(size for _, size, _ in meshes.entries())
+    meshes.evict()
+    assert len(meshes.entries()) == 1
+
+
+@pytest.mark.parametrize("suffix", [".stl", ".ply", ".obj", ".3mf"])
+def test_failed_exports_leave_nothing(tmp_path, suffix):
+    shape = geometry.sphere(2)
+    path = tmp_path / f"out{suffix}"
+    path.write_bytes(b"previous export")
+
+    def failing():
+        yield from shape.chunks(step=0.2, engine="octree", verbose=False)
+        raise geometry.Cancelled()
+
+    with pytest.raises(geometry.Cancelled):
+        export.save(path, failing())
+    assert path.read_bytes() == b"previous export"
+    assert [i.name for i in tmp_path.iterdir()] == [path.name]
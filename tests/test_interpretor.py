@@ -1,5 +1,6 @@
 from pysdfscad.main import OpenscadFile,colorize_ansi
 import logging
+import math
 import pytest
 from _pytest.logging import caplog as _caplog
 from loguru import logger
@@ -161,3 +162,344 @@ def test_scope(caplog):
     assert "ECHO: 14" in loglines[0]
     assert "ECHO: 3" in loglines[1]
 
+
+def test_operator_precedence(caplog):
+    eval_scad("""
+    echo(1+4/2, 2*3^2, 1<2 && 2<1 || true, -2^2, 2^3^2);
+    """)
+    assert "ECHO: 3.0, 18, True, -4, 512" in caplog.text
+
+def test_bytecode_cache(tmp_path, monkeypatch, caplog):
+    import pysdfscad.cache
+    monkeypatch.setattr(pysdfscad.cache, "cache_dir",
+                        lambda *parts: tmp_path.joinpath(*parts))
+    (tmp_path/"bytecode").mkdir()
+
+    interpreter = OpenscadFile()
+    interpreter.text = 'echo("cached");'
+    interpreter.run()
+    assert len(list((tmp_path/"bytecode").glob("*.pyc"))) == 1
+
+    def no_parse():
+        raise AssertionError("Cached source was parsed again")
+    monkeypatch.setattr(interpreter, "ast", no_parse)
+    interpreter.run()
+    assert caplog.text.count("ECHO: 'cached'") == 2
+
+def test_cli_cache_hit_skips_parser(tmp_path, monkeypatch):
+    from click.testing import CliRunner
+    import pysdfscad.cache
+    import pysdfscad.main
+    def cache_dir(*parts):
+        path = tmp_path.joinpath("cache", *parts)
+        path.mkdir(parents=True, exist_ok=True)
+        return path
+    monkeypatch.setattr(pysdfscad.cache, "cache_dir", cache_dir)
+    source = tmp_path/"echo.scad"
+    source.write_text('echo("cli");')
+    runner = CliRunner()
+    assert runner.invoke(pysdfscad.main.main, [str(source)]).exit_code == 0
+
+    class NoParser:
+        def parse(self, text):
+            raise AssertionError("Cached source was parsed again")
+    monkeypatch.setattr(pysdfscad.main, "openscad_parser", NoParser())
+    result = runner.invoke(pysdfscad.main.main, [str(source)])
+    assert result.exit_code == 0, result.output
+    # Printing the code is opt in, and is what needs the parser
+    result = runner.invoke(pysdfscad.main.main, [str(source), "--show-python"])
+    assert isinstance(result.exception, AssertionError)
+
+def test_disk_cache_cleans_up(tmp_path, monkeypatch):
+    import os
+    import pysdfscad.cache
+    monkeypatch.setattr(pysdfscad.cache, "cache_dir",
+                        lambda *parts: tmp_path.joinpath(*parts))
+    (tmp_path/"test").mkdir()
+    cache = pysdfscad.cache.DiskCache("test", suffix=".bin", max_size=100)
+
+    def failing_replace(src, dst):
+        raise OSError("disk full")
+    with monkeypatch.context() as m:
+        m.setattr(os, "replace", failing_replace)
+        assert cache.put("a", b"x" * 10) is None
+    assert list((tmp_path/"test").iterdir()) == []
+
+    # Left behind by a process that died mid write
+    stale = tmp_path/"test"/"old.tmp"
+    stale.write_bytes(b"x")
+    os.utime(stale, (0, 0))
+    scans = []
+    entries = cache.entries
+    monkeypatch.setattr(cache, "entries", lambda: scans.append(1) or entries())
+    cache.put("a", b"x" * 10)
+    assert not stale.exists() and len(scans) == 1
+    # Only scanned again once over budget
+    cache.put("b", b"x" * 10)
+    assert len(scans) == 1
+    cache.put("c", b"x" * 90)
+    assert len(scans) == 2
+    assert sum(size for _, size, _ in entries()) <= 100
+
+def test_single_parse_per_revision(monkeypatch):
+    import pysdfscad.main
+    parses = []
+    parser = pysdfscad.main.openscad_parser
+    class CountingParser:
+        def parse(self, text):
+            parses.append(text)
+            return parser.parse(text)
+    monkeypatch.setattr(pysdfscad.main, "openscad_parser", CountingParser())
+
+    interpreter = OpenscadFile(use_cache=False)
+    interpreter.text = "echo(1);"
+    interpreter.as_ast()
+    interpreter.as_python()
+    interpreter.run()
+    assert len(parses) == 1
+
+    interpreter.text = "echo(1);"
+    interpreter.run()
+    assert len(parses) == 1
+
+    interpreter.text = "echo(2);"
+    interpreter.run()
+    assert len(parses) == 2
+
+def test_incremental_transform():
+    import ast
+    from pysdfscad.compiler import OpenscadToPy, IncrementalOpenscadToPy, parser
+
+    source = """
+    module a() cube([1,1,1]);
+    function f(x) = x*2;
+    a();
+    """
+    edited = "b=1;\n" + source.replace("x*2", "x*3")
+
+    incremental = IncrementalOpenscadToPy()
+    incremental.transform(parser.parse(source), source)
+    tree = parser.parse(edited)
+    result = incremental.transform(tree, edited)
+    assert incremental.transformed == 2
+    assert incremental.reused == 2
+    expected = OpenscadToPy().transform(tree)
+    assert ast.dump(result, include_attributes=True) == ast.dump(expected, include_attributes=True)
+
+def test_constant_folding(caplog):
+    interpreter = OpenscadFile(use_cache=False)
+    interpreter.text = """
+    teeth = 12;
+    pitch = 360 / teeth;
+    function sin(x) = x;
+    echo(pitch * 2, cos(0) + 1, sin(2), true ? PI : 0);
+    """
+    source = interpreter.as_python()
+    assert "60.0, 2.0, function_sin(2), 3.14159" in source
+    assert "var_teeth" not in source
+    interpreter.run()
+    assert "ECHO: 60.0, 2.0, 2, 3.14159" in caplog.text
+
+def test_constant_folding_keeps_order():
+    # Using a variable before it's assigned fails the same way with and
+    # without optimization
+    text = """
+    echo(width);
+    module ring() { cylinder(h=1, r=width); }
+    width = 4;
+    ring();
+    """
+    for optimize in (True, False):
+        interpreter = OpenscadFile(use_cache=False, optimize=optimize)
+        interpreter.text = text
+        with pytest.raises(UnboundLocalError):
+            interpreter.run()
+    interpreter = OpenscadFile(use_cache=False)
+    interpreter.text = text.replace("echo(width);", "")
+    (ring,) = interpreter.run()
+    assert "var_width = 4" in interpreter.as_python()
+    unoptimized = OpenscadFile(use_cache=False, optimize=False)
+    unoptimized.text = interpreter.text
+    assert unoptimized.run() == [ring]
+
+def test_memoized_functions(caplog):
+    caplog.set_level(logging.DEBUG)
+    interpreter = OpenscadFile(use_cache=False)
+    interpreter.text = """
+    function fib(n) = n < 2 ? n : fib(n-1) + fib(n-2);
+    function scaled(v) = [v[0]*k, v[1]*k];
+    // pysdfscad: no-memoize
+    function plain(n) = n;
+    echo(fib(60), plain(1));
+    k = 1;
+    echo(scaled([1, 2]));
+    k = 2;
+    echo(scaled([1, 2]));
+    """
+    source = interpreter.as_python()
+    assert source.count("@memoize") == 2
+    interpreter.run()
+    assert "ECHO: 1548008755920, 1" in caplog.text
+    assert "ECHO: [1, 2]" in caplog.text
+    assert "ECHO: [2, 4]" in caplog.text
+    assert "function fib(): 58 memoized calls, 61 evaluated" in caplog.text
+
+def test_memoize_skips_big_keys(monkeypatch):
+    from pysdfscad import openscad_builtins
+    monkeypatch.setattr(openscad_builtins, "memo_stats", openscad_builtins.Counter())
+    points = list(range(openscad_builtins.MEMO_MAX_KEY + 1))
+    offset = 1
+    def function_big(i):
+        return points[i] + offset
+    def function_small(i):
+        return i + offset
+    big, small = openscad_builtins.memoize(function_big), openscad_builtins.memoize(function_small)
+    for _ in range(3):
+        assert big(5) == 6 and small(5) == 6
+    stats = openscad_builtins.memo_stats
+    assert stats["big", "hits"] == 0 and stats["big", "misses"] == 3
+    assert stats["small", "hits"] == 2
+    # Both still see changes to the variables they close over
+    offset = 2
+    assert big(5) == 7 and small(5) == 7
+
+def test_geometry_dag():
+    from pysdfscad import geometry
+    a, b = geometry.sphere(1), geometry.sphere(2)
+    assert geometry.sphere(1) is a
+    nested = geometry.union([geometry.union([b, a]), a, geometry.translate(b, (0, 0, 0))])
+    assert geometry.optimize([nested]) == geometry.optimize([geometry.union([a, b])])
+    assert geometry.optimize([nested]) == geometry.optimize([geometry.union([b, a])])
+    # Smooth booleans depend on the order children are combined in
+    smooth = geometry.union([b, a], k=0.5)
+    assert geometry.optimize([smooth]) == [smooth]
+
+    out = eval_scad("""
+    union(smooth=0){
+        sphere(r=1);
+        translate([0,0,0]) sphere(r=1);
+        union(smooth=0) cube([1,1,1], center=true);
+    }
+    """)
+    assert out == geometry.optimize([geometry.union([geometry.sphere(1), geometry.box((1, 1, 1))])])
+
+def test_nary_booleans():
+    import numpy as np
+    from pysdfscad import geometry
+    spheres = [geometry.translate(geometry.sphere(1), (i, 0, 0)) for i in range(50)]
+    p = np.random.default_rng(0).uniform(-2, 52, (1000, 3))
+    distances = np.array([i.to_sdf()(p).reshape(-1) for i in spheres])
+    union = geometry.union(spheres).to_sdf()(p).reshape(-1)
+    assert np.allclose(union, distances.min(axis=0))
+    difference = geometry.difference(spheres[:3]).to_sdf()(p).reshape(-1)
+    assert np.allclose(difference, np.maximum(distances[0], -distances[1:3].min(axis=0)))
+    # Smooth unions only ever add material
+    smooth = geometry.union(spheres, k=0.5).to_sdf()(p).reshape(-1)
+    assert np.all(smooth <= union + 1e-9)
+
+def test_bounds_and_bvh():
+    import numpy as np
+    from pysdfscad import geometry
+    rng = np.random.default_rng(0)
+    shape = geometry.rotate(geometry.translate(geometry.box((1, 2, 3)), (1, 0, 0)), 0.7, (1, 1, 0))
+    p = rng.uniform(-5, 5, (20000, 3))
+    low, high = shape.bounds
+    inside = p[shape.to_sdf()(p).reshape(-1) < 0]
+    assert np.all(inside >= low) and np.all(inside <= high)
+
+    spheres = [geometry.translate(geometry.sphere(1), tuple(rng.uniform(-50, 50, 3))) for _ in range(100)]
+    distances = np.array([i.to_sdf()(p * 10).reshape(-1) for i in spheres])
+    union = geometry.union(spheres).to_sdf()(p * 10).reshape(-1)
+    assert np.allclose(union, distances.min(axis=0))
+
+def test_smooth_union_culling():
+    import numpy as np
+    from pysdfscad import geometry, kernel
+    # Unions from .scad source are smooth
+    (node,) = eval_scad("union(){ for (i=[0:15]) translate([i*3,0,0]) sphere(1); }")
+    assert node.op == "union" and node.params == (1,) and len(node.children) >= geometry.Union.bvh_threshold
+    p = np.random.default_rng(0).uniform((-3, -3, -3), (50, 3, 3), (20000, 3))
+    children = [i.to_sdf() for i in node.children]
+    expected = geometry._balanced(geometry.smooth_min, children, p, 1).reshape(-1)
+    assert np.allclose(node.to_sdf()(p).reshape(-1), expected)
+    assert np.allclose(kernel.fuse(node)(p).reshape(-1), expected)
+
+    # Each point only evaluates the spheres near it, not all of them
+    calls = []
+    def counted(f):
+        def g(p):
+            calls.append(len(p))
+            return f(p)
+        return g
+    tree = geometry.SmoothBVH([(i.bounds, counted(f)) for i, f in zip(node.children, children)], 1)
+    assert np.allclose(tree(p), expected)
+    assert sum(calls) < 2 * len(p)
+
+def test_transform_chains():
+    import numpy as np
+    from pysdfscad import geometry
+    out = eval_scad("""
+    translate([1,2,3]) rotate([10,20,30]) scale([2,1,1]) mirror([1,1,0]) cube([1,2,3], center=true);
+    translate([1,0]) rotate(30) translate([0,1]) square([1,2]);
+    """)
+    # Each chain ends up as a single transform over the primitive
+    assert [i.op for i in out] == ["transform", "transform"]
+    assert [i.children[0].op for i in out] == ["box", "rectangle"]
+
+    box = geometry.box((1, 2, 3))
+    chain = geometry.translate(geometry.rotate(geometry.scale(box, (2, 1, 0.5)), 0.7, (1, 1, 0)), (1, 0, 0))
+    (collapsed,) = geometry.optimize([chain])
+    assert collapsed.op == "transform"
+    p = np.random.default_rng(0).uniform(-4, 4, (20000, 3))
+    d = collapsed.to_sdf()(p)
+    assert np.allclose(d, chain.to_sdf()(p))
+    low, high = collapsed.bounds
+    inside = p[d.reshape(-1) < 0]
+    assert len(inside) and np.all(inside >= low) and np.all(inside <= high)
+    # Translations on their own stay translations
+    double = geometry.translate(geometry.translate(box, (1, 0, 0)), (0, 1, 0))
+    assert geometry.optimize([double]) == [geometry.translate(box, (1.0, 1.0, 0.0))]
+
+def test_mesh_bounds():
+    import numpy as np
+    from pysdfscad import geometry
+    out = eval_scad("translate([10,0,0]) difference(){ cube([4,4,4], center=true); sphere(r=2.5); }")
+    low, high = geometry.mesh_bounds(out[0], step=0.25)
+    assert np.allclose(low, (7.5, -2.5, -2.5)) and np.allclose(high, (12.5, 2.5, 2.5))
+    points = out[0].generate(step=0.25, verbose=False)
+    assert np.all(np.array(points) >= low) and np.all(np.array(points) <= high)
+
+def test_special_variables():
+    from pysdfscad import geometry, resolution
+    out = eval_scad("""
+    $fs = 0.5;
+    module ball($fn=6) sphere(r=1);
+    ball();
+    ball($fn=12);
+    sphere(r=1);
+    """)
+    assert [i.params[0] for i in out] == pytest.approx([1 - math.cos(math.pi / n) for n in (6, 12, 13)])
+    # A low $fn never meshes coarser than the default, a higher one finer
+    default = resolution.samples_step(geometry.sphere(1))
+    assert resolution.choose_step(out[0]) == pytest.approx(default)
+    fine = eval_scad("sphere(r=1, $fn=16);")[0]
+    finer = eval_scad("sphere(r=1, $fn=24);")[0]
+    assert resolution.choose_step(finer) < resolution.choose_step(fine) < default
+    assert resolution.choose_step(finer, triangles=1000) > resolution.choose_step(finer)
+    # But not so fine a normal sized part takes forever to mesh
+    for source in ("$fn=100; sphere(r=10);", "$fs=0.5; $fa=2; cylinder(r=20, h=5);"):
+        (node,) = eval_scad(source)
+        low, high = node.bounds
+        samples = math.prod(high - low) / resolution.choose_step(node) ** 3
+        assert samples <= resolution.MAX_DETAIL_SAMPLES * 1.001
+    assert eval_scad("sphere(r=1);") == [geometry.sphere(1)]
+
+def test_nary_smooth_union_is_closed():
+    import numpy as np
+    from pysdfscad import geometry
+    bars = [geometry.rotate(geometry.box((6, 0.3, 0.3)), i * 360 / 32) for i in range(32)]
+    vertices, faces = geometry.union(bars, k=0.5).generate(step=0.05, engine="octree", indexed=True, verbose=False)
+    edges = np.sort(np.concatenate([faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]]), axis=1)
+    _, counts = np.unique(edges, axis=0, return_counts=True)
+    # No open edges, where the bounds clip the mesh
+    assert len(faces) and not np.any(counts == 1)
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+from pysdfscad import geometry, kernel
+
+SHAPES = {
+    "primitives": geometry.union(
+        [
+            geometry.sphere(1),
+            geometry.translate(geometry.box((1, 2, 3)), (1, 0, 0)),
+            geometry.rotate(geometry.translate(geometry.box(2), (0, 1, 0)), 0.4, (1, 1, 0)),
+        ]
+    ),
+    "difference": geometry.difference(
+        [geometry.box((4, 4, 4)), geometry.translate(geometry.sphere(1), (1, 0, 0)), geometry.sphere(1.5)]
+    ),
+    "intersection": geometry.intersection([geometry.box((4, 4, 4)), geometry.shell(geometry.sphere(2), 0.3)]),
+    "smooth_union": geometry.union(
+        [
+            geometry.sphere(1),
+            geometry.translate(geometry.sphere(1), (1.5, 0, 0)),
+            geometry.translate(geometry.box(1), (0, 1.2, 0)),
+        ],
+        0.5,
+    ),
+    "smooth_difference": geometry.difference(
+        [geometry.box((4, 4, 4)), geometry.sphere(2.3), geometry.translate(geometry.sphere(1), (2, 2, 2))], 0.3
+    ),
+    "extrude": geometry.rotate(
+        geometry.extrude(
+            geometry.difference(
+                [
+                    geometry.rectangle((3, 2)),
+                    geometry.rotate(geometry.translate(geometry.circle(0.5), (0.5, 0, 0)), 0.3, (0, 0, 1)),
+                ]
+            ),
+            2,
+        ),
+        0.5,
+        (0, 1, 0),
+    ),
+    "bvh": geometry.union(
+        [geometry.translate(geometry.sphere(1), (i * 1.5, (i * 7) % 5, (i * 3) % 4)) for i in range(40)]
+    ),
+    "fallback": geometry.union([geometry.capped_cone((0, 0, 0), (0, 0, 2), 1, 0.5), geometry.sphere(1)]),
+}
+
+
+@pytest.mark.parametrize("name", SHAPES)
+def test_fused_kernel_matches_closures(name):
+    (shape,) = geometry.optimize([SHAPES[name]])
+    points = np.random.default_rng(0).uniform(-5, 10, (5000, 3))
+    f = kernel.fuse(shape)
+    assert f is kernel.fuse(shape)
+    assert np.allclose(f(points), shape.to_sdf()(points))
+    # Scratch buffers are reallocated for a different batch size
+    assert np.allclose(f(points[:7]), shape.to_sdf()(points[:7]))
+
+
+@pytest.mark.parametrize("value", [float("inf"), float("nan")])
+def test_non_finite_constants(value):
+    shape = geometry.sphere(value)
+    points = np.random.default_rng(0).uniform(-5, 5, (100, 3))
+    assert np.array_equal(kernel.fuse(shape)(points), shape.to_sdf()(points), equal_nan=True)
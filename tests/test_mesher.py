@@ -0,0 +1,238 @@
+import numpy as np
+import pytest
+from pysdfscad import decimate, geometry, mesher
+
+
+def triangles(points):
+    return {tuple(i) for i in np.round(np.asarray(points).reshape(-1, 9), 6)}
+
+
+def test_octree_matches_uniform_grid():
+    shape = geometry.difference(
+        [geometry.box((10, 10, 10)), geometry.box((9, 9, 9)), geometry.sphere(3)]
+    )
+    bounds = geometry.mesh_bounds(shape, step=0.25)
+    uniform = shape.generate(step=0.25, bounds=bounds, verbose=False, sparse=False)
+    octree = shape.generate(step=0.25, bounds=bounds, engine="octree", verbose=False)
+    assert len(octree) == len(uniform)
+    assert triangles(octree) == triangles(uniform)
+
+
+def test_octree_skips_empty_space():
+    f = geometry.sphere(1).to_sdf()
+    axes = mesher.grid(((-20, -20, -20), (20, 20, 20)), 0.1)
+    blocks = mesher.surface_blocks(f, axes)
+    total = np.prod(np.ceil((np.array([len(i) for i in axes]) - 1) / mesher.LEAF_SIZE))
+    assert 0 < len(blocks) < total / 100
+
+
+def test_interval_bounds_samples():
+    rng = np.random.default_rng(0)
+    shape = geometry.difference(
+        [
+            geometry.rotate(geometry.box((2, 3, 4)), 0.5, (1, 1, 0)),
+            geometry.translate(geometry.sphere(1), (1, 0, 0)),
+            geometry.extrude(geometry.circle(0.5), 6),
+        ]
+    )
+    low = rng.uniform(-3, 3, (100, 3))
+    high = low + rng.uniform(0, 1, (100, 3))
+    d_low, d_high = geometry.interval(shape, low, high)
+    f = shape.to_sdf()
+    for i in range(len(low)):
+        d = f(rng.uniform(low[i], high[i], (200, 3))).reshape(-1)
+        assert d_low[i] <= d.min() and d.max() <= d_high[i]
+
+
+def test_sparse_engines_take_their_options(monkeypatch):
+    shape = geometry.sphere(2)
+    for engine in ("octree", "dual"):
+        calls = []
+        generate = geometry.SPARSE_ENGINES[engine]
+        def spy(*args, **kwargs):
+            calls.append(kwargs)
+            return generate(*args, **kwargs)
+        monkeypatch.setitem(geometry.SPARSE_ENGINES, engine, spy)
+        shape.generate(step=0.25, engine=engine, verbose=False, leaf_size=4)
+        assert calls[0]["leaf_size"] == 4
+        # Options the engine doesn't know aren't silently ignored
+        with pytest.raises(TypeError):
+            shape.generate(step=0.25, engine=engine, verbose=False, leaf_sise=4)
+
+
+def test_specialize_prunes_far_children():
+    near, far = geometry.sphere(1), geometry.translate(geometry.sphere(1), (10, 0, 0))
+    shape = geometry.difference([geometry.box((4, 4, 4)), near, far])
+    (pruned,) = geometry.specialize(shape, (-2, -2, -2), (2, 2, 2))
+    assert pruned == geometry.difference([geometry.box((4, 4, 4)), near])
+
+
+def test_specialize_prunes_smooth_unions():
+    from test_interpretor import eval_scad
+
+    (shape,) = eval_scad("union(){ sphere(1); translate([1.5,0,0]) sphere(1); translate([10,0,0]) sphere(1); }")
+    assert shape.params == (1,)
+    near = geometry.union(list(shape.children[:2]), k=1)
+    (pruned,) = geometry.specialize(shape, (-2, -2, -2), (2, 2, 2))
+    assert pruned == near
+    # What's left keeps its grouping, so the result doesn't change at all
+    s0, s1, s2 = [geometry.translate(geometry.sphere(1), (i * 1.5, 0, 0)) for i in range(3)]
+    far = geometry.translate(geometry.sphere(1), (0, 20, 0))
+    shape = geometry.union([s0, far, s1, s2], k=1)
+    (pruned,) = geometry.specialize(shape, (-2, -2, -2), (5, 2, 2))
+    (expected,) = geometry.optimize([geometry.union([s0, geometry.union([s1, s2], k=1)], k=1)])
+    assert pruned == expected
+    p = np.random.default_rng(0).uniform((-2, -2, -2), (5, 2, 2), (5000, 3))
+    assert np.allclose(shape.to_sdf()(p), pruned.to_sdf()(p))
+    # The far sphere is only pruned once it's k past the near ones
+    (kept,) = geometry.specialize(shape, (-2, -2, -2), (5, 17, 2))
+    assert kept == shape
+
+def test_decimate_merges_flat_faces():
+    shape = geometry.box((4, 4, 4))
+    vertices, faces = shape.generate(step=0.1, engine="octree", verbose=False, indexed=True)
+    out, out_faces = decimate.decimate((vertices, faces), 0.01)
+    assert len(out_faces) < len(faces) / 20
+    assert np.abs(shape.to_sdf()(out)).max() <= 0.01
+    vertices, faces = mesher.weld(out[out_faces])
+    _, uses = decimate.edges(faces, len(vertices))
+    assert np.all(uses == 2)
+
+
+def test_dual_contouring_keeps_corners():
+    shape = geometry.box((4, 4, 4))
+    points = shape.generate(step=0.5, engine="dual", verbose=False)
+    corners = np.array([(x, y, z) for x in (-2, 2) for y in (-2, 2) for z in (-2, 2)])
+    distance = np.linalg.norm(points[:, None, :] - corners, axis=2).min(axis=0)
+    assert np.all(distance < 1e-6)
+    vertices, faces = mesher.weld(points)
+    _, uses = decimate.edges(faces, len(vertices))
+    assert np.all(uses == 2)
+
+
+def test_indexed_meshes_match_soup():
+    shape = geometry.difference([geometry.box((4, 4, 4)), geometry.sphere(2.5)])
+    for engine in ("sdf", "octree", "dual"):
+        soup = shape.generate(step=0.2, engine=engine, verbose=False)
+        vertices, faces = shape.generate(step=0.2, engine=engine, verbose=False, indexed=True)
+        assert np.array_equal(vertices[faces].reshape(-1, 3), np.asarray(soup).reshape(-1, 3))
+        if engine != "dual":  # Dual contouring can put two cells' vertices in one place
+            assert len(vertices) == len(mesher.weld(soup)[0])
+
+
+def test_volume_cache_remeshes_offsets(tmp_path, monkeypatch):
+    from pysdfscad import cache
+
+    monkeypatch.setattr(cache, "cache_dir", lambda *parts: tmp_path.joinpath(*parts))
+    (tmp_path / "volumes").mkdir()
+    volumes = cache.VolumeCache()
+    shape = geometry.sphere(2)
+    points = shape.generate(step=0.1, engine="volume", volumes=volumes, margin=1, verbose=False)
+    assert len(points) == len(shape.generate(step=0.1, bounds=((-3.2,) * 3, (3.2,) * 3), verbose=False))
+
+    def no_sampling(*args, **kwargs):
+        raise AssertionError("Cached volume was sampled again")
+
+    monkeypatch.setattr(geometry, "distance", no_sampling)
+    for level in (-0.5, 0.5):
+        points = shape.generate(step=0.1, engine="volume", volumes=volumes, margin=1, level=level, verbose=False)
+        assert np.allclose(np.linalg.norm(points, axis=1), 2 + level, atol=0.01)
+
+
+def test_tiles_only_remesh_changes():
+    from pysdfscad import tiles
+
+    def model(x):
+        holes = [geometry.translate(geometry.sphere(1), (i * 3 - 6, 0, 0)) for i in range(5)]
+        (node,) = geometry.optimize([geometry.difference([geometry.box((16, 4, 4)), *holes, geometry.sphere(0.5 + x)])])
+        return node
+
+    assert geometry.changed(model(0), model(0)) == []
+    incremental = tiles.TiledMesh(tile_cells=8)
+    assert incremental.fresh(model(0), 0.25)
+    total = incremental.update(model(0), step=0.25)
+    assert not incremental.fresh(model(0.2), 0.25) and incremental.fresh(model(0), 0.5)
+    assert incremental.update(model(0), step=0.25) == 0
+    assert 0 < incremental.copy().update(model(0.2), step=0.25) < total
+    assert incremental.node is model(0)
+    assert 0 < incremental.update(model(0.2), step=0.25) < total
+    scratch = tiles.TiledMesh(tile_cells=8)
+    scratch.update(model(0.2), step=0.25)
+    a, b = (np.sort(v[f].reshape(-1, 9), axis=0) for v, f in (incremental.mesh(), scratch.mesh()))
+    assert a.shape == b.shape and np.allclose(a, b)
+
+
+@pytest.mark.parametrize("engine", ["sdf", "octree", "dual", "volume"])
+def test_cancelled_meshing_stops(engine):
+    import threading
+
+    cancel = threading.Event()
+    cancel.set()
+    with pytest.raises(geometry.Cancelled):
+        geometry.sphere(1).generate(step=0.1, engine=engine, verbose=False, cancel=cancel)
+
+
+def test_cancelled_tiles_are_left_alone():
+    import threading
+
+    from pysdfscad import tiles
+
+    mesh = tiles.TiledMesh(tile_cells=8)
+    mesh.update(geometry.sphere(1), step=0.25)
+    before = mesh.mesh()
+    cancel = threading.Event()
+    cancel.set()
+    with pytest.raises(geometry.Cancelled):
+        mesh.update(geometry.sphere(1.5), step=0.25, cancel=cancel)
+    assert mesh.node is geometry.sphere(1)
+    assert all(np.array_equal(a, b) for a, b in zip(before, mesh.mesh()))
+
+
+def test_progressive_passes_end_at_full_resolution():
+    from pysdfscad import progressive
+
+    (shape,) = geometry.optimize([geometry.difference([geometry.box((4, 4, 4)), geometry.sphere(2.5)])])
+    passes = list(progressive.refine(shape, step=0.05))
+    steps = [step for step, _ in passes]
+    assert len(steps) > 1 and steps[-1] == 0.05
+    assert all(a == 2 * b for a, b in zip(steps, steps[1:]))
+    counts = [len(faces) for _, (_, faces) in passes]
+    assert counts == sorted(counts)
+    bounds = geometry.mesh_bounds(shape, steps[0])
+    whole = shape.generate(0.05, bounds, engine="octree", indexed=True, verbose=False)
+    a, b = (np.sort(v[f].reshape(-1, 9), axis=0) for v, f in (passes[-1][1], whole))
+    assert a.shape == b.shape and np.allclose(a, b)
+
+
+def test_tiles_skip_the_mesh_cache(tmp_path, monkeypatch):
+    from pysdfscad import cache, tiles
+
+    monkeypatch.setattr(cache, "cache_dir", lambda *parts: tmp_path.joinpath(*parts))
+    (tmp_path / "meshes").mkdir()
+    meshes = cache.MeshCache()
+    mesh = tiles.TiledMesh(tile_cells=8)
+    mesh.update(geometry.sphere(1), step=0.25, cache=meshes)
+    assert not meshes.entries()
+    # Meshed whole, that's worth keeping
+    mesh.update(geometry.sphere(1), step=0.25, engine="dual", cache=meshes)
+    assert len(meshes.entries()) == 1
+
+
+def test_tiles_adopt_the_last_progressive_pass():
+    from pysdfscad import progressive, tiles
+
+    def model(x):
+        (node,) = geometry.optimize([geometry.difference([geometry.box((8, 4, 4)), geometry.sphere(1 + x)])])
+        return node
+
+    *_, (step, mesh) = progressive.refine(model(0), step=0.125, align=True)
+    adopted = tiles.TiledMesh(tile_cells=8)
+    adopted.adopt(model(0), step, mesh)
+    scratch = tiles.TiledMesh(tile_cells=8)
+    total = scratch.update(model(0), step=0.125)
+    a, b = (np.sort(v[f].reshape(-1, 9), axis=0) for v, f in (adopted.mesh(), scratch.mesh()))
+    assert a.shape == b.shape and np.allclose(a, b)
+    assert set(adopted.tiles) == set(scratch.tiles)
+    # Edits after that only mesh what they touched
+    assert not adopted.fresh(model(0.2), 0.125)
+    assert 0 < adopted.update(model(0.2), step=0.125) < total
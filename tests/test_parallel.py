@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+from pysdfscad import geometry, parallel
+
+
+def test_process_pool_matches_local():
+    shape = geometry.difference(
+        [geometry.box((4, 4, 4)), geometry.translate(geometry.sphere(1), (1, 0, 0)), geometry.sphere(1.5)]
+    )
+    points = np.random.default_rng(0).uniform(-3, 3, (10000, 3))
+    with parallel.ProcessPool(2, slot_points=3000) as pool:
+        f = pool.function(shape)
+        assert f == pool.function(shape)
+        local = geometry.distance(shape)
+        assert np.array_equal(f(points), local(points))
+        assert np.array_equal(f(points[:10]), local(points[:10]))
+
+
+def test_process_pool_survives_errors():
+    points = np.random.default_rng(0).uniform(-3, 3, (10000, 3))
+    with parallel.ProcessPool(2, slot_points=1000) as pool:
+        # Fuses fine, but fails on the first batch of points
+        broken = pool.function(geometry.sphere("oops"))
+        for _ in range(3):
+            with pytest.raises(Exception):
+                broken(points)
+        assert pool._free.qsize() == 4
+        shape = geometry.sphere(1)
+        assert np.array_equal(pool.function(shape)(points), geometry.distance(shape)(points))